@@ -0,0 +1,611 @@
+"""
+Throughput benchmarks of the generation -> extraction -> probe pipeline, offline on CPU.
+
+Measures samples/sec of each dataset/synthetic generator, embeddings/sec of each Model
+type and probe steps/sec of ProbeExperiment.train, and writes them to a JSON file named
+by the commit, so that the results of two commits can be compared:
+
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/<commit>.json
+
+Nothing is downloaded. Unless --real_synth is given, the synth is replaced by a stub that
+writes a tone as long as the MIDI file, and foundation models are tiny randomly
+initialized configs of the same architectures, so the numbers measure the pipeline code
+rather than the soundfont or the size of the pretrained models. Benchmarks that can not
+run in the environment, e.g. because ffmpeg is missing, are recorded with their error.
+"""
+import sys
+import json
+import time
+import zlib
+import argparse
+import platform
+import tempfile
+import traceback
+import subprocess
+from pathlib import Path
+from types import ModuleType
+from itertools import islice
+from contextlib import ExitStack, redirect_stdout, redirect_stderr
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from unittest.mock import patch
+
+import mido
+import numpy as np
+import soundfile as sf
+import torch
+
+from config import REPO_ROOT, DEFAULT_SYNTH_BINARY_LOCATION
+from probe.metrics_sink import MetricsSink
+from probe.probe_config import ProbeExperimentConfig
+from probe.probes import ProbeExperiment
+
+BENCHMARK_RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+
+# rows of each generator that are timed, after one untimed warm up row
+GENERATOR_NUM_ROWS = 8
+
+# embeddings extracted per model, after one untimed warm up sample
+EMBEDDING_NUM_SAMPLES = 8
+
+# size of the synthetic split a probe is trained on
+PROBE_NUM_SAMPLES = 4096
+PROBE_EMBEDDING_DIMENSION = 1024
+PROBE_NUM_EPOCHS = 4
+
+# sample rate of the stub synth, the same as the synth binary
+STUB_SYNTH_SAMPLE_RATE = 44100
+
+# a benchmark is reported as slower or faster than another if it differs by more than this
+REGRESSION_TOLERANCE = 0.1
+
+TEXT_PROMPT = "A C major chord in root position played on an acoustic grand piano."
+
+
+def stub_synth_wav_from_midi(
+    midi_filepath: Path, save_wav_to: Optional[Path] = None, show_logs: bool = True
+) -> None:
+    """Stands in for produce_synth_wav_from_midi, writing a tone as long as the MIDI."""
+    if not save_wav_to:
+        save_wav_to = midi_filepath.with_name(midi_filepath.stem + ".wav")
+
+    # the synth binary renders the release of the last note too
+    duration = mido.MidiFile(midi_filepath).length + 1.0
+    t = np.arange(int(duration * STUB_SYNTH_SAMPLE_RATE)) / STUB_SYNTH_SAMPLE_RATE
+    audio = 0.25 * np.sin(2 * np.pi * 440.0 * t)
+    sf.write(str(save_wav_to), np.stack([audio, audio], axis=1), STUB_SYNTH_SAMPLE_RATE)
+
+
+def get_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def measure(run: Callable[[], int], num_runs: int) -> Dict[str, Any]:
+    """Times num_runs calls of run, after one untimed warm up call.
+
+    run returns the number of items it produced, the result is their throughput.
+    """
+    run()
+    num_items = 0
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        num_items += run()
+    seconds = time.perf_counter() - start
+    return {
+        "num_items": num_items,
+        "seconds": seconds,
+        "items_per_sec": num_items / seconds if seconds > 0 else None,
+    }
+
+
+def _quiet():
+    # generators and models print per sample, which would dominate short benchmarks
+    stack = ExitStack()
+    stack.enter_context(redirect_stdout(None))
+    stack.enter_context(redirect_stderr(None))
+    return stack
+
+
+def _run_benchmark(name: str, benchmark: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    print(f"Running {name} ...")
+    try:
+        with _quiet():
+            result = benchmark()
+    except Exception as e:
+        print(f"  failed: {e}")
+        return {"error": str(e), "traceback": traceback.format_exc()}
+    print(f"  {result['items_per_sec']:.2f} / sec")
+    return result
+
+
+# --- dataset generation ---
+
+
+def _get_generator_row_iterators() -> Dict[str, Tuple[ModuleType, Iterator]]:
+    """Small configurations of each generator, the first rows of its real configuration."""
+    from dataset.synthetic import (
+        chord_progressions,
+        chords,
+        intervals,
+        notes,
+        scales,
+        tempos,
+        time_signatures,
+    )
+    from dataset.synthetic.metronome_configs import CLICK_CONFIGS
+    from dataset.synthetic.midi_instrument import get_instruments
+
+    instruments = get_instruments(
+        ignore_atonal=True,
+        ignore_polyphonic=True,
+        ignore_highly_articulate=True,
+        take_only_first_category=False,
+    )[:2]
+    return {
+        "notes": (
+            notes,
+            notes.get_row_iterator(notes.get_all_midi_note_values(), instruments),
+        ),
+        "intervals": (
+            intervals,
+            intervals.get_row_iterator(
+                intervals.get_all_interval_midi_settings(), instruments
+            ),
+        ),
+        "scales": (
+            scales,
+            scales.get_row_iterator(scales.get_all_scales(), instruments),
+        ),
+        "chords": (
+            chords,
+            chords.get_row_iterator(chords.get_all_chords(), instruments),
+        ),
+        "chord_progressions": (
+            chord_progressions,
+            chord_progressions.get_row_iterator(
+                chord_progressions.PROGRESSIONS,
+                chord_progressions.get_all_keys(),
+                instruments,
+            ),
+        ),
+        "tempos": (
+            tempos,
+            tempos.get_row_iterator(
+                slowest_bpm=50,
+                fastest_bpm=210,
+                click_configs=CLICK_CONFIGS[:2],
+                num_random_offsets=2,
+                target_duration_per_sample_in_sec=4.0,
+                seed=0,
+            ),
+        ),
+        "time_signatures": (
+            time_signatures,
+            time_signatures.get_row_iterator(
+                time_signatures.get_all_time_signatures(),
+                click_configs=CLICK_CONFIGS[:2],
+                num_reverb_levels=1,
+                num_random_offsets=2,
+                target_duration_per_sample_in_sec=4.0,
+                seed=0,
+            ),
+        ),
+    }
+
+
+def benchmark_generator(
+    module: ModuleType,
+    row_iterator: Iterator,
+    num_rows: int = GENERATOR_NUM_ROWS,
+    real_synth: bool = False,
+) -> Dict[str, Any]:
+    """Samples/sec of the row processor of a generator, in one process.
+
+    A row may produce several samples, e.g. the random offsets of a tempo, each counts.
+    """
+    rows = list(islice(row_iterator, num_rows + 1))
+    rows_to_run = iter(rows)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, ExitStack() as stack:
+        if not real_synth:
+            stack.enter_context(
+                patch.object(
+                    module, "produce_synth_wav_from_midi", stub_synth_wav_from_midi
+                )
+            )
+        result = measure(
+            lambda: len(module.row_processor(Path(tmp_dir), next(rows_to_run))),
+            num_runs=len(rows) - 1,
+        )
+    return {**result, "num_rows": len(rows) - 1}
+
+
+def benchmark_generators(real_synth: bool = False) -> Dict[str, Any]:
+    return {
+        name: _run_benchmark(
+            f"generator {name}",
+            lambda: benchmark_generator(module, row_iterator, real_synth=real_synth),
+        )
+        for name, (module, row_iterator) in _get_generator_row_iterators().items()
+    }
+
+
+# --- embedding extraction ---
+
+
+class TinyMusicgenProcessor:
+    """Stands in for the MusicGen processor of a tiny model, without a pretrained tokenizer.
+
+    Audio goes through the real feature extractor, words of a text are hashed to token ids.
+    """
+
+    def __init__(self, vocab_size: int, sampling_rate: int) -> None:
+        from transformers import EncodecFeatureExtractor
+
+        self.vocab_size = vocab_size
+        self.feature_extractor = EncodecFeatureExtractor(
+            feature_size=1, sampling_rate=sampling_rate
+        )
+
+    def __call__(
+        self,
+        audio=None,
+        text=None,
+        sampling_rate=None,
+        padding=True,
+        truncation=False,
+        return_tensors="pt",
+    ):
+        from transformers import BatchFeature
+
+        inputs = {}
+        if audio is not None:
+            inputs.update(
+                self.feature_extractor(
+                    audio, sampling_rate=sampling_rate, return_tensors="pt"
+                )
+            )
+        if text is not None:
+            # 0 is the padding token
+            input_ids = [
+                zlib.crc32(word.encode()) % (self.vocab_size - 1) + 1
+                for word in text.split()
+            ] or [0]
+            inputs["input_ids"] = torch.tensor([input_ids])
+            inputs["attention_mask"] = torch.ones_like(inputs["input_ids"])
+        return BatchFeature(inputs)
+
+
+def get_tiny_musicgen_model(vocab_size: int = 64):
+    """A randomly initialized MusicGen with small text encoder, audio encoder and decoder."""
+    from transformers import (
+        EncodecConfig,
+        MusicgenConfig,
+        MusicgenDecoderConfig,
+        MusicgenForConditionalGeneration,
+        T5Config,
+    )
+
+    sampling_rate = 32000
+    config = MusicgenConfig(
+        text_encoder=T5Config(
+            vocab_size=vocab_size, d_model=32, d_kv=8, d_ff=64, num_layers=2, num_heads=4
+        ),
+        audio_encoder=EncodecConfig(
+            target_bandwidths=[1.5],
+            sampling_rate=sampling_rate,
+            audio_channels=1,
+            num_filters=4,
+            hidden_size=32,
+            codebook_size=vocab_size,
+            num_lstm_layers=1,
+        ),
+        decoder=MusicgenDecoderConfig(
+            vocab_size=vocab_size,
+            hidden_size=32,
+            num_hidden_layers=4,
+            num_attention_heads=4,
+            ffn_dim=64,
+            num_codebooks=4,
+            pad_token_id=vocab_size,
+            bos_token_id=vocab_size,
+        ),
+    )
+    model = MusicgenForConditionalGeneration(config).eval()
+    return TinyMusicgenProcessor(vocab_size, sampling_rate), model
+
+
+def get_tiny_bert_model(vocab_dir: Path):
+    """A randomly initialized BERT with a small word level vocabulary."""
+    from transformers import BertConfig, BertModel, BertTokenizer
+
+    vocab_path = vocab_dir / "vocab.txt"
+    words = sorted({w.strip(".").lower() for w in TEXT_PROMPT.split()})
+    vocab_path.write_text(
+        "\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *words]) + "\n"
+    )
+    tokenizer = BertTokenizer(str(vocab_path))
+    model = BertModel(
+        BertConfig(
+            vocab_size=len(tokenizer),
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=64,
+        )
+    ).eval()
+    return tokenizer, model
+
+
+def benchmark_embeddings(num_samples: int = EMBEDDING_NUM_SAMPLES) -> Dict[str, Any]:
+    """Embeddings/sec of each Model type, from a 4 second audio file or a text prompt."""
+    try:
+        from embeddings.models import (
+            Model,
+            DURATION_IN_SEC,
+            audio_file_to_embedding_np_array,
+            text_prompt_to_embedding_np_array,
+        )
+    except ImportError as e:
+        return {"error": f"Could not import embeddings.models: {e}"}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_file = Path(tmp_dir, "sample.wav")
+        midi_file = Path(tmp_dir, "sample.mid")
+        # a stub synth wav of the extracted duration
+        mid = mido.MidiFile()
+        track = mido.MidiTrack()
+        track.append(mido.Message("note_on", note=60, velocity=100, time=0))
+        track.append(
+            mido.Message(
+                "note_off",
+                note=60,
+                time=int(mido.second2tick(DURATION_IN_SEC, mid.ticks_per_beat, 500000)),
+            )
+        )
+        mid.tracks.append(track)
+        mid.save(midi_file)
+        stub_synth_wav_from_midi(midi_file, audio_file)
+
+        text_models = {
+            Model.MUSICGEN_TEXT_ENCODER,
+            Model.MUSICGEN_DECODER_LM_S,
+            Model.MUSICGEN_DECODER_LM_M,
+            Model.MUSICGEN_DECODER_LM_L,
+            Model.BERT,
+        }
+        musicgen = None
+        bert = None
+        for model_type in Model:
+            if model_type == Model.JUKEBOX:
+                # jukemirlib only runs the pretrained 5B parameter model
+                results[model_type.name] = {
+                    "skipped": "Jukebox has no small configuration to run offline"
+                }
+                continue
+
+            def _benchmark() -> Dict[str, Any]:
+                nonlocal musicgen, bert
+                processor, model = None, None
+                with ExitStack() as stack:
+                    stack.enter_context(torch.no_grad())
+                    if model_type == Model.BERT:
+                        bert = bert or get_tiny_bert_model(Path(tmp_dir))
+                        # the pretrained model is loaded by each call
+                        stack.enter_context(
+                            patch(
+                                "embeddings.models.BertTokenizer.from_pretrained",
+                                return_value=bert[0],
+                            )
+                        )
+                        stack.enter_context(
+                            patch(
+                                "embeddings.models.BertModel.from_pretrained",
+                                return_value=bert[1],
+                            )
+                        )
+                    elif model_type.name.startswith("MUSICGEN"):
+                        musicgen = musicgen or get_tiny_musicgen_model()
+                        processor, model = musicgen
+
+                    if model_type in text_models:
+                        # these models embed the prompts datasets
+                        def _embed() -> int:
+                            text_prompt_to_embedding_np_array(
+                                TEXT_PROMPT, model_type, processor, model
+                            )
+                            return 1
+
+                    else:
+
+                        def _embed() -> int:
+                            audio_file_to_embedding_np_array(
+                                audio_file, model_type, processor, model
+                            )
+                            return 1
+
+                    return measure(_embed, num_runs=num_samples)
+
+            results[model_type.name] = _run_benchmark(
+                f"embeddings {model_type.name}", _benchmark
+            )
+    return results
+
+
+# --- probe training ---
+
+PROBE_BENCHMARKS = {
+    # standardization statistics updated on every batch
+    "linear": {"hidden_layer_sizes": []},
+    # standardized once, splits kept on the device
+    "linear_precompute_standardization": {
+        "hidden_layer_sizes": [],
+        "precompute_standardization": True,
+    },
+    "mlp_512": {"hidden_layer_sizes": [512], "precompute_standardization": True},
+}
+
+
+class StepSink(MetricsSink):
+    """Remembers the last step a probe reported."""
+
+    def __init__(self) -> None:
+        self.step = 0
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None) -> None:
+        if step is not None:
+            self.step = max(self.step, step)
+
+
+def benchmark_probe(
+    num_samples: int = PROBE_NUM_SAMPLES,
+    embedding_dimension: int = PROBE_EMBEDDING_DIMENSION,
+    num_epochs: int = PROBE_NUM_EPOCHS,
+    **cfg_kwargs,
+) -> Dict[str, Any]:
+    """Steps/sec of ProbeExperiment.train on an in-memory multiclass split."""
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(num_samples, embedding_dimension)).astype(np.float32)
+    y = X[:, :12].argmax(axis=1)
+
+    def _train() -> int:
+        sink = StepSink()
+        exp = ProbeExperiment(
+            ProbeExperimentConfig(
+                dataset="benchmark",
+                dataset_embeddings_label_column_name="label",
+                model_hash="benchmark",
+                num_outputs=12,
+                early_stopping=False,
+                max_num_epochs=num_epochs,
+                load_embeddings_in_memory=True,
+                **cfg_kwargs,
+            ),
+            summarize_frequency=1,
+            use_wandb=False,
+            metrics_sink=sink,
+        )
+        exp.split_to_uids = {"train": [], "valid": []}
+        exp.split_to_X = {"train": X, "valid": X}
+        exp.split_to_y = {"train": y, "valid": y}
+        exp.output_type = "multiclass"
+        exp.train()
+        return sink.step
+
+    return measure(_train, num_runs=1)
+
+
+def benchmark_probes() -> Dict[str, Any]:
+    return {
+        name: _run_benchmark(f"probe {name}", lambda: benchmark_probe(**cfg_kwargs))
+        for name, cfg_kwargs in PROBE_BENCHMARKS.items()
+    }
+
+
+# --- results ---
+
+
+def run_benchmarks(
+    stages: Tuple[str, ...] = ("generators", "embeddings", "probes"),
+    real_synth: bool = False,
+) -> Dict[str, Any]:
+    # one thread, so results do not depend on the number of cores of the machine
+    torch.set_num_threads(1)
+    results = {
+        "commit": get_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "real_synth": real_synth,
+    }
+    if "generators" in stages:
+        results["generators"] = benchmark_generators(real_synth)
+    if "embeddings" in stages:
+        results["embeddings"] = benchmark_embeddings()
+    if "probes" in stages:
+        results["probes"] = benchmark_probes()
+    return results
+
+
+def compare_results(
+    old: Dict[str, Any], new: Dict[str, Any], tolerance: float = REGRESSION_TOLERANCE
+) -> List[Tuple[str, float]]:
+    """The benchmarks run in both results, with the ratio of their new to old throughput.
+
+    Ratios below 1 - tolerance are regressions.
+    """
+    ratios = []
+    for stage in ("generators", "embeddings", "probes"):
+        for name, new_result in new.get(stage, {}).items():
+            old_result = old.get(stage, {}).get(name, {})
+            if not (
+                isinstance(new_result, dict)
+                and new_result.get("items_per_sec")
+                and old_result.get("items_per_sec")
+            ):
+                continue
+            ratios.append(
+                (
+                    f"{stage}/{name}",
+                    new_result["items_per_sec"] / old_result["items_per_sec"],
+                )
+            )
+    return ratios
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=["generators", "embeddings", "probes"],
+        default=["generators", "embeddings", "probes"],
+    )
+    parser.add_argument(
+        "--real_synth",
+        action="store_true",
+        help=f"Use the synth binary at {DEFAULT_SYNTH_BINARY_LOCATION}",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Where to write the results, by default benchmarks/results/<commit>.json",
+    )
+    parser.add_argument(
+        "--compare", type=Path, default=None, help="Results of an earlier run"
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(tuple(args.stages), real_synth=args.real_synth)
+    output = args.output or BENCHMARK_RESULTS_DIR / f"{results['commit'] or 'results'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"Wrote results to {output}")
+
+    if args.compare is not None:
+        old = json.loads(args.compare.read_text())
+        for name, ratio in compare_results(old, results):
+            if ratio < 1 - REGRESSION_TOLERANCE:
+                status = "SLOWER"
+            elif ratio > 1 + REGRESSION_TOLERANCE:
+                status = "faster"
+            else:
+                status = ""
+            print(f"{name}: {ratio:.2f}x {status}")
+
+
+if __name__ == "__main__":
+    main()
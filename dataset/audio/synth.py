@@ -2,8 +2,10 @@ from typing import Optional
 import subprocess
 from pathlib import Path
 from config import DEFAULT_SYNTH_BINARY_LOCATION, DEFAULT_SOUNDFONT_LOCATION
+from instrumentation import timed
 
 
+@timed("synth")
 def produce_synth_wav_from_midi(
     midi_filepath: Path, save_wav_to: Optional[Path] = None, show_logs: bool = True
 ):
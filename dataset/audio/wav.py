@@ -7,7 +7,10 @@ import random
 import ffmpeg
 import librosa
 
+from instrumentation import timed
 
+
+@timed("silence_check")
 def is_wave_silent(file_path: Union[str, Path]) -> bool:
     """Returns true if the wav file at the given path is completely silent.
 
@@ -34,6 +37,7 @@ def get_wav_as_numpy(file_path: Union[str, Path]) -> Tuple[np.ndarray, int]:
     return audio.flatten(), sample_rate
 
 
+@timed("trim")
 def random_trim(
     source_wav_path: Path,
     save_offset_wav_to_path: Path,
@@ -101,6 +105,7 @@ def random_trim(
     return start_time
 
 
+@timed("trim")
 def trim(
     source_wav_path: Path,
     save_offset_wav_to_path: Path,
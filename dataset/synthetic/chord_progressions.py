@@ -13,6 +13,7 @@ from pathlib import Path
 
 from config import OUTPUT_DIR, DEFAULT_SOUNDFONT_LOCATION
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import span
 from dataset.music.transforms import get_chord, get_scale
 from dataset.music.constants import PITCH_CLASS_TO_NOTE_NAME_SHARP, NOTE_NAME_TO_ENHARMONIC
 from dataset.music.midi import (
@@ -204,22 +205,23 @@ def row_processor(
         dataset_path
         / f"{note_name}_{progression_name}_{midi_program_num}_{cleaned_name}.wav"
     )
-    chord_midi = get_progression_by_root_pitch_class(
-        root_note_pitch_class, mode, chord_degrees
-    )
-    midi_file = create_midi_file()
-    midi_track = create_midi_track(
-        # this information doesn't change the sound
-        bpm=120,
-        time_signature=(4, 4),
-        key_root=note_name,
-        track_name=midi_program_name,
-        program=midi_program_num,
-        channel=2,
-    )
-    write_progression(chord_midi, midi_track, channel=2)
-    midi_file.tracks.append(midi_track)
-    midi_file.save(midi_file_path)
+    with span("midi"):
+        chord_midi = get_progression_by_root_pitch_class(
+            root_note_pitch_class, mode, chord_degrees
+        )
+        midi_file = create_midi_file()
+        midi_track = create_midi_track(
+            # this information doesn't change the sound
+            bpm=120,
+            time_signature=(4, 4),
+            key_root=note_name,
+            track_name=midi_program_name,
+            program=midi_program_num,
+            channel=2,
+        )
+        write_progression(chord_midi, midi_track, channel=2)
+        midi_file.tracks.append(midi_track)
+        midi_file.save(midi_file_path)
     produce_synth_wav_from_midi(midi_file_path, synth_file_path)
     is_silent = is_wave_silent(synth_file_path)
 
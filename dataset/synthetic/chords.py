@@ -28,6 +28,7 @@ from dataset.synthetic.midi_instrument import get_instruments
 from dataset.audio.synth import produce_synth_wav_from_midi
 from dataset.audio.wav import is_wave_silent
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import span
 
 _CHORD_MAP = {
     "major": get_major_triad,
@@ -117,20 +118,21 @@ def row_processor(
     #     / f"{note_name}_{chord_type}_{inversion or '5'}.csv"
     # )
 
-    chord_midi = get_chord_midi(root_note_pitch_class, chord_type, inversion)
-    midi_file = create_midi_file()
-    midi_track = create_midi_track(
-        # this information doesn't change the sound
-        bpm=120,
-        time_signature=(4, 4),
-        key_root=note_name,
-        track_name=midi_program_name,
-        program=midi_program_num,
-        channel=2,
-    )
-    write_progression(chord_midi, midi_track, channel=2)
-    midi_file.tracks.append(midi_track)
-    midi_file.save(midi_file_path)
+    with span("midi"):
+        chord_midi = get_chord_midi(root_note_pitch_class, chord_type, inversion)
+        midi_file = create_midi_file()
+        midi_track = create_midi_track(
+            # this information doesn't change the sound
+            bpm=120,
+            time_signature=(4, 4),
+            key_root=note_name,
+            track_name=midi_program_name,
+            program=midi_program_num,
+            channel=2,
+        )
+        write_progression(chord_midi, midi_track, channel=2)
+        midi_file.tracks.append(midi_track)
+        midi_file.save(midi_file_path)
     produce_synth_wav_from_midi(midi_file_path, synth_file_path)
 
     # # create rows of text prompts
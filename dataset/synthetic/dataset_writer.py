@@ -3,15 +3,33 @@ from contextlib import nullcontext
 import tempfile
 import multiprocessing
 from functools import partial
-from typing import Iterator, Dict, Any, Callable, Tuple, List
+from typing import Iterator, Dict, Any, Callable, Tuple, List, Optional
 from pathlib import Path
 import shutil
 import pandas as pd
 from util import use_770_permissions
+from instrumentation import span, count, emit, get_recorder
 
 DatasetRowDescription = Tuple[int, Dict[str, Any]]
 
 
+def _instrumented_row_processor(
+    row_processor: Callable[[Path, DatasetRowDescription], List[DatasetRowDescription]],
+    dataset_path: Path,
+    row: DatasetRowDescription,
+) -> Tuple[List[DatasetRowDescription], Optional[Dict[str, Any]]]:
+    with span("dataset_writer.row"):
+        rows = row_processor(dataset_path, row)
+    # the timings recorded in a worker process are handed back to the writer with its rows
+    return rows, get_recorder().drain()
+
+
+def _init_worker() -> None:
+    # a forked worker starts with a copy of the recording of the writer, which must not be
+    # handed back a second time
+    get_recorder().reset()
+
+
 class DatasetWriter:
     """A helper class that handles the creation of SynTheory datasets."""
 
@@ -90,6 +108,14 @@ class DatasetWriter:
         try:
             tmp_dir = tempfile.mkdtemp()
             result_df = self._create_dataset_inner_loop(Path(tmp_dir))
+            # where the time of this dataset went, summed over the worker processes
+            emit(
+                "dataset_writer",
+                dataset_name=self.dataset_name,
+                status="done",
+                num_samples=result_df.shape[0],
+                max_processes=self.max_processes,
+            )
 
             if not self.dataset_path.exists():
                 self.dataset_path.mkdir(parents=True)
@@ -111,6 +137,12 @@ class DatasetWriter:
 
         except Exception as e:
             # the row processor or something it called raise an exception
+            emit(
+                "dataset_writer",
+                dataset_name=self.dataset_name,
+                status="failed",
+                max_processes=self.max_processes,
+            )
             raise e
         finally:
             # if some exception was caught, then we should delete the temporary directory
@@ -119,13 +151,26 @@ class DatasetWriter:
 
     def _create_dataset_inner_loop(self, tmp_output_path: Path) -> pd.DataFrame:
         # lambda functions cannot be pickled
-        row_processor_func = partial(self.row_processor, tmp_output_path)
+        row_processor_func = partial(
+            _instrumented_row_processor, self.row_processor, tmp_output_path
+        )
+        recorder = get_recorder()
 
         with self._file_permission_ctx():
             rows = []
-            with multiprocessing.Pool(self.max_processes) as pool:
-                # gather the rows
-                for row_set in pool.imap(row_processor_func, self.row_iterator):
+            with multiprocessing.Pool(self.max_processes, initializer=_init_worker) as pool:
+                results = pool.imap(row_processor_func, self.row_iterator)
+                while True:
+                    # time spent waiting on the workers for the next row
+                    with span("dataset_writer.dispatch"):
+                        result = next(results, None)
+                    if result is None:
+                        break
+                    row_set, worker_recording = result
+                    recorder.merge(worker_recording)
+                    count("dataset_writer.samples", len(row_set))
+
+                    # gather the rows
                     # we could also just have the row ID be a property of the object returned, but
                     # we do it this way to draw attention to the ordering from the implementer
                     for row in row_set:
@@ -139,6 +184,7 @@ class DatasetWriter:
             df = df.sort_values(by=["row_id"])
 
             # save to disk
-            df.to_csv(tmp_output_path / self.info_csv_filepath.parts[-1], index=False)
+            with span("dataset_writer.csv_write"):
+                df.to_csv(tmp_output_path / self.info_csv_filepath.parts[-1], index=False)
 
             return df
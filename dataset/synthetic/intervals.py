@@ -14,6 +14,7 @@ from dataset.synthetic.midi_instrument import get_instruments
 from dataset.audio.synth import produce_synth_wav_from_midi
 from dataset.audio.wav import is_wave_silent
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import span
 
 _PLAY_STYLE = {
     0: "UP",
@@ -163,25 +164,26 @@ def row_processor(
         / f"{note_name}_{midi_interval_val}_{play_style_name}_{midi_program_num}_{cleaned_name}.wav"
     )
 
-    midi_file = create_midi_file()
-    midi_track = create_midi_track(
-        # this information doesn't change the sound
-        bpm=120,
-        time_signature=(4, 4),
-        key_root=note_name,
-        track_name=midi_program_name,
-        program=midi_program_num,
-        channel=2,
-    )
-    write_interval_midi(
-        midi_base_note,
-        midi_interval_val,
-        play_style,
-        midi_track,
-        channel=2,
-    )
-    midi_file.tracks.append(midi_track)
-    midi_file.save(midi_file_path)
+    with span("midi"):
+        midi_file = create_midi_file()
+        midi_track = create_midi_track(
+            # this information doesn't change the sound
+            bpm=120,
+            time_signature=(4, 4),
+            key_root=note_name,
+            track_name=midi_program_name,
+            program=midi_program_num,
+            channel=2,
+        )
+        write_interval_midi(
+            midi_base_note,
+            midi_interval_val,
+            play_style,
+            midi_track,
+            channel=2,
+        )
+        midi_file.tracks.append(midi_track)
+        midi_file.save(midi_file_path)
     produce_synth_wav_from_midi(midi_file_path, synth_file_path)
 
     # record this row in the csv
@@ -16,6 +16,7 @@ from dataset.synthetic.midi_instrument import get_instruments
 from dataset.audio.synth import produce_synth_wav_from_midi
 from dataset.audio.wav import is_wave_silent
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import span
 
 import csv
 import string
@@ -163,20 +164,21 @@ def row_processor(
         / f"{midi_note_val}_{register}_{note_name}_{midi_program_num}_{cleaned_name}.wav"
     )
 
-    note_midi = get_note_midi(midi_note_val)
-    midi_file = create_midi_file()
-    midi_track = create_midi_track(
-        # this information doesn't change the sound
-        bpm=120,
-        time_signature=(4, 4),
-        key_root=note_name,
-        track_name=midi_program_name,
-        program=midi_program_num,
-        channel=2,
-    )
-    write_melody(note_midi, midi_track, channel=2)
-    midi_file.tracks.append(midi_track)
-    midi_file.save(midi_file_path)
+    with span("midi"):
+        note_midi = get_note_midi(midi_note_val)
+        midi_file = create_midi_file()
+        midi_track = create_midi_track(
+            # this information doesn't change the sound
+            bpm=120,
+            time_signature=(4, 4),
+            key_root=note_name,
+            track_name=midi_program_name,
+            program=midi_program_num,
+            channel=2,
+        )
+        write_melody(note_midi, midi_track, channel=2)
+        midi_file.tracks.append(midi_track)
+        midi_file.save(midi_file_path)
     produce_synth_wav_from_midi(midi_file_path, synth_file_path)
 
     octave = midi_note_val // 12
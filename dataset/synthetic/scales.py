@@ -12,6 +12,7 @@ from dataset.music.midi import (
 )
 from dataset.synthetic.midi_instrument import get_instruments
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import span
 from dataset.audio.synth import produce_synth_wav_from_midi
 from dataset.audio.wav import is_wave_silent
 
@@ -160,20 +161,21 @@ def row_processor(
         / f"{root_note}_{mode}_{play_style_name}_{midi_program_num}_{cleaned_name}.wav"
     )
 
-    scale_midi = get_scale_midi(root_note, mode, play_style)
-    midi_file = create_midi_file()
-    midi_track = create_midi_track(
-        # this information doesn't change the sound
-        bpm=120,
-        time_signature=(4, 4),
-        key_root=root_note,
-        track_name=midi_program_name,
-        program=midi_program_num,
-        channel=2,
-    )
-    write_melody(scale_midi, midi_track, channel=2)
-    midi_file.tracks.append(midi_track)
-    midi_file.save(midi_file_path)
+    with span("midi"):
+        scale_midi = get_scale_midi(root_note, mode, play_style)
+        midi_file = create_midi_file()
+        midi_track = create_midi_track(
+            # this information doesn't change the sound
+            bpm=120,
+            time_signature=(4, 4),
+            key_root=root_note,
+            track_name=midi_program_name,
+            program=midi_program_num,
+            channel=2,
+        )
+        write_melody(scale_midi, midi_track, channel=2)
+        midi_file.tracks.append(midi_track)
+        midi_file.save(midi_file_path)
     produce_synth_wav_from_midi(midi_file_path, synth_file_path)
     is_silent = is_wave_silent(synth_file_path)
 
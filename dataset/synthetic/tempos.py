@@ -9,6 +9,7 @@ from dataset.audio.wav import random_trim, is_wave_silent, trim
 from dataset.music.track import create_click_track_midi
 from dataset.synthetic.metronome_configs import CLICK_CONFIGS
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import span
 
 
 def get_all_tempos(slowest: int, fastest: int) -> Iterator[int]:
@@ -27,18 +28,19 @@ def create_midi_and_synth(
     dataset_path: Path, bpm: int, config: ClickTrackConfig
 ) -> Tuple[Path, Path]:
     # get soundfont information
-    midi_file = create_click_track_midi(
-        bpm,
-        # ~ approximately 20 seconds but not exactly, we over-shoot it
-        # so that we have space to move around after the wav is created
-        num_beats=bpm // 3,
-        midi_file=None,
-        time_signature=(4, 4),
-        config=config,
-    )
+    with span("midi"):
+        midi_file = create_click_track_midi(
+            bpm,
+            # ~ approximately 20 seconds but not exactly, we over-shoot it
+            # so that we have space to move around after the wav is created
+            num_beats=bpm // 3,
+            midi_file=None,
+            time_signature=(4, 4),
+            config=config,
+        )
 
-    midi_file_path = dataset_path / f"{bpm}_bpm_{config.name}.mid"
-    midi_file.save(midi_file_path)
+        midi_file_path = dataset_path / f"{bpm}_bpm_{config.name}.mid"
+        midi_file.save(midi_file_path)
 
     synth_file_path = dataset_path / f"{bpm}_bpm_{config.name}.wav"
 
@@ -9,6 +9,7 @@ from dataset.music.track import create_click_track_midi
 from dataset.music.midi import is_compound_time_signature
 from dataset.synthetic.metronome_configs import CLICK_CONFIGS
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import span
 
 _NUMBERS_TO_WORDS = {
     2: "two",
@@ -78,28 +79,29 @@ def row_processor(
     midi_program_num = config.midi_program_num
 
     # play approx 30 seconds of audio
-    total_beats_to_play = int((time_signature[1] / 4) * (bpm // 2))
-    midi_file = create_click_track_midi(
-        bpm,
-        # ~ approximately 20 seconds but not exactly, we over-shoot it
-        # so that we have space to move around after the wav is created
-        total_beats_to_play,
-        midi_file=None,
-        time_signature=time_signature,
-        config=config,
-        reverb_level=reverb_level,
-    )
+    with span("midi"):
+        total_beats_to_play = int((time_signature[1] / 4) * (bpm // 2))
+        midi_file = create_click_track_midi(
+            bpm,
+            # ~ approximately 20 seconds but not exactly, we over-shoot it
+            # so that we have space to move around after the wav is created
+            total_beats_to_play,
+            midi_file=None,
+            time_signature=time_signature,
+            config=config,
+            reverb_level=reverb_level,
+        )
 
-    time_signature_readable_name = str(time_signature)[1:-1].replace(", ", "_")
-    midi_file_path = (
-        dataset_path
-        / f"{time_signature_readable_name}_{bpm}_bpm_{config.name}_reverb_level_{reverb_level}.mid"
-    )
-    synth_file_path = (
-        dataset_path
-        / f"{time_signature_readable_name}_{bpm}_bpm_{config.name}_reverb_level_{reverb_level}.wav"
-    )
-    midi_file.save(midi_file_path)
+        time_signature_readable_name = str(time_signature)[1:-1].replace(", ", "_")
+        midi_file_path = (
+            dataset_path
+            / f"{time_signature_readable_name}_{bpm}_bpm_{config.name}_reverb_level_{reverb_level}.mid"
+        )
+        synth_file_path = (
+            dataset_path
+            / f"{time_signature_readable_name}_{bpm}_bpm_{config.name}_reverb_level_{reverb_level}.wav"
+        )
+        midi_file.save(midi_file_path)
 
     # play the MIDI, realizing it to a waveform
     produce_synth_wav_from_midi(midi_file_path, synth_file_path, show_logs=True)
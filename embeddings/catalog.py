@@ -0,0 +1,196 @@
+import os
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import zarr
+
+# one catalog per dataset folder, next to the zarr files it lists
+CATALOG_FILENAME = "embeddings_catalog.json"
+
+
+def get_model_type_and_size(model_name: str) -> Tuple[str, str]:
+    """The model type and size [S | M | L] probes refer to, given the model_name of a config."""
+    if model_name == "JUKEBOX":
+        return "JUKEBOX", "L"
+    elif "MUSICGEN_DECODER" in model_name:
+        return "MUSICGEN_DECODER", model_name.split("_LM_")[-1]
+    elif "MUSICGEN_AUDIO_ENCODER" in model_name:
+        return "MUSICGEN_AUDIO_ENCODER", "L"
+    elif "MUSICGEN_TEXT_ENCODER" in model_name:
+        return "MUSICGEN_TEXT_ENCODER", "L"
+    elif "BERT" in model_name:
+        return "BERT", "L"
+    # handcrafted features, default to L
+    return model_name, "L"
+
+
+def normalize_model_type(model_type: str) -> str:
+    # in some configs we neglected the "LM" suffix. Consider
+    # "MUSICGEN_DECODER_LM" to be equal to "MUSICGEN_DECODER"
+    if model_type.startswith("MUSICGEN_DECODER"):
+        return model_type.split("_LM")[0]
+    return model_type
+
+
+class EmbeddingsCatalog:
+    """Index of the embeddings extracted for a dataset, by model type and size.
+
+    Each entry describes one zarr array: the model that produced it, its shape and dtype.
+    Extraction adds an entry when it creates an array, so finding the embeddings of a model
+    reads one small JSON file and opens no arrays. Zarr files in the dataset folder that are
+    missing from the catalog, e.g. extracted before it existed, are added the first time the
+    catalog is loaded.
+    """
+
+    def __init__(self, dataset_folder: Union[str, Path], entries: List[Dict[str, Any]]) -> None:
+        self.dataset_folder = Path(dataset_folder)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._index: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        for entry in entries:
+            self.add(entry)
+
+    @property
+    def path(self) -> Path:
+        return self.dataset_folder / CATALOG_FILENAME
+
+    @classmethod
+    def load(cls, dataset_folder: Union[str, Path]) -> "EmbeddingsCatalog":
+        dataset_folder = Path(dataset_folder)
+        catalog_path = dataset_folder / CATALOG_FILENAME
+        entries = []
+        if catalog_path.is_file():
+            entries = json.loads(catalog_path.read_text())["entries"]
+        catalog = cls(dataset_folder, [cls._from_json(dataset_folder, e) for e in entries])
+
+        # listing the folder is cheap, reading the settings and shapes of arrays is not
+        missing = [
+            z
+            for z in sorted(dataset_folder.glob("*.zarr"))
+            if z.name not in catalog.entries
+        ]
+        if missing:
+            for z in missing:
+                entry = cls._scan(dataset_folder, z)
+                if entry is not None:
+                    catalog.add(entry)
+            try:
+                catalog.save()
+            except OSError:
+                # the dataset folder may be read only, the catalog is still correct
+                pass
+        return catalog
+
+    @staticmethod
+    def _scan(dataset_folder: Path, zarr_filepath: Path) -> Optional[Dict[str, Any]]:
+        dataset_name = dataset_folder.name
+        if not zarr_filepath.name.startswith(dataset_name):
+            # expect embeddings arrays to be prefixed with the dataset name
+            return None
+
+        # get the settings associated with the model that produced these embeddings
+        model_hash = zarr_filepath.name.split(".zarr")[0].split("_")[-1]
+        model_settings_path = dataset_folder / f"{dataset_name}_{model_hash}.json"
+        if not model_settings_path.is_file():
+            return None
+        model_settings = json.loads(model_settings_path.read_text())
+        emb = zarr.open(str(zarr_filepath), mode="r")
+        return make_catalog_entry(zarr_filepath, model_hash, model_settings, emb.shape, emb.dtype)
+
+    @staticmethod
+    def _from_json(dataset_folder: Path, entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            **entry,
+            "zarr_filepath": dataset_folder / entry["zarr_filepath"],
+            "embeddings_dataset_shape": tuple(entry["embeddings_dataset_shape"]),
+        }
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        """Add the entry of a zarr array, replacing an earlier entry of the same array."""
+        name = Path(entry["zarr_filepath"]).name
+        if name in self.entries:
+            key = self._key(self.entries[name])
+            self._index[key] = [e for e in self._index[key] if e is not self.entries[name]]
+        entry = {**entry, "zarr_filepath": self.dataset_folder / name}
+        self.entries[name] = entry
+        self._index.setdefault(self._key(entry), []).append(entry)
+
+    @staticmethod
+    def _key(entry: Dict[str, Any]) -> Tuple[str, str]:
+        return normalize_model_type(entry["model_type"]), entry["model_size"]
+
+    def save(self) -> None:
+        entries = [
+            {
+                **entry,
+                # relative, so the dataset folder can be moved
+                "zarr_filepath": entry["zarr_filepath"].name,
+                "embeddings_dataset_shape": list(entry["embeddings_dataset_shape"]),
+            }
+            for entry in self.entries.values()
+        ]
+        # write to a temporary name and move it into place, so that concurrent readers
+        # never see a partially written catalog
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"entries": entries}, indent=2))
+        os.replace(tmp_path, self.path)
+
+    def find(
+        self,
+        model_type: str,
+        model_size: str,
+        model_layer: Optional[Union[int, str]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """The entry of the embeddings of a model that have the given layer, if any.
+
+        model_layer "all" requires embeddings with a layer axis, None matches any entry.
+        """
+        match = None
+        for entry in self._index.get((normalize_model_type(model_type), model_size), []):
+            # shape is (all samples, layer, embedding dimension)
+            shape = entry["embeddings_dataset_shape"]
+            if (
+                model_layer is None
+                or (len(shape) == 3 if model_layer == "all" else shape[1] > model_layer)
+            ):
+                match = entry
+        return match
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self.entries.values())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def make_catalog_entry(
+    zarr_filepath: Union[str, Path],
+    model_hash: str,
+    model_settings: Dict[str, Any],
+    shape: Tuple[int, ...],
+    dtype: Any,
+) -> Dict[str, Any]:
+    model_type, model_size = get_model_type_and_size(model_settings["model_name"])
+    return {
+        "zarr_filepath": Path(zarr_filepath),
+        "embeddings_dataset_shape": tuple(shape),
+        "dtype": str(dtype),
+        "model_hash": model_hash,
+        "model_settings": model_settings,
+        "model_size": model_size,
+        "model_type": model_type,
+    }
+
+
+def register_embeddings(
+    dataset_folder: Union[str, Path],
+    zarr_filepath: Union[str, Path],
+    model_hash: str,
+    model_settings: Dict[str, Any],
+    shape: Tuple[int, ...],
+    dtype: Any,
+) -> None:
+    """Add a newly created zarr array to the catalog of its dataset."""
+    catalog = EmbeddingsCatalog.load(dataset_folder)
+    catalog.add(make_catalog_entry(zarr_filepath, model_hash, model_settings, shape, dtype))
+    catalog.save()
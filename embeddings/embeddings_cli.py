@@ -1,17 +1,31 @@
 import argparse
 from util import use_770_permissions
-from embeddings.extract_embeddings import extract_shard
+from embeddings.extract_embeddings import extract_shard, extract_from_work_queue
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset_folder_name", type=str, required=True)
-    parser.add_argument("--dataset_shard", type=int, required=True)
+    parser.add_argument("--dataset_shard", type=int, default=None)
+    parser.add_argument(
+        "--work_queue",
+        action="store_true",
+        help="Lease ranges of samples from the work queue of the dataset instead of extracting a fixed shard",
+    )
     parser.add_argument("--model_config_checksum", type=str, required=True)
     args = parser.parse_args()
 
+    if args.work_queue == (args.dataset_shard is not None):
+        parser.error("pass exactly one of --dataset_shard and --work_queue")
+
     with use_770_permissions():
-        extract_shard(
-            args.dataset_folder_name,
-            int(args.dataset_shard),
-            args.model_config_checksum,
-        )
+        if args.work_queue:
+            extract_from_work_queue(
+                args.dataset_folder_name,
+                args.model_config_checksum,
+            )
+        else:
+            extract_shard(
+                args.dataset_folder_name,
+                int(args.dataset_shard),
+                args.model_config_checksum,
+            )
@@ -0,0 +1,162 @@
+import os
+import argparse
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+import zarr
+
+from util import use_770_permissions
+from config import OUTPUT_DIR, load_config
+
+# probes train in float32, store exports in that precision so loading requires no cast
+EXPORT_DTYPE = np.float32
+
+
+def get_exported_embeddings_path(
+    zarr_filepath: Union[str, Path], model_layer: Optional[int] = None
+) -> Path:
+    """Location of the uncompressed .npy export of a zarr embeddings array.
+
+    Exports live next to the zarr they were created from. Embeddings with a layer axis
+    are exported one file per layer, handcrafted features (no layer axis) to a single file.
+    """
+    zarr_filepath = Path(zarr_filepath)
+    stem = zarr_filepath.name.split(".zarr")[0]
+    if model_layer is None:
+        return zarr_filepath.parent / f"{stem}.npy"
+    return zarr_filepath.parent / f"{stem}_layer_{model_layer}.npy"
+
+
+def is_export_up_to_date(zarr_filepath: Union[str, Path], export_path: Path) -> bool:
+    """Whether the export exists and was written after the zarr was last modified.
+
+    Writing a chunk replaces a file in the zarr folder, which updates the mtime of the folder,
+    so an export of a zarr that was extracted again is older than the zarr.
+    """
+    return (
+        export_path.is_file()
+        and export_path.stat().st_mtime_ns >= Path(zarr_filepath).stat().st_mtime_ns
+    )
+
+
+def export_zarr_to_npy(
+    zarr_filepath: Union[str, Path],
+    layers: Optional[Iterable[int]] = None,
+    chunk_size: Optional[int] = None,
+    overwrite: bool = False,
+) -> List[Path]:
+    """Write each (model, layer) slice of a zarr embeddings array to an uncompressed float32 .npy.
+
+    The zarr is read once, chunk by chunk along the sample axis, and every requested layer is
+    written from the same chunk so that this never holds more than one chunk in memory. Files
+    are written to a temporary name and moved into place, so a reader never sees a partial export.
+
+    Args:
+        zarr_filepath: The zarr array of embeddings, of shape (n, layers, dim) or (n, dim).
+        layers: The layers to export. By default, all layers are exported.
+        chunk_size: Number of samples to read from the zarr at a time. Defaults to the zarr chunking.
+        overwrite: If false, layers whose export is newer than the zarr are skipped.
+
+    Returns: The paths of the exported .npy files.
+    """
+    data = zarr.open(str(zarr_filepath), mode="r")
+    is_foundation_model_layers = len(data.shape) == 3
+
+    if is_foundation_model_layers:
+        layers = list(range(data.shape[1])) if layers is None else list(layers)
+        export_paths = {
+            layer: get_exported_embeddings_path(zarr_filepath, layer) for layer in layers
+        }
+        export_shape = (data.shape[0], data.shape[2])
+    else:
+        # handcrafted features have no layer axis
+        export_paths = {None: get_exported_embeddings_path(zarr_filepath)}
+        export_shape = data.shape
+
+    if not overwrite:
+        export_paths = {
+            k: v
+            for k, v in export_paths.items()
+            if not is_export_up_to_date(zarr_filepath, v)
+        }
+
+    if not export_paths:
+        # nothing to do
+        return []
+
+    chunk_size = chunk_size or data.chunks[0]
+    tmp_paths = {k: v.with_name(v.name + ".tmp") for k, v in export_paths.items()}
+    memmaps = {
+        k: np.lib.format.open_memmap(
+            str(tmp_path), mode="w+", dtype=EXPORT_DTYPE, shape=export_shape
+        )
+        for k, tmp_path in tmp_paths.items()
+    }
+
+    try:
+        for start in range(0, data.shape[0], chunk_size):
+            end = min(start + chunk_size, data.shape[0])
+            chunk = data[start:end]
+            for layer, mm in memmaps.items():
+                if layer is None:
+                    mm[start:end] = chunk
+                else:
+                    mm[start:end] = chunk[:, layer, :]
+
+        for mm in memmaps.values():
+            mm.flush()
+    except Exception:
+        for tmp_path in tmp_paths.values():
+            tmp_path.unlink(missing_ok=True)
+        raise
+    finally:
+        # release the file handles before moving the files
+        del memmaps
+
+    for layer, export_path in export_paths.items():
+        os.replace(tmp_paths[layer], export_path)
+
+    return list(export_paths.values())
+
+
+def load_exported_embeddings(
+    zarr_filepath: Union[str, Path], model_layer: Optional[int] = None
+) -> Optional[np.ndarray]:
+    """Memory map the .npy export of a zarr embeddings array, if it exists.
+
+    The file is mapped read-only, so concurrent probe jobs on the same node share the
+    page cache instead of each decompressing their own copy. An export that is older than
+    the zarr holds the embeddings of a previous extraction and is ignored.
+
+    Returns: The (n, dim) memory-mapped array, or None if no up to date export exists.
+    """
+    export_path = get_exported_embeddings_path(zarr_filepath, model_layer)
+    if not is_export_up_to_date(zarr_filepath, export_path):
+        return None
+    return np.load(export_path, mmap_mode="r")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="Path to the YAML config file")
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    concepts = config['concepts']
+    models = config['models']
+
+    with use_770_permissions():
+        for concept in concepts:
+            dataset_folder = OUTPUT_DIR / concept
+            for model_name in models:
+                # zarr files are named: <concept>_<model name>_<model config checksum>.zarr
+                for zarr_filepath in dataset_folder.glob(f"{concept}_{model_name}_*.zarr"):
+                    print(f"Exporting {zarr_filepath.name}")
+                    written = export_zarr_to_npy(zarr_filepath, overwrite=args.overwrite)
+                    print(f"Wrote {len(written)} export(s) for {concept} - {model_name}")
+
+
+if __name__ == "__main__":
+    main()
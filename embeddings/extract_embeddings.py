@@ -1,5 +1,4 @@
 import argparse
-import datetime
 import time
 from typing import NamedTuple, Dict, Any, List, Optional, Tuple
 import json
@@ -12,20 +11,43 @@ import numpy as np
 from transformers import MusicgenForConditionalGeneration, AutoProcessor
 import torchaudio
 import zarr
+from zarr.util import guess_chunks
 
 from util import use_770_permissions
+from instrumentation import span, count, emit
 from config import OUTPUT_DIR, load_config
+from embeddings.catalog import register_embeddings
 from embeddings.config_checksum import compute_checksum
-from embeddings.models import audio_file_to_embedding_np_array, Model, load_musicgen_model, text_prompt_to_embedding_np_array
+from embeddings.shard_progress import (
+    DEAD,
+    DONE,
+    FAILED,
+    RUNNING,
+    ShardHeartbeat,
+    get_shard_state,
+    read_heartbeat,
+)
+from embeddings.work_queue import (
+    LEASED,
+    PENDING,
+    WORK_QUEUE_LEASE_SEC,
+    WORK_QUEUE_LEASE_SIZE,
+    WorkQueue,
+    get_work_queue_path,
+    get_worker_id,
+)
+from embeddings.models import audio_file_to_embedding_np_array, Model, get_embedding_shape, load_musicgen_model, text_prompt_to_embedding_np_array
 
 import ast
 
+# the columns of the embeddings info csv that extraction needs, the manifest of a shard has only these
+MANIFEST_COLUMNS = ["zarr_idx", "dataset_shard", "audio_file_path", "text_prompt"]
+
 class ShardStatus(Enum):
     DONE = 1
     FAIL = 2
     IN_PROGRESS = 3
-
-JOB_HOURS_FAILURE_THRESHOLD = 6
+    NOT_STARTED = 4
 
 SLURM_JOB_BASE = r"""
 #!/bin/bash
@@ -45,7 +67,7 @@ conda activate {conda_env_name}
 {model_config_str}
 
 # Run the script
-python embeddings/embeddings_cli.py --dataset_folder_name {dataset_folder_name} --dataset_shard {dataset_shard} --model_config_checksum {hash}
+python embeddings/embeddings_cli.py --dataset_folder_name {dataset_folder_name} {shard_args} --model_config_checksum {hash}
 """
 
 
@@ -123,6 +145,14 @@ class DatasetEmbeddingInformation:
             )
         )
 
+        self.work_queue_path = get_work_queue_path(self.dataset_folder, self.model_config_checksum)
+        self.manifest_folder = self.dataset_folder / (
+            "{0}_{1}_manifests".format(
+                self.dataset_name,
+                self.model_config_checksum,
+            )
+        )
+
         self.model_config_json_path = self.dataset_folder / (
             "{0}_{1}.json".format(
                 self.dataset_name,
@@ -167,15 +197,8 @@ class DatasetEmbeddingInformation:
         # checks passed, return yes it is valid
         return zarr_file
 
-    def get_or_create_zarr_file(self) -> zarr:
-        zarr_file = self.load_zarr_file()
-
-        if zarr_file is not None:
-            # nothing to do 
-            return zarr_file
-
+    def _get_embedding_shape_from_first_sample(self, model_type: Model) -> Tuple[int, ...]:
         # load model
-        model_type = Model[self.model_config["model_type"]]
         if model_type in {
             Model.MUSICGEN_AUDIO_ENCODER,
             Model.MUSICGEN_DECODER_LM_S,
@@ -205,7 +228,6 @@ class DatasetEmbeddingInformation:
             )
         # TODO: make sure it's possible to do both eventually
         elif "audio" in self.conds:
-            # embeddings file does not yet exist, initialize it to all zeros
             audio_filepath = get_audio_file_path_from_sample_info(first_sample)
 
             # do only 1 extraction just to get the dimensions
@@ -215,8 +237,27 @@ class DatasetEmbeddingInformation:
                 processor,
                 model,
             )
-        
-        embeddings_shape = embedding.shape
+
+        return embedding.shape
+
+    def get_or_create_zarr_file(self) -> zarr:
+        zarr_file = self.load_zarr_file()
+
+        if zarr_file is not None:
+            # nothing to do 
+            return zarr_file
+
+        # the shape follows from the model and its settings, without loading it
+        model_type = Model[self.model_config["model_type"]]
+        embeddings_shape = get_embedding_shape(
+            model_type,
+            extract_from_layer=self.model_config.get("extract_from_layer", None),
+            decoder_hidden_states=self.model_config.get("decoder_hidden_states", True),
+            meanpool=self.model_config.get("meanpool", True),
+        )
+        if embeddings_shape is None:
+            # depends on the length of the input, extract the first sample to find out
+            embeddings_shape = self._get_embedding_shape_from_first_sample(model_type)
 
         print(f"initial extraction shape: {embeddings_shape}")
 
@@ -227,27 +268,33 @@ class DatasetEmbeddingInformation:
         # gets shard sizes based on number of samples
         shard_sizes = self._get_shard_sizes()
 
-        # create the first shard
-        first_shard_zeros = np.zeros((shard_sizes[0],) + embeddings_shape)
-
-        # need a single shard so we can save it
-        zarr.save(str(self.zarr_file_path.absolute()), first_shard_zeros)
+        # probes train in float32 so there is no need to store more. No chunk is written here,
+        # chunks that were never written read as the fill value, and all zeros means the sample
+        # has not been extracted yet. Chunked as if the first shard were saved on its own, like
+        # the arrays created before
         zarr_file = zarr.open(
             str(self.zarr_file_path.absolute()),
-            mode="a",
+            mode="w",
+            shape=(self.num_total_samples, *embeddings_shape),
+            chunks=guess_chunks((shard_sizes[0], *embeddings_shape), np.dtype(np.float32).itemsize),
+            dtype=np.float32,
+            fill_value=0.0,
             synchronizer=zarr_file_sync,
         )
 
-        # append each shard to the zarr file. We do this instead of allocating it all 
-        # at once because the zero array might not fit in memory
-        for shard_size in shard_sizes[1:]:
-            if shard_size != first_shard_zeros.shape[0]:
-                first_shard_zeros = np.zeros((shard_size,) + embeddings_shape)
-            zarr_file.append(first_shard_zeros)
-
         # check that the zarr file dimension is correct
         assert zarr_file.shape == (self.num_total_samples, *embeddings_shape)
 
+        # list the new array, so probes find it without opening every zarr of the dataset
+        register_embeddings(
+            self.dataset_folder,
+            self.zarr_file_path,
+            self.model_config_checksum,
+            self.model_config,
+            zarr_file.shape,
+            zarr_file.dtype,
+        )
+
         return zarr_file
 
     def make_status_folder(self) -> None:
@@ -268,26 +315,21 @@ class DatasetEmbeddingInformation:
                 "There is a mismatch between the reported number of shards on disk and the number of shards we need."
             )
 
+        # one status per shard, in order of the shards
         shard_statuses = []
         for i in range(total_shards):
             shard_status_file = self.status_folder / f"{i}.txt"
-            if not shard_status_file.exists():
-                # does not exist yet
-                continue
-
-            shard_status = shard_status_file.read_text()
-            if shard_status == "done":
+            shard_status = shard_status_file.read_text() if shard_status_file.exists() else None
+            # a shard that is in progress has failed if its heartbeats stopped, see shard_progress
+            state = get_shard_state(shard_status, read_heartbeat(self.status_folder, i))
+            if state == DONE:
                 shard_statuses.append(ShardStatus.DONE)
-            elif shard_status.startswith("failed"):
+            elif state in (FAILED, DEAD):
                 shard_statuses.append(ShardStatus.FAIL)
-            elif shard_status.startswith("in progress"):
-                started_at_ts = int(shard_status.splitlines()[1])
-                started_at_dt = datetime.utcfromtimestamp(started_at_ts)
-                current_time = datetime.utcnow()
-                diff_in_seconds = (current_time - started_at_dt).total_seconds()
-                diff_in_hours = diff_in_seconds / 3600
-                did_fail = diff_in_hours < JOB_HOURS_FAILURE_THRESHOLD
-                shard_statuses.append(ShardStatus.FAIL if did_fail else ShardStatus.IN_PROGRESS)
+            elif state == RUNNING:
+                shard_statuses.append(ShardStatus.IN_PROGRESS)
+            else:
+                shard_statuses.append(ShardStatus.NOT_STARTED)
 
         return shard_statuses
 
@@ -312,7 +354,13 @@ class DatasetEmbeddingInformation:
                 all_shard_script_paths.append(tmp_file)
         return all_shard_script_paths
     
-    def write_shard_runner_scripts_and_embedding_info_csv(self, conda_env_name: str, slurm_partition: str) -> List[Path]:
+    def write_shard_runner_scripts_and_embedding_info_csv(
+        self, conda_env_name: str, slurm_partition: str, write_shard_scripts: bool = True
+    ) -> List[Path]:
+        """Writes the embeddings info csv and a manifest per shard, returns the script of each shard.
+
+        Work queue workers do not run shards, pass write_shard_scripts=False to skip the scripts.
+        """
         # if embeddings already exist
         if self.embeddings_info_file.is_file():
             raise RuntimeError(
@@ -322,6 +370,7 @@ class DatasetEmbeddingInformation:
         row_data = []
         slurm_files = []
         shard_idx = -1
+        self.manifest_folder.mkdir(exist_ok=True)
 
         # loop through shards
         for sample_idx in range(0, self.num_total_samples, self.max_samples_per_shard):
@@ -329,20 +378,22 @@ class DatasetEmbeddingInformation:
             shard_idx += 1
 
             # write the script that will populate this shard
-            json_str = json.dumps(self.model_config, indent=4)
-            json_comment = "\n".join(f"# {x}" for x in json_str.splitlines())
-            script_contents = SLURM_JOB_BASE.format(
-                slurm_partition=slurm_partition,
-                hash=self.model_config_checksum,
-                dataset_folder_name=self.dataset_name,
-                dataset_shard=shard_idx,
-                conda_env_name=conda_env_name,
-                model_config_str=json_comment,
-            ).strip()
-
-            tmp_file = self.dataset_folder / f"tmp_slurm_{self.model_config_checksum}_{shard_idx}.sh"
-            tmp_file.write_text(script_contents)
-            slurm_files.append(tmp_file)
+            if write_shard_scripts:
+                json_str = json.dumps(self.model_config, indent=4)
+                json_comment = "\n".join(f"# {x}" for x in json_str.splitlines())
+                script_contents = SLURM_JOB_BASE.format(
+                    slurm_partition=slurm_partition,
+                    hash=self.model_config_checksum,
+                    dataset_folder_name=self.dataset_name,
+                    dataset_shard=shard_idx,
+                    shard_args=f"--dataset_shard {shard_idx}",
+                    conda_env_name=conda_env_name,
+                    model_config_str=json_comment,
+                ).strip()
+
+                tmp_file = self.dataset_folder / f"tmp_slurm_{self.model_config_checksum}_{shard_idx}.sh"
+                tmp_file.write_text(script_contents)
+                slurm_files.append(tmp_file)
 
             # write a row for all the samples in this shard
             t_sample_info: NamedTuple
@@ -390,11 +441,67 @@ class DatasetEmbeddingInformation:
                     }
                     row_data.append(row)
 
+            # the rows of this shard, with only the columns extraction needs
+            shard_rows = row_data[sample_idx:]
+            pd.DataFrame(
+                [{k: row[k] for k in MANIFEST_COLUMNS if k in row} for row in shard_rows]
+            ).to_csv(self.get_shard_manifest_path(shard_idx), index=False)
+
         embedding_info_df = pd.json_normalize(row_data)
         embedding_info_df.to_csv(self.embeddings_info_file)
 
         return slurm_files
 
+    def get_shard_manifest_path(self, dataset_shard: int) -> Path:
+        return self.manifest_folder / f"{dataset_shard}.csv"
+
+    def read_shard_manifest(self, dataset_shard: int) -> pd.DataFrame:
+        """The rows of the embeddings info csv of a shard, with only the columns extraction needs."""
+        manifest_path = self.get_shard_manifest_path(dataset_shard)
+        if manifest_path.is_file():
+            return pd.read_csv(manifest_path)
+
+        # written before there were manifests, read the needed columns of all rows
+        embeddings_info_df = self.read_manifest()
+        return embeddings_info_df[embeddings_info_df["dataset_shard"] == dataset_shard].reset_index(drop=True)
+
+    def read_manifest(self) -> pd.DataFrame:
+        """The rows of all shards, with only the columns extraction needs."""
+        return pd.read_csv(self.embeddings_info_file, usecols=lambda c: c in MANIFEST_COLUMNS)
+
+    def get_bash_scripts_for_work_queue_workers(self) -> List[Path]:
+        return sorted(self.dataset_folder.glob(f"tmp_slurm_{self.model_config_checksum}_worker_*.sh"))
+
+    def write_work_queue_and_worker_scripts(
+        self,
+        conda_env_name: str,
+        slurm_partition: str,
+        num_workers: int,
+        lease_size: int = WORK_QUEUE_LEASE_SIZE,
+    ) -> List[Path]:
+        # the workers lease ranges of the zarr indices in the embeddings info csv
+        WorkQueue.create(self.work_queue_path, self.num_total_samples, lease_size).close()
+
+        json_str = json.dumps(self.model_config, indent=4)
+        json_comment = "\n".join(f"# {x}" for x in json_str.splitlines())
+        slurm_files = []
+        for worker_idx in range(num_workers):
+            script_contents = SLURM_JOB_BASE.format(
+                slurm_partition=slurm_partition,
+                hash=self.model_config_checksum,
+                dataset_folder_name=self.dataset_name,
+                dataset_shard=f"worker_{worker_idx}",
+                shard_args="--work_queue",
+                conda_env_name=conda_env_name,
+                model_config_str=json_comment,
+            ).strip()
+
+            tmp_file = self.dataset_folder / f"tmp_slurm_{self.model_config_checksum}_worker_{worker_idx}.sh"
+            tmp_file.write_text(script_contents)
+            slurm_files.append(tmp_file)
+
+        return slurm_files
+
     @classmethod
     def load_from_dataset_folder_and_checksum(cls, dataset_folder: Path, model_config_checksum: str) -> "DatasetEmbeddingInformation":
         dataset_folder_name = dataset_folder.parts[-1]
@@ -410,6 +517,89 @@ class DatasetEmbeddingInformation:
             conds=[]
         )
 
+def load_model_for_extraction(model_type: Model) -> Tuple[Optional[AutoProcessor], Optional[MusicgenForConditionalGeneration]]:
+    try:
+        with span("extract.load_model"):
+            return load_musicgen_model(model_type)
+    except ValueError:
+        # not a musicgen model, later functions will handle
+        return None, None
+
+
+def extract_sample(
+    sample_info: Dict[str, Any],
+    dataset_folder: Path,
+    zarr_file: zarr.Array,
+    model_config: Dict[str, Any],
+    processor: Optional[AutoProcessor],
+    model: Optional[MusicgenForConditionalGeneration],
+    model_config_checksum: str,
+    log_prefix: str,
+) -> bool:
+    """Extracts the embedding of a row of the embeddings info csv. False if it was already written."""
+    sample_idx = int(sample_info["zarr_idx"])
+
+    # if we're working with audio files
+    if "audio_file_path" in sample_info:
+        audio_file_path = sample_info["audio_file_path"]
+    # otherwise we're working with text
+    elif "text_prompt" in sample_info:
+        text_prompt = sample_info["text_prompt"]
+
+    with span("extract.zarr_check"):
+        is_written = np.any(zarr_file[sample_idx])
+
+    if is_written:
+        return False
+
+    # all 0s in this array slice, hasn't yet been written, do not overwrite already written
+
+    # TODO: eventually be able to do both text and audio
+
+    # the load audio, preprocess and forward spans are recorded within
+    with span("extract.sample"):
+        # audio files
+        if "audio_file_path" in sample_info:
+            embedding_vec = get_embedding_from_model_using_config(
+                dataset_folder / audio_file_path, model_config, processor, model
+            )
+        # text prompts
+        elif "text_prompt" in sample_info:
+            embedding_vec = get_text_embedding_from_model_using_config(
+                text_prompt, model_config, processor, model
+            )
+
+    # truncate/pad embedding vec to the first embedding
+    # if embedding_vec.shape[0] > emb_shape:
+    #     embedding_vec = embedding_vec[:emb_shape]
+    # elif embedding_vec.shape[0] < emb_shape:
+    #     padding = np.zeros(emb_shape - embedding_vec.shape[0])  # pad with zeros
+    #     embedding_vec = np.concatenate(embedding_vec, padding)
+
+    print(f"extract shard embedding shape: {embedding_vec.shape}")
+
+    with span("extract.zarr_write"):
+        zarr_file[sample_idx] = embedding_vec
+    count("extract.samples")
+
+    model_type = Model[model_config["model_type"]]
+    # audio files
+    if "audio_file_path" in sample_info:
+        print(
+            f"{log_prefix}: Finished extracting idx: {sample_idx}, "
+            f"file: {audio_file_path}, for dataset: {dataset_folder.name}, "
+            f"with model config checksum: {model_config_checksum} ({model_type})"
+        )
+    elif "text_prompt" in sample_info:
+        print(
+            f"{log_prefix}: Finished extracting idx: {sample_idx}, "
+            f"prompt: {text_prompt}, for dataset: {dataset_folder.name}, "
+            f"with model config checksum: {model_config_checksum} ({model_type})"
+        )
+    # from zarr docs: "files are automatically closed whenever an array is modified."
+    return True
+
+
 def extract_shard(
     dataset_folder_name: str,
     dataset_shard: int,
@@ -421,7 +611,6 @@ def extract_shard(
 
     # load information for this model embedding
     model_config = embedding_info.model_config
-    info_file = embedding_info.embeddings_info_file
     status_folder = embedding_info.status_folder
 
     # overwrites existing text
@@ -429,95 +618,159 @@ def extract_shard(
     shard_status_path = status_folder / (f"{dataset_shard}.txt")
     shard_status_path.write_text(f"in progress\n{started_at}")
 
-    # read the embeddings information, will use this to determine if we need
+    # read the embeddings information of this shard, will use this to determine if we need
     # to extract a specific index yet
-    embeddings_info_df = pd.read_csv(info_file)
+    embeddings_info_df = embedding_info.read_shard_manifest(dataset_shard)
 
-    # load model
     model_type = Model[model_config["model_type"]]
+
+    # identify the records of this shard in the instrumentation log
+    shard_tags = dict(
+        dataset=dataset_folder_name,
+        shard=dataset_shard,
+        model_config_checksum=model_config_checksum,
+        model_type=model_type.name,
+    )
+    # started before the model is loaded, which can take longer than the heartbeat timeout
+    heartbeat = ShardHeartbeat(
+        status_folder,
+        dataset_shard,
+        num_samples=len(embeddings_info_df),
+        **{k: v for k, v in shard_tags.items() if k != "shard"},
+    )
+    samples_skipped = 0
+    written_idx = []
     try:
-        processor, model = load_musicgen_model(model_type)
-    except ValueError:
-        # not a musicgen model, later functions will handle
-        processor, model = None, None
+        processor, model = load_model_for_extraction(model_type)
 
-    zarr_file = embedding_info.load_zarr_file()
+        zarr_file = embedding_info.load_zarr_file()
 
-    print(f"extract shard zarr file shape: {zarr_file.shape}")
-    emb_shape = zarr_file.shape[1]
-    print(f"emb_shape: {emb_shape}")
+        print(f"extract shard zarr file shape: {zarr_file.shape}")
+        emb_shape = zarr_file.shape[1]
+        print(f"emb_shape: {emb_shape}")
 
-    if not zarr_file:
-        raise RuntimeError(f"Embeddings file for {dataset_folder_name} ({model_config_checksum}) did not exist.")
+        if not zarr_file:
+            raise RuntimeError(f"Embeddings file for {dataset_folder_name} ({model_config_checksum}) did not exist.")
 
-    written_idx = []
-    try:
         t_sample_info: NamedTuple
-        for t_sample_info in embeddings_info_df.itertuples():
+        for t_sample_info in embeddings_info_df.itertuples(index=False):
             sample_info = t_sample_info._asdict()
 
-            if int(sample_info["dataset_shard"]) != dataset_shard:
-                # only convert the files required by this shard
-                continue
+            written_idx.append(int(sample_info["zarr_idx"]))
+            if not extract_sample(
+                sample_info,
+                dataset_folder,
+                zarr_file,
+                model_config,
+                processor,
+                model,
+                model_config_checksum,
+                log_prefix=f"Shard: {dataset_shard}",
+            ):
+                # written by an earlier run of this shard
+                samples_skipped += 1
 
-            sample_idx = int(sample_info["zarr_idx"])
-            written_idx.append(sample_idx)
+            heartbeat.update(len(written_idx), samples_skipped)
 
-            # if we're working with audio files
-            if "audio_file_path" in sample_info:
-                audio_file_path = sample_info["audio_file_path"]
-            # otherwise we're working with text
-            elif "text_prompt" in sample_info:
-                text_prompt = sample_info["text_prompt"]
+    except Exception as e:
+        shard_status_path.write_text(f"failed. Error: {e}")
+        heartbeat.finish(FAILED)
+        emit("extract_shard", **shard_tags, status="failed")
+        raise e
 
-            if not np.any(zarr_file[sample_idx]):
-                # all 0s in this array slice, hasn't yet been written, do not overwrite already written
+    # overwrites existing text
+    shard_status_path.write_text("done")
+    heartbeat.finish(DONE)
+    emit("extract_shard", **shard_tags, status="done")
 
-                # TODO: eventually be able to do both text and audio
+    return zarr_file, np.array(written_idx)
 
-                # audio files
-                if "audio_file_path" in sample_info:
-                    embedding_vec = get_embedding_from_model_using_config(
-                        dataset_folder / audio_file_path, model_config, processor, model
-                    )
-                # text prompts
-                elif "text_prompt" in sample_info:
-                    embedding_vec = get_text_embedding_from_model_using_config(
-                        text_prompt, model_config, processor, model
-                    )
+def extract_from_work_queue(
+    dataset_folder_name: str,
+    model_config_checksum: str,
+    root_dir: Optional[Path] = OUTPUT_DIR,
+    worker_id: Optional[str] = None,
+    lease_sec: float = WORK_QUEUE_LEASE_SEC,
+) -> Tuple[zarr.Array, np.ndarray]:
+    """Extracts the ranges of samples leased from the work queue of the dataset, until it is empty.
+
+    The lease is renewed while its samples are extracted. If it was lost anyway, e.g. after
+    the job was suspended, the worker moves on to the next lease and leaves the rest of the
+    range to the worker that claimed it. A range that fails is given back to the queue, which
+    marks it failed after WORK_QUEUE_MAX_ATTEMPTS tries, and the worker moves on as well.
+    """
+    dataset_folder = root_dir / dataset_folder_name
+    embedding_info = DatasetEmbeddingInformation.load_from_dataset_folder_and_checksum(dataset_folder, model_config_checksum)
+    model_config = embedding_info.model_config
+    worker_id = worker_id or get_worker_id()
 
-                # truncate/pad embedding vec to the first embedding
-                # if embedding_vec.shape[0] > emb_shape:
-                #     embedding_vec = embedding_vec[:emb_shape]
-                # elif embedding_vec.shape[0] < emb_shape:
-                #     padding = np.zeros(emb_shape - embedding_vec.shape[0])  # pad with zeros
-                #     embedding_vec = np.concatenate(embedding_vec, padding)
+    work_queue_path = get_work_queue_path(dataset_folder, model_config_checksum)
+    if not work_queue_path.is_file():
+        raise RuntimeError(f"The work queue for {dataset_folder_name} ({model_config_checksum}) did not exist.")
+    queue = WorkQueue(work_queue_path)
 
-                print(f"extract shard embedding shape: {embedding_vec.shape}")
+    # rows by zarr index, leases are ranges of it
+    embeddings_info_df = embedding_info.read_manifest().set_index("zarr_idx", drop=False).sort_index()
 
-                zarr_file[sample_idx] = embedding_vec
+    model_type = Model[model_config["model_type"]]
+    processor, model = load_model_for_extraction(model_type)
 
-                # audio files
-                if "audio_file_path" in sample_info:
-                    print(
-                        f"Shard: {dataset_shard}: Finished extracting idx: {sample_idx}, "
-                        f"file: {audio_file_path}, for dataset: {dataset_folder_name}, "
-                        f"with model config checksum: {model_config_checksum} ({model_type})"
-                    )
-                elif "text_prompt" in sample_info:
-                    print(
-                        f"Shard: {dataset_shard}: Finished extracting idx: {sample_idx}, "
-                        f"prompt: {text_prompt}, for dataset: {dataset_folder_name}, "
-                        f"with model config checksum: {model_config_checksum} ({model_type})"
+    zarr_file = embedding_info.load_zarr_file()
+    if not zarr_file:
+        raise RuntimeError(f"Embeddings file for {dataset_folder_name} ({model_config_checksum}) did not exist.")
+
+    worker_tags = dict(
+        dataset=dataset_folder_name,
+        worker=worker_id,
+        model_config_checksum=model_config_checksum,
+        model_type=model_type.name,
+    )
+    written_idx = []
+    try:
+        while (lease := queue.claim(worker_id, lease_sec)) is not None:
+            start, stop = lease
+            renewed_at = time.monotonic()
+            num_written = len(written_idx)
+            try:
+                t_sample_info: NamedTuple
+                for t_sample_info in embeddings_info_df.loc[start : stop - 1].itertuples(index=False):
+                    extract_sample(
+                        t_sample_info._asdict(),
+                        dataset_folder,
+                        zarr_file,
+                        model_config,
+                        processor,
+                        model,
+                        model_config_checksum,
+                        log_prefix=f"Worker: {worker_id}",
                     )
-                # from zarr docs: "files are automatically closed whenever an array is modified."
+                    written_idx.append(t_sample_info.zarr_idx)
 
-    except Exception as e:
-        shard_status_path.write_text(f"failed. Error: {e}")
-        raise e
+                    if time.monotonic() - renewed_at > lease_sec / 4:
+                        if not queue.renew(start, worker_id, lease_sec):
+                            print(f"Worker: {worker_id}: lost the lease of samples [{start}, {stop})")
+                            break
+                        renewed_at = time.monotonic()
+                else:
+                    queue.complete(start, worker_id)
+            except Exception as e:
+                # e.g. a bad audio file. The range is retried, by this or another worker, until
+                # it fails for good, and the worker goes on with the other ranges
+                queue.release(start, worker_id)
+                del written_idx[num_written:]
+                print(f"Worker: {worker_id}: failed to extract samples [{start}, {stop}): {e}")
+                emit("extract_lease", **worker_tags, start=start, stop=stop, status="failed", error=str(e))
+            except BaseException:
+                # let another worker retry the range
+                queue.release(start, worker_id)
+                raise
+    except Exception:
+        emit("extract_worker", **worker_tags, status="failed")
+        raise
+    finally:
+        queue.close()
 
-    # overwrites existing text
-    shard_status_path.write_text("done")
+    emit("extract_worker", **worker_tags, status="done")
 
     return zarr_file, np.array(written_idx)
 
@@ -537,7 +790,8 @@ def get_embedding_from_model_using_config(
 
     minimum_duration = model_config["minimum_duration_in_sec"]
 
-    audio, sr = torchaudio.load(audio_file)
+    with span("extract.check_duration"):
+        audio, sr = torchaudio.load(audio_file)
     duration = audio.shape[-1] / sr
 
     if duration < minimum_duration:
@@ -618,6 +872,7 @@ def extract_embeddings_for_dataset_with_model(
     slurm_partition: str,
     conds: list[str],
     max_samples_per_shard: int = 300,
+    work_queue_workers: int = 0,
 ) -> List[Path]:
     # creates DatasetEmbeddingInformation for each model and dataset
     dataset_coordinator = DatasetEmbeddingInformation(dataset_folder, model_config, max_samples_per_shard, conds)
@@ -625,11 +880,18 @@ def extract_embeddings_for_dataset_with_model(
     # create the zarr file to hold the embeddings
     embeddings_array = dataset_coordinator.get_or_create_zarr_file()
     
-    # write the scripts that we can use to run to extract a portion (shard) of all embeddings
+    # write the scripts that we can use to run to extract a portion (shard) of all embeddings,
+    # workers of a work queue only need the embeddings info csv
     slurm_files = dataset_coordinator.write_shard_runner_scripts_and_embedding_info_csv(
-        conda_env_name, slurm_partition
+        conda_env_name, slurm_partition, write_shard_scripts=not work_queue_workers
     )
 
+    if work_queue_workers:
+        # workers lease small ranges of samples from a queue instead of running a fixed shard each
+        slurm_files = dataset_coordinator.write_work_queue_and_worker_scripts(
+            conda_env_name, slurm_partition, work_queue_workers
+        )
+
     # enqueue the jobs to extract the shards
     for tmp_file in slurm_files:
         subprocess.run(f"chmod u+x {tmp_file.absolute()}", shell=True)
@@ -652,6 +914,27 @@ def get_failed_jobs(dataset_folder: Path, model_config: Dict[str, Any], max_samp
     )
 
 
+def report_work_queue(dataset_folder: Path, model_config: Dict[str, Any], max_samples_per_shard: int, conds: list[str]) -> None:
+    dataset_coordinator = DatasetEmbeddingInformation(dataset_folder, model_config, max_samples_per_shard, conds)
+    queue = WorkQueue(dataset_coordinator.work_queue_path)
+    failed = queue.retry_failed()
+    progress = queue.progress()
+    queue.close()
+
+    name = f"{dataset_coordinator.dataset_name} - {dataset_coordinator.model_name} ({dataset_coordinator.model_config_checksum})"
+    scripts_str = ", ".join(x.name for x in dataset_coordinator.get_bash_scripts_for_work_queue_workers())
+    if failed:
+        ranges_str = ", ".join(f"[{start}, {stop})" for start, stop in failed)
+        print(f"{name}: the samples {ranges_str} failed and were queued again. Inspect the worker logs, then re-run some of these scripts: {scripts_str}.")
+    elif progress[PENDING] or progress["expired"]:
+        # leases of dead workers expire and are picked up by the others, unless none are left
+        print(f"{name}: {progress[PENDING] + progress['expired']} samples are waiting in the work queue. If no worker is running, re-run some of these scripts: {scripts_str}.")
+    elif progress[LEASED]:
+        print(f"{name}: {progress[LEASED]} samples are being extracted.")
+    else:
+        print(f"{name} is done with no errors.")
+
+
 def main():
     # need to allocate 16 gb of memory
 
@@ -667,6 +950,8 @@ def main():
 
     slurm_partition = settings['slurm_partition']
     conda_env_name = settings['conda_env_name']
+    # 0 runs a job per shard, otherwise this many jobs share a work queue of all samples
+    work_queue_workers = settings.get('work_queue_workers', 0)
     
     with use_770_permissions():
         # for every concept in the config
@@ -684,8 +969,11 @@ def main():
                 if model_name == "JUKEBOX":
                     model_config["decoder_hidden_states"] = False
 
-                # creates shard scripts for each model
-                if has_no_shard_scripts(dataset_folder, model_config, settings['max_samples_per_shard'], conds):
+                # creates shard scripts, or the work queue, for each model
+                if get_work_queue_path(dataset_folder, compute_checksum(model_config)).is_file():
+                    # - started with work queue workers, which have no shard scripts
+                    report_work_queue(dataset_folder, model_config, settings['max_samples_per_shard'], conds)
+                elif has_no_shard_scripts(dataset_folder, model_config, settings['max_samples_per_shard'], conds):
                     # - no scripts at all (never started)
                     print(f"Extracting embeddings for {concept} using {model_name}")
                     shard_scripts = extract_embeddings_for_dataset_with_model(
@@ -694,7 +982,8 @@ def main():
                         conda_env_name,
                         slurm_partition,
                         conds=conds,
-                        max_samples_per_shard=settings['max_samples_per_shard']
+                        max_samples_per_shard=settings['max_samples_per_shard'],
+                        work_queue_workers=work_queue_workers,
                     )
                 else:
                     failed_jobs = get_failed_jobs(dataset_folder, model_config, settings['max_samples_per_shard'], conds)
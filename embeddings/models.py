@@ -1,4 +1,4 @@
-from typing import Union, Optional
+from typing import Union, Optional, Tuple
 from enum import Enum
 from pathlib import Path
 
@@ -12,10 +12,33 @@ from transformers import MusicgenForConditionalGeneration, AutoProcessor, BertMo
 
 import torch
 
+from instrumentation import span, timed
+
 SAMPLE_RATE_FEATS = 22050 # librosa default sample rate for handcrafted features
 
 DURATION_IN_SEC = 4.0
 
+# sizes of the representations of each model, so that their shapes are known without an inference
+JUKEBOX_HIDDEN_SIZE = 4800
+MUSICGEN_AUDIO_ENCODER_HIDDEN_SIZE = 128
+# MusicGen conditions on T5 base for all model sizes
+MUSICGEN_TEXT_ENCODER_HIDDEN_SIZE = 768
+BERT_HIDDEN_SIZE = 768
+
+# (hidden size, number of layers, number of attention heads) of the MusicGen decoders
+MUSICGEN_DECODER_SIZES = {
+    "MUSICGEN_DECODER_LM_S": (1024, 24, 16),
+    "MUSICGEN_DECODER_LM_M": (1536, 48, 24),
+    "MUSICGEN_DECODER_LM_L": (2048, 48, 32),
+}
+
+# number of features per frame, with librosa defaults
+HANDCRAFTED_FEATURE_SIZES = {
+    "MELSPEC": 128,
+    "CHROMA": 12,
+    "MFCC": 20,
+}
+
 
 class Model(Enum):
     JUKEBOX = 1
@@ -47,6 +70,51 @@ class Model(Enum):
             raise ValueError(f"Invalid model: {self}")
 
 
+def get_embedding_shape(
+    model_type: Model,
+    extract_from_layer: Optional[int] = None,
+    decoder_hidden_states: bool = True,
+    meanpool: bool = True,
+) -> Optional[Tuple[int, ...]]:
+    """
+    Shape of the embedding of one sample, as extracted by audio_file_to_embedding_np_array and
+    text_prompt_to_embedding_np_array. None if it depends on the length of the input, i.e. the
+    MusicGen decoders without meanpool.
+    """
+    if model_type == Model.JUKEBOX:
+        # jukemirlib always meanpools
+        if extract_from_layer is None:
+            return (model_type.max_layers, JUKEBOX_HIDDEN_SIZE)
+        return (JUKEBOX_HIDDEN_SIZE,)
+    elif model_type in {Model.MELSPEC, Model.CHROMA, Model.MFCC}:
+        # mean and std of the features and of their 1st and 2nd order differences
+        return (6 * HANDCRAFTED_FEATURE_SIZES[model_type.name],)
+    elif model_type == Model.HANDCRAFT:
+        return (6 * sum(HANDCRAFTED_FEATURE_SIZES.values()),)
+    elif model_type == Model.MUSICGEN_AUDIO_ENCODER:
+        return (MUSICGEN_AUDIO_ENCODER_HIDDEN_SIZE,)
+    elif model_type == Model.MUSICGEN_TEXT_ENCODER:
+        return (MUSICGEN_TEXT_ENCODER_HIDDEN_SIZE,)
+    elif model_type == Model.BERT:
+        # the mean over the tokens of a batch of 1
+        return (1, BERT_HIDDEN_SIZE)
+    elif model_type.name in MUSICGEN_DECODER_SIZES:
+        if not meanpool:
+            return None
+        hidden_size, num_layers, num_heads = MUSICGEN_DECODER_SIZES[model_type.name]
+        if decoder_hidden_states:
+            # the hidden states include the output of the embedding layer
+            size, num_outputs = hidden_size, num_layers + 1
+        else:
+            # attention weights are averaged per head
+            size, num_outputs = num_heads, num_layers
+        if extract_from_layer is None:
+            return (num_outputs, size)
+        return (size,)
+    else:
+        raise ValueError(f"Invalid model: {model_type}")
+
+
 def load_musicgen_model(model: Model):
     """
     Load MusicGen processor and model.
@@ -69,6 +137,7 @@ def load_musicgen_model(model: Model):
         raise ValueError(f"Not MusicGen model: {model}")
 
 
+@timed("extract.load_audio")
 def load_audio(fpath: str, sr: int, duration: float) -> np.ndarray:
     audio, _ = lr.load(fpath, sr=sr, duration=duration)
     if audio.ndim == 1:
@@ -109,15 +178,17 @@ def audio_file_to_embedding_np_array(
         else: 
             layers = [extract_from_layer]
 
-        reps = jukemirlib.extract(
-            fpath=audio_file,
-            layers=layers,
-            duration=DURATION_IN_SEC,
-            meanpool=True,
-            # downsample to rate 15 using method "librosa_fft"
-            downsample_target_rate=15,
-            downsample_method=None,
-        )
+        # jukemirlib loads and preprocesses the audio itself
+        with span("extract.forward"):
+            reps = jukemirlib.extract(
+                fpath=audio_file,
+                layers=layers,
+                duration=DURATION_IN_SEC,
+                meanpool=True,
+                # downsample to rate 15 using method "librosa_fft"
+                downsample_target_rate=15,
+                downsample_method=None,
+            )
         # jukemirlib produces a dictionary where the key is the number of layers
         # but we want this as just a numpy array
         if extract_from_layer is None:
@@ -129,20 +200,21 @@ def audio_file_to_embedding_np_array(
     # Handcrafted features
     elif model_type in {Model.MELSPEC, Model.CHROMA, Model.MFCC, Model.HANDCRAFT}:
         audio = load_audio(audio_file, 22050, DURATION_IN_SEC)
-        if model_type == Model.HANDCRAFT:
-            embedding = np.concatenate([concat_features(melspectrogram(audio, sr=22050)),
-                                        concat_features(chroma_cqt(audio, sr=22050)),
-                                        concat_features(mfcc(audio, sr=22050))])
-        else:
-            if model_type == Model.MELSPEC:
-                features = melspectrogram(audio, sr=22050)
-            elif model_type == Model.CHROMA:
-                features = chroma_cqt(audio, sr=22050)
-            elif model_type == Model.MFCC:
-                features = mfcc(y=audio, sr=22050)
+        with span("extract.forward"):
+            if model_type == Model.HANDCRAFT:
+                embedding = np.concatenate([concat_features(melspectrogram(audio, sr=22050)),
+                                            concat_features(chroma_cqt(audio, sr=22050)),
+                                            concat_features(mfcc(audio, sr=22050))])
+            else:
+                if model_type == Model.MELSPEC:
+                    features = melspectrogram(audio, sr=22050)
+                elif model_type == Model.CHROMA:
+                    features = chroma_cqt(audio, sr=22050)
+                elif model_type == Model.MFCC:
+                    features = mfcc(y=audio, sr=22050)
             
-            # concatentate mean and std across time of features & their 1st and 2nd order differences
-            embedding = concat_features(features)
+                # concatentate mean and std across time of features & their 1st and 2nd order differences
+                embedding = concat_features(features)
         
     # MusicGen Features
     elif model_type == Model.MUSICGEN_AUDIO_ENCODER:
@@ -200,11 +272,14 @@ def text_prompt_to_embedding_np_array(
             meanpool=meanpool
         )
     elif model_type == Model.BERT:
-        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        model = BertModel.from_pretrained("bert-base-uncased")
-
-        encoded_input = tokenizer(prompt, return_tensors='pt')
-        output = model(**encoded_input)
+        with span("extract.load_model"):
+            tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+            model = BertModel.from_pretrained("bert-base-uncased")
+
+        with span("extract.preprocess"):
+            encoded_input = tokenizer(prompt, return_tensors='pt')
+        with span("extract.forward"):
+            output = model(**encoded_input)
         last_hidden_state = output.last_hidden_state
         embedding = last_hidden_state.mean(dim=1)
         embedding = embedding.detach().numpy()
@@ -227,12 +302,13 @@ def extract_musicgen_audio_encoder_emb(
 
     audio = load_audio(str(audio_file), sampling_rate, DURATION_IN_SEC)
 
-    inputs = processor(
-        audio=audio,
-        sampling_rate=sampling_rate,
-        padding=True,
-        return_tensors="pt",
-    )
+    with span("extract.preprocess"):
+        inputs = processor(
+            audio=audio,
+            sampling_rate=sampling_rate,
+            padding=True,
+            return_tensors="pt",
+        )
 
     x = inputs["input_values"]
 
@@ -240,8 +316,9 @@ def extract_musicgen_audio_encoder_emb(
     audio_encoder = model.get_audio_encoder()
 
     # extract representations from audio encoder
-    for layer in audio_encoder.encoder.layers:
-        x = layer(x)
+    with span("extract.forward"):
+        for layer in audio_encoder.encoder.layers:
+            x = layer(x)
 
     if meanpool:
         return x.mean(axis=2).squeeze().detach().numpy()
@@ -271,26 +348,29 @@ def extract_musicgen_decoder_lm_emb(
         
         audio = load_audio(str(audio_file), sampling_rate, DURATION_IN_SEC)
 
-        inputs = processor(
-            audio=audio,
-            text=text_cond,
-            sampling_rate=sampling_rate,
-            padding=True,
-            return_tensors="pt",
-        )
+        with span("extract.preprocess"):
+            inputs = processor(
+                audio=audio,
+                text=text_cond,
+                sampling_rate=sampling_rate,
+                padding=True,
+                return_tensors="pt",
+            )
     elif text_cond != "":
-        inputs = processor(
-            text=text_cond,
-            padding=True,
-            return_tensors="pt",
-        )
+        with span("extract.preprocess"):
+            inputs = processor(
+                text=text_cond,
+                padding=True,
+                return_tensors="pt",
+            )
         pad_token_id = model.generation_config.pad_token_id
         decoder_input_ids = (
             torch.ones((inputs.input_ids.shape[0] * model.decoder.num_codebooks, 1), dtype=torch.long) * pad_token_id
         )
 
     # extract representations from decoder LM
-    out = model(**inputs, decoder_input_ids=decoder_input_ids, output_attentions=True, output_hidden_states=True)
+    with span("extract.forward"):
+        out = model(**inputs, decoder_input_ids=decoder_input_ids, output_attentions=True, output_hidden_states=True)
 
     # output decoder hidden states
     if hidden_states:
@@ -327,23 +407,25 @@ def extract_musicgen_text_encoder_emb(
     Extract embeddings from MusicGen Text Encoder
     """
     # set up inputs
-    inputs = processor(
-        text=text_cond,
-        padding=True,
-        truncation=True,
-        return_tensors="pt",
-    )
+    with span("extract.preprocess"):
+        inputs = processor(
+            text=text_cond,
+            padding=True,
+            truncation=True,
+            return_tensors="pt",
+        )
 
     # text encoder
     text_encoder = model.get_text_encoder()
 
-    # embed tokens
-    x = text_encoder.encoder.embed_tokens(inputs["input_ids"])
+    with span("extract.forward"):
+        # embed tokens
+        x = text_encoder.encoder.embed_tokens(inputs["input_ids"])
 
-    # extract representations from text encoder
-    for layer in text_encoder.encoder.block:
-        # get first item of tuple to get hidden states
-        x = layer(x)[0]
+        # extract representations from text encoder
+        for layer in text_encoder.encoder.block:
+            # get first item of tuple to get hidden states
+            x = layer(x)[0]
 
     if meanpool:
         return x.mean(axis=1).squeeze().detach().numpy()
@@ -1,13 +1,88 @@
+import os
+import pickle
 import argparse
-from json import loads
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
 import numpy as np
 import pandas as pd
 import zarr
+import numba
 import umap
+import umap.plot
+import matplotlib.pyplot as plt
+from sklearn.decomposition import PCA
 
 from config import OUTPUT_DIR, load_config
-from probe.main import _is_equal_model_types
+from embeddings.catalog import EmbeddingsCatalog, get_model_type_and_size
+from embeddings.config_checksum import compute_checksum
+from embeddings.shard_progress import is_extraction_finished
 from probe.probe_config import CONCEPT_LABELS
+from probe.splits import RANDOM_SPLIT, SPLIT_NAMES, get_split_policy, load_split_positions
+
+# cosine similarity for word embeddings
+UMAP_SETTINGS = {"n_neighbors": 50, "min_dist": 0.1, "metric": "cosine"}
+
+# samples projected onto the fitted UMAP at a time, when it was fit on a subsample
+UMAP_TRANSFORM_CHUNK_SIZE = 8192
+
+
+def get_umap_cache_path(
+    embeddings_zarr_filepath: Union[str, Path], settings: Dict[str, Any], kind: str
+) -> Path:
+    """Location of a cached UMAP result, next to the zarr it was computed from.
+
+    kind is "embedding" for the 2-D coordinates or "knn" for the nearest neighbor graph,
+    settings are everything the result depends on.
+    """
+    zarr_filepath = Path(embeddings_zarr_filepath)
+    stem = zarr_filepath.name.split(".zarr")[0]
+    suffix = "pkl" if kind == "knn" else "npz"
+    return zarr_filepath.parent / (
+        f"{stem}_umap_{kind}_{compute_checksum(settings)[:16]}.{suffix}"
+    )
+
+
+def _atomic_write(path: Path, write_fn) -> None:
+    try:
+        # write to a temporary name and move it into place, so that concurrent plots
+        # never read a partially written file
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # the dataset folder may be read only, the result is still correct
+        pass
+
+
+def _save_npz(path: Path, **arrays: np.ndarray) -> None:
+    _atomic_write(path, lambda f: np.savez(f, **arrays))
+
+
+def _save_pickle(path: Path, obj: Any) -> None:
+    _atomic_write(path, lambda f: pickle.dump(obj, f))
+
+
+def stratified_sample_positions(
+    dataset_labels: pd.DataFrame, label_columns: List[str], num_samples: int, seed: int = 0
+) -> np.ndarray:
+    """Sorted positions of about num_samples rows, sampled evenly from each label group.
+
+    Every combination of labels keeps its share of the rows, and at least one row, so
+    that rare labels are still on the plots.
+    """
+    rng = np.random.default_rng(seed)
+    frac = num_samples / dataset_labels.shape[0]
+    groups = dataset_labels.groupby(label_columns, sort=True).indices
+    positions = [
+        rng.choice(group, size=max(1, round(frac * len(group))), replace=False)
+        for group in groups.values()
+    ]
+    return np.sort(np.concatenate(positions))
+
 
 class EmbeddingsPlot:
 
@@ -16,9 +91,25 @@ class EmbeddingsPlot:
             dataset_labels_filepath,
             dataset_settings,
             embeddings_zarr_filepath,
-            model_type
+            model_type,
+            split_name: Optional[str] = None,
+            seed: int = 0,
+            split_policy: str = RANDOM_SPLIT,
+            max_fit_samples: Optional[int] = None,
+            pca_components: Optional[int] = None,
         ) -> None:
+        """Load the embeddings of the last layer and the labels to color them by.
+
+        If split_name is given, only the samples of that split are loaded. The splits are
+        the same that probes trained with the same seed and policy use.
+
+        For large datasets, max_fit_samples bounds the samples that UMAP is fit on. They
+        are a subsample stratified by the label columns, and only they are loaded. The
+        other samples are read in chunks and projected onto the fitted manifold with
+        UMAP.transform. pca_components reduces the embeddings with PCA before UMAP.
+        """
         self.dataset_labels_filepath = dataset_labels_filepath
+        self.embeddings_zarr_filepath = embeddings_zarr_filepath
         self.label_columns = [label_column for (_, label_column) in dataset_settings]
         self.model_type = model_type
 
@@ -31,52 +122,239 @@ class EmbeddingsPlot:
         if "zarr_idx" not in set(dataset_labels.columns):
             dataset_labels["zarr_idx"] = np.arange(dataset_labels.shape[0])
 
+        if split_name is not None:
+            positions = load_split_positions(
+                dataset_labels_filepath, dataset_labels, seed, split_policy
+            )
+            self.dataset_labels = dataset_labels.iloc[positions[split_name]]
+
         # load the zarr, read only mode
         data = zarr.open(embeddings_zarr_filepath, mode="r")
 
         self.is_foundation_model_layers = len(data.shape) == 3
         self.embeddings = data
+        # get last layer
+        self.model_layer = data.shape[1] - 1 if self.is_foundation_model_layers else None
+
+        num_samples = self.dataset_labels.shape[0]
+        if max_fit_samples is None or max_fit_samples >= num_samples:
+            max_fit_samples = None
+            self.fit_positions = np.arange(num_samples)
+        else:
+            self.fit_positions = stratified_sample_positions(
+                self.dataset_labels, self.label_columns, max_fit_samples, seed
+            )
+        self.pca_components = pca_components
+
+        # everything that determines which embeddings are plotted, and how
+        self.selection = {
+            "embeddings_shape": list(data.shape),
+            "model_layer": self.model_layer,
+            "split_name": split_name,
+            "seed": seed if split_name is not None or max_fit_samples is not None else None,
+            "split_policy": split_policy if split_name is not None else None,
+            "max_fit_samples": max_fit_samples,
+            # the subsample is stratified by these
+            "label_columns": self.label_columns if max_fit_samples is not None else None,
+            "pca_components": pca_components,
+        }
+
+        self.X = self.read_embeddings(self.fit_positions)
+
+        self.ys = [self.dataset_labels[label] for label in self.label_columns]
 
-        selector = self.dataset_labels["zarr_idx"].to_numpy()
+    def read_embeddings(self, positions: np.ndarray) -> np.ndarray:
+        """The embeddings of the samples at the given positions of dataset_labels."""
+        selector = self.dataset_labels["zarr_idx"].to_numpy()[positions]
         if self.is_foundation_model_layers:
-            # get last layer
-            self.X = np.array(self.embeddings[selector][:, -1, :], dtype=np.float32)
+            # only read the plotted layer
+            selection = (selector, self.model_layer, slice(None))
         else:
             # handcrafted features or encoders (only one layer)
-            self.X = np.array(self.embeddings[selector], dtype=np.float32)
+            selection = (selector, slice(None))
+        return np.asarray(
+            self.embeddings.get_orthogonal_selection(selection), dtype=np.float32
+        )
 
-        self.ys = [self.dataset_labels[label] for label in self.label_columns]
+    def fit_umap(self, refit: bool = False) -> np.ndarray:
+        """The 2-D UMAP coordinates of the loaded embeddings.
+
+        The embeddings are the same for every label column, only the colouring differs, so
+        UMAP is fit once and every plot reuses the coordinates. They are cached next to the
+        zarr along with the nearest neighbor graph, so later runs skip the fit. A changed
+        min_dist only recomputes the layout and reuses the cached graph. Pass refit to ignore
+        the cache.
+        """
+        knn_settings = {
+            **self.selection,
+            "n_neighbors": UMAP_SETTINGS["n_neighbors"],
+            "metric": UMAP_SETTINGS["metric"],
+        }
+        embedding_settings = {**knn_settings, "min_dist": UMAP_SETTINGS["min_dist"]}
+        knn_path = get_umap_cache_path(self.embeddings_zarr_filepath, knn_settings, "knn")
+        embedding_path = get_umap_cache_path(
+            self.embeddings_zarr_filepath, embedding_settings, "embedding"
+        )
+        # cached results are stale once the labels, and so possibly the samples, change, or
+        # once the embeddings are extracted again
+        inputs_mtime_ns = max(
+            Path(self.dataset_labels_filepath).stat().st_mtime_ns,
+            Path(self.embeddings_zarr_filepath).stat().st_mtime_ns,
+        )
+
+        def _is_cached(path: Path) -> bool:
+            return not refit and path.is_file() and path.stat().st_mtime_ns >= inputs_mtime_ns
+
+        if _is_cached(embedding_path):
+            with np.load(embedding_path) as f:
+                return f["embedding"]
+
+        precomputed_knn = (None, None, None)
+        if _is_cached(knn_path):
+            with open(knn_path, "rb") as f:
+                precomputed_knn = pickle.load(f)
+
+        pca = None
+        X = self.X
+        if self.pca_components is not None and self.pca_components < X.shape[1]:
+            pca = PCA(n_components=self.pca_components, random_state=0)
+            X = pca.fit_transform(X)
+
+        mapper = umap.UMAP(**UMAP_SETTINGS, precomputed_knn=precomputed_knn).fit(X)
+
+        num_samples = self.dataset_labels.shape[0]
+        if len(self.fit_positions) == num_samples:
+            embedding = mapper.embedding_
+        else:
+            # project the samples that UMAP was not fit on, a chunk at a time
+            embedding = np.empty((num_samples, 2), dtype=np.float32)
+            embedding[self.fit_positions] = mapper.embedding_
+            other_positions = np.setdiff1d(np.arange(num_samples), self.fit_positions)
+            for i in range(0, len(other_positions), UMAP_TRANSFORM_CHUNK_SIZE):
+                positions = other_positions[i : i + UMAP_TRANSFORM_CHUNK_SIZE]
+                X = self.read_embeddings(positions)
+                if pca is not None:
+                    X = pca.transform(X)
+                embedding[positions] = mapper.transform(X)
 
-    def plot_umap(self) -> None:
+        _save_npz(embedding_path, embedding=embedding)
+        if precomputed_knn[0] is None and getattr(mapper, "_knn_indices", None) is not None:
+            # UMAP only builds the graph for larger datasets, small ones are cheap to refit.
+            # The search index is kept so that the mapper can still transform new samples.
+            _save_pickle(
+                knn_path,
+                (mapper._knn_indices, mapper._knn_dists, mapper._knn_search_index),
+            )
+        return embedding
+
+    def plot_umap(
+        self,
+        refit: bool = False,
+        output_dir: Union[str, Path] = ".",
+        label_columns: Optional[List[str]] = None,
+    ) -> List[Path]:
+        """Plot the UMAP coloured by each label column, or by the given ones.
+
+        Returns the paths of the plots, see get_umap_plot_path.
+        """
+        embedding = self.fit_umap(refit=refit)
+        # holds the settings that are printed on the plots
+        mapper = umap.UMAP(**UMAP_SETTINGS)
+        concept_name = Path(self.dataset_labels_filepath).parent.name
+
+        plot_paths = []
         # loop through label columns
-        for i in range(len(self.label_columns)):
+        for label_column, y in zip(self.label_columns, self.ys):
+            if label_columns is not None and label_column not in label_columns:
+                continue
             # aggregate all the dataset label splits to plot
-            print(f"plotting UMAP for {self.label_columns[i]} in {self.model_type}")
+            print(f"plotting UMAP for {label_column} in {self.model_type}")
 
-            # cosine similarity for word embeddings
-            mapper = umap.UMAP(n_neighbors=50, min_dist=0.1, metric="cosine").fit(self.X)
-            ax = umap.plot.points(mapper, labels=self.ys[i])
+            ax = umap.plot.points(mapper, points=embedding, labels=y)
 
-            ax.get_figure().savefig(f"umap_plot_{str(self.dataset_labels_filepath).split("/")[6]}_{self.label_columns[i]}_{self.model_type}.png")
+            plot_path = get_umap_plot_path(
+                output_dir, concept_name, label_column, self.model_type
+            )
+            plot_path.parent.mkdir(parents=True, exist_ok=True)
+            ax.get_figure().savefig(plot_path)
+            plt.close(ax.get_figure())
+            plot_paths.append(plot_path)
 
             print("done")
+        return plot_paths
+
+
+def get_umap_plot_path(
+    output_dir: Union[str, Path], concept_name: str, label_column: str, model_type: str
+) -> Path:
+    return Path(output_dir) / concept_name / (
+        f"umap_plot_{concept_name}_{label_column}_{model_type}.png"
+    )
+
+
+def get_plot_fingerprint(
+    exp_info: Dict[str, Any],
+    dataset_labels_filepath: Union[str, Path],
+    label_column: str,
+    plot_settings: Dict[str, Any],
+) -> str:
+    """Checksum of everything a plot is made from, known without loading any embeddings.
+
+    The zarr keeps its shape when the embeddings are extracted again, its mtime tells.
+    """
+    labels_stat = Path(dataset_labels_filepath).stat()
+    return compute_checksum(
+        {
+            "zarr_filepath": str(exp_info["zarr_filepath"]),
+            "zarr_mtime_ns": Path(exp_info["zarr_filepath"]).stat().st_mtime_ns,
+            "embeddings_dataset_shape": list(exp_info["embeddings_dataset_shape"]),
+            "dtype": exp_info["dtype"],
+            "model_hash": exp_info["model_hash"],
+            "labels_mtime_ns": labels_stat.st_mtime_ns,
+            "labels_size": labels_stat.st_size,
+            "label_column": label_column,
+            "umap": UMAP_SETTINGS,
+            **plot_settings,
+        }
+    )
+
+
+def _get_fingerprint_path(plot_path: Path) -> Path:
+    return plot_path.with_name(plot_path.name + ".fingerprint")
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--config", type=str, required=True, help="Path to the YAML config file")
-    args = parser.parse_args()
-    config = load_config(args.config)
 
+def is_plot_current(plot_path: Path, fingerprint: str) -> bool:
+    """Whether the plot exists and was made from the same inputs."""
+    fingerprint_path = _get_fingerprint_path(plot_path)
+    return (
+        plot_path.is_file()
+        and fingerprint_path.is_file()
+        and fingerprint_path.read_text() == fingerprint
+    )
+
+
+def get_plot_jobs(
+    config: Dict[str, Any],
+    output_dir: Path,
+    plot_settings: Dict[str, Any],
+    base_path_parent: Path = OUTPUT_DIR,
+    force: bool = False,
+) -> List[Dict[str, Any]]:
+    """One job per (concept, model), with the label columns whose plots are out of date.
+
+    The plots of a model share one UMAP fit, so its label columns are plotted in one job.
+    """
     concepts = config['concepts']
     conds = config['conditionings']
     models = config['models']
 
+    jobs = []
     for concept_name in concepts:
         for model in models:
             if model.split("_LM_")[-1] != "L" and model != "MUSICGEN_TEXT_ENCODER" and model != "BERT":
                 continue
 
-            base_path= OUTPUT_DIR / concept_name
+            base_path = base_path_parent / concept_name
 
             dataset_settings = CONCEPT_LABELS[concept_name]
 
@@ -86,64 +364,134 @@ def main():
             elif "audio" in conds:
                 dataset_info = base_path / "info.csv"
 
-            zarr_files = list(base_path.glob("*.zarr"))
+            # look up the correct location for the embeddings given the model
+            exp_info = EmbeddingsCatalog.load(base_path).find(*get_model_type_and_size(model))
+            if exp_info is None:
+                print(f"There are no embeddings of {model} for {concept_name}, skipping.")
+                continue
+            if not is_extraction_finished(
+                Path(exp_info["zarr_filepath"]).parent, exp_info["model_hash"]
+            ):
+                print(f"The embeddings of {model} for {concept_name} are not extracted yet, skipping.")
+                continue
 
-            model_embeddings_infos = []
+            fingerprints = {}
+            for (_, label_column) in dataset_settings:
+                fingerprint = get_plot_fingerprint(
+                    exp_info, dataset_info, label_column, plot_settings
+                )
+                plot_path = get_umap_plot_path(
+                    output_dir, concept_name, label_column, exp_info["model_type"]
+                )
+                if force or not is_plot_current(plot_path, fingerprint):
+                    fingerprints[label_column] = fingerprint
+            if not fingerprints:
+                continue
 
-            # loop through all zarr files
-            for z in zarr_files:
-                f_name = z.parts[-1]
+            jobs.append(
+                {
+                    "dataset_labels_filepath": dataset_info,
+                    "dataset_settings": dataset_settings,
+                    "embeddings_zarr_filepath": exp_info["zarr_filepath"],
+                    "model_type": exp_info["model_type"],
+                    # tempos are probed with regression, everything else is multiclass
+                    "split_policy": get_split_policy(
+                        concept_name,
+                        "regression" if concept_name == "tempos" else "multiclass",
+                    ),
+                    "plot_settings": plot_settings,
+                    "output_dir": output_dir,
+                    "fingerprints": fingerprints,
+                }
+            )
+    return jobs
 
-                if not f_name.startswith(concept_name):
-                    # expect embeddings arrays to be prefixed with the concept name
-                    continue
 
-                # get the settings associated with the model that produced these embeddings
-                model_hash = f_name.split(".zarr")[0].split("_")[-1]
-                model_settings_path = base_path / (concept_name + "_" + model_hash + ".json")
-                model_settings = loads(model_settings_path.read_text())
+def run_plot_job(job: Dict[str, Any], refit: bool = False) -> List[Path]:
+    """Plot the out of date label columns of a job, see get_plot_jobs."""
+    plot_settings = job["plot_settings"]
+    emb = EmbeddingsPlot()
+    emb.load_embeddings(
+        dataset_labels_filepath=job["dataset_labels_filepath"],
+        dataset_settings=job["dataset_settings"],
+        embeddings_zarr_filepath=job["embeddings_zarr_filepath"],
+        model_type=job["model_type"],
+        split_name=plot_settings["split_name"],
+        seed=plot_settings["seed"],
+        split_policy=job["split_policy"],
+        max_fit_samples=plot_settings["max_fit_samples"],
+        pca_components=plot_settings["pca_components"],
+    )
+    plot_paths = emb.plot_umap(
+        refit=refit,
+        output_dir=job["output_dir"],
+        label_columns=list(job["fingerprints"].keys()),
+    )
+    concept_name = Path(job["dataset_labels_filepath"]).parent.name
+    for label_column, fingerprint in job["fingerprints"].items():
+        plot_path = get_umap_plot_path(
+            job["output_dir"], concept_name, label_column, job["model_type"]
+        )
+        # written last, so that a plot interrupted midway is made again
+        _get_fingerprint_path(plot_path).write_text(fingerprint)
+    return plot_paths
 
-                model_name = model_settings["model_name"]
 
-                emb = zarr.open(z)
+def _init_plot_worker(num_threads: int) -> None:
+    # UMAP parallelizes with numba, split the cores between the workers
+    numba.set_num_threads(max(1, min(num_threads, numba.config.NUMBA_NUM_THREADS)))
 
-                model_name = model_settings["model_name"]
-                if model_name == "JUKEBOX":
-                    model_type = "JUKEBOX"
-                elif "MUSICGEN_DECODER" in model_name:
-                    model_type = "MUSICGEN_DECODER"
-                elif "MUSICGEN_AUDIO_ENCODER" in model_name:
-                    model_type = "MUSICGEN_AUDIO_ENCODER"
-                elif "MUSICGEN_TEXT_ENCODER" in model_name:
-                    model_type = "MUSICGEN_TEXT_ENCODER"
-                else:
-                    # handcrafted features, default to L
-                    model_type = model_settings["model_name"]
 
-                exp_info = {
-                    "zarr_filepath": z,
-                    "dataset_labels_path": dataset_info,
-                    "model_type": model_type,
-                }
-                model_embeddings_infos.append(exp_info)
-        
-            # look up the correct location for the embeddings given experiment config
-            exp_info = None
-            for e in model_embeddings_infos:
-                if (
-                    _is_equal_model_types(e["model_type"], model)
-                ):
-                    exp_info = e
-            
-            emb = EmbeddingsPlot()
-            emb.load_embeddings(
-                dataset_labels_filepath=exp_info["dataset_labels_path"],
-                dataset_settings=dataset_settings,
-                embeddings_zarr_filepath=exp_info["zarr_filepath"],
-                model_type=exp_info["model_type"]
-            )
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="Path to the YAML config file")
+    # plot only the samples of a probe split, by default all samples are plotted
+    parser.add_argument("--split", type=str, choices=SPLIT_NAMES, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    # fit UMAP again instead of using the cached coordinates
+    parser.add_argument("--refit_umap", action="store_true")
+    # fit UMAP on a stratified subsample of at most this many samples, and project the
+    # others onto it. Bounds the time and memory of plotting the large concepts.
+    parser.add_argument("--max_fit_samples", type=int, default=None)
+    # reduce the embeddings to this many dimensions with PCA before UMAP
+    parser.add_argument("--pca_components", type=int, default=None)
+    parser.add_argument("--output_dir", type=Path, default=OUTPUT_DIR / "umap_plots")
+    # number of (concept, model) plot jobs to run at the same time
+    parser.add_argument("--workers", type=int, default=1)
+    # plot again even if the inputs of a plot did not change
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    plot_settings = {
+        "split_name": args.split,
+        "seed": args.seed,
+        "max_fit_samples": args.max_fit_samples,
+        "pca_components": args.pca_components,
+    }
+    jobs = get_plot_jobs(
+        config, args.output_dir, plot_settings, force=args.force or args.refit_umap
+    )
+    print(f"{len(jobs)} plot job(s) to run on {args.workers} worker(s).")
+
+    if args.workers == 1:
+        for job in jobs:
+            run_plot_job(job, refit=args.refit_umap)
+        return
 
-            emb.plot_umap()
+    num_threads = max(1, (os.cpu_count() or 1) // args.workers)
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_plot_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        futures = [
+            executor.submit(run_plot_job, job, refit=args.refit_umap) for job in jobs
+        ]
+        for future in as_completed(futures):
+            for plot_path in future.result():
+                print(f"wrote {plot_path}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,400 @@
+"""
+Progress of embedding extraction shards, from the heartbeats they write to their status folder.
+
+Each running shard periodically writes <status_folder>/<shard>.heartbeat.json with the
+samples it has completed, its throughput and its ETA. This module reads those heartbeats,
+together with the status files of finished shards, for every (concept, model) pair under a
+root folder:
+
+    python -m embeddings.shard_progress --root_dir data/ --watch 60
+
+reports the progress of each pair, the shards that stopped sending heartbeats (dead) or
+run much slower than the other shards of their pair (stragglers), and the projected
+completion time of the whole extraction. Extractions run by work queue workers report the
+samples of their queue instead.
+"""
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import statistics
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import pandas as pd
+
+from config import OUTPUT_DIR
+from embeddings.work_queue import WorkQueue, get_work_queue_path
+
+# seconds between heartbeats of a running shard
+HEARTBEAT_INTERVAL_SEC = 30
+
+# a running shard whose last heartbeat is older than this is dead
+HEARTBEAT_TIMEOUT_SEC = 20 * HEARTBEAT_INTERVAL_SEC
+
+# shards that do not write heartbeats are considered failed after running for this long
+JOB_HOURS_FAILURE_THRESHOLD = 6
+
+# a running shard is a straggler if its throughput is below this fraction of the median
+# throughput of the running shards of its (concept, model) pair
+STRAGGLER_THROUGHPUT_FRACTION = 0.5
+
+# states of a shard
+DONE = "done"
+FAILED = "failed"
+DEAD = "dead"
+RUNNING = "running"
+NOT_STARTED = "not started"
+
+
+def get_heartbeat_path(status_folder: Path, shard: int) -> Path:
+    return status_folder / f"{shard}.heartbeat.json"
+
+
+class ShardHeartbeat:
+    """Writes the progress of a running shard to its heartbeat file.
+
+    A background thread writes the file once every interval_sec from when the heartbeat is
+    created until finish, so a shard that spends a long time loading its model or on a
+    single sample is not taken for dead. update only records the progress, it is cheap to
+    call after every sample.
+    """
+
+    def __init__(
+        self,
+        status_folder: Path,
+        shard: int,
+        num_samples: int,
+        interval_sec: float = HEARTBEAT_INTERVAL_SEC,
+        **tags,
+    ) -> None:
+        self.path = get_heartbeat_path(status_folder, shard)
+        self.shard = shard
+        self.num_samples = num_samples
+        self.interval_sec = interval_sec
+        self.tags = tags
+        self.started_at = time.time()
+        self.samples_done = 0
+        # samples written by an earlier run of this shard, they do not count towards throughput
+        self.samples_skipped = 0
+        # the writer thread and finish must not write at the same time, or a late heartbeat
+        # could replace the final state
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.write(RUNNING)
+        self._writer = threading.Thread(target=self._write_periodically, daemon=True)
+        self._writer.start()
+
+    def _write_periodically(self) -> None:
+        while not self._stopped.wait(self.interval_sec):
+            self.write(RUNNING)
+
+    def update(self, samples_done: int, samples_skipped: int = 0) -> None:
+        self.samples_done = samples_done
+        self.samples_skipped = samples_skipped
+
+    def finish(self, state: str) -> None:
+        self._stopped.set()
+        self._writer.join()
+        self.write(state)
+
+    def write(self, state: str) -> None:
+        now = time.time()
+        elapsed = now - self.started_at
+        samples_extracted = self.samples_done - self.samples_skipped
+        samples_per_sec = samples_extracted / elapsed if elapsed > 0 else None
+        remaining = self.num_samples - self.samples_done
+        heartbeat = {
+            **self.tags,
+            "shard": self.shard,
+            "state": state,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "updated_at": now,
+            "num_samples": self.num_samples,
+            "samples_done": self.samples_done,
+            "samples_skipped": self.samples_skipped,
+            "samples_per_sec": samples_per_sec,
+            "eta_sec": remaining / samples_per_sec if samples_per_sec else None,
+        }
+        # write to a temporary name and move it into place, so that readers never see a
+        # partially written heartbeat
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with self._lock:
+            try:
+                tmp_path.write_text(json.dumps(heartbeat))
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                # progress reports must never stop the extraction
+                print(f"Could not write heartbeat {self.path}: {e}")
+
+
+def read_heartbeat(status_folder: Path, shard: int) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(get_heartbeat_path(status_folder, shard).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def get_shard_state(
+    status_text: Optional[str],
+    heartbeat: Optional[Dict[str, Any]],
+    now: Optional[float] = None,
+) -> str:
+    """The state of a shard from the text of its status file and its heartbeat."""
+    now = time.time() if now is None else now
+    if status_text is None:
+        return NOT_STARTED
+    if status_text == "done":
+        return DONE
+    if status_text.startswith("failed"):
+        return FAILED
+    if status_text.startswith("in progress"):
+        if heartbeat is not None and heartbeat["started_at"] >= _get_started_at(status_text):
+            # the heartbeat belongs to this run of the shard
+            if now - heartbeat["updated_at"] > HEARTBEAT_TIMEOUT_SEC:
+                return DEAD
+            return RUNNING
+        # shards that do not write heartbeats get a fixed amount of time
+        diff_in_hours = (now - _get_started_at(status_text)) / 3600
+        return DEAD if diff_in_hours > JOB_HOURS_FAILURE_THRESHOLD else RUNNING
+    return NOT_STARTED
+
+
+def _get_started_at(status_text: str) -> float:
+    # "in progress\n<started at>"
+    lines = status_text.splitlines()
+    return float(lines[1]) if len(lines) > 1 else 0.0
+
+
+def _read_text(path: Path) -> Optional[str]:
+    try:
+        return path.read_text()
+    except OSError:
+        return None
+
+
+def get_extraction_progress(
+    dataset_folder: Path, model_config_checksum: str, now: Optional[float] = None
+) -> Dict[str, Any]:
+    """Progress of the shards extracting the embeddings of a dataset with one model config."""
+    now = time.time() if now is None else now
+    dataset_name = dataset_folder.name
+    prefix = f"{dataset_name}_{model_config_checksum}"
+    status_folder = dataset_folder / f"{prefix}_status"
+    model_config_path = dataset_folder / f"{prefix}.json"
+    model_config = json.loads(model_config_path.read_text()) if model_config_path.is_file() else {}
+
+    # the number of samples of each shard, from the embeddings info csv
+    embeddings_info_file = dataset_folder / f"{prefix}_embeddings_info.csv"
+    shard_sizes: Dict[int, int] = {}
+    if embeddings_info_file.is_file():
+        shard_sizes = (
+            pd.read_csv(embeddings_info_file, usecols=["dataset_shard"])["dataset_shard"]
+            .value_counts()
+            .to_dict()
+        )
+    total_shards = int(_read_text(status_folder / "total_shards.txt") or len(shard_sizes))
+
+    shards = []
+    for shard in range(total_shards):
+        status_text = _read_text(status_folder / f"{shard}.txt")
+        heartbeat = read_heartbeat(status_folder, shard)
+        state = get_shard_state(status_text, heartbeat, now)
+        num_samples = shard_sizes.get(shard, heartbeat["num_samples"] if heartbeat else 0)
+        if state == DONE:
+            samples_done = num_samples
+        elif heartbeat is not None:
+            samples_done = heartbeat["samples_done"]
+        else:
+            samples_done = 0
+        shards.append(
+            {
+                "shard": shard,
+                "state": state,
+                "num_samples": num_samples,
+                "samples_done": samples_done,
+                "samples_per_sec": heartbeat["samples_per_sec"] if heartbeat and state == RUNNING else None,
+                "eta_sec": heartbeat["eta_sec"] if heartbeat and state == RUNNING else None,
+                "heartbeat_age_sec": now - heartbeat["updated_at"] if heartbeat else None,
+                "host": heartbeat["host"] if heartbeat else None,
+                "straggler": False,
+            }
+        )
+
+    # stragglers are slow compared to the other running shards of the same model and dataset
+    rates = [s["samples_per_sec"] for s in shards if s["samples_per_sec"]]
+    if len(rates) > 1:
+        median_rate = statistics.median(rates)
+        for s in shards:
+            if s["samples_per_sec"] is not None:
+                s["straggler"] = s["samples_per_sec"] < STRAGGLER_THROUGHPUT_FRACTION * median_rate
+
+    progress = {
+        "dataset": dataset_name,
+        "model_config_checksum": model_config_checksum,
+        "model_name": model_config.get("model_name"),
+        "num_samples": sum(s["num_samples"] for s in shards),
+        "samples_done": sum(s["samples_done"] for s in shards),
+        "samples_per_sec": sum(rates),
+        "shards": shards,
+        "work_queue": None,
+    }
+
+    # workers of a work queue do not run the shards, the queue has their progress
+    work_queue_path = get_work_queue_path(dataset_folder, model_config_checksum)
+    if work_queue_path.is_file():
+        queue = WorkQueue(work_queue_path)
+        work_queue = progress["work_queue"] = queue.progress(now)
+        queue.close()
+        queue_samples = sum(v for k, v in work_queue.items() if k != "samples_per_sec")
+        progress["num_samples"] = max(progress["num_samples"], queue_samples)
+        progress["samples_done"] = max(progress["samples_done"], work_queue["done"])
+        progress["samples_per_sec"] += work_queue["samples_per_sec"]
+
+    return progress
+
+
+def is_extraction_finished(dataset_folder: Path, model_config_checksum: str) -> bool:
+    """Whether every sample of an extraction was written to its zarr.
+
+    The zarr is created at its full shape before the shards start, so its shape does not
+    tell. Extractions without a work queue or status folder, e.g. copied from elsewhere,
+    are taken to be finished.
+    """
+    work_queue_path = get_work_queue_path(dataset_folder, model_config_checksum)
+    if work_queue_path.is_file():
+        queue = WorkQueue(work_queue_path)
+        try:
+            return queue.is_done()
+        finally:
+            queue.close()
+
+    status_folder = dataset_folder / f"{dataset_folder.name}_{model_config_checksum}_status"
+    total_shards = _read_text(status_folder / "total_shards.txt")
+    if total_shards is None:
+        return True
+    return all(
+        get_shard_state(_read_text(status_folder / f"{shard}.txt"), None) == DONE
+        for shard in range(int(total_shards))
+    )
+
+
+def get_campaign_progress(
+    root_dir: Union[str, Path] = OUTPUT_DIR, now: Optional[float] = None
+) -> Dict[str, Any]:
+    """Progress of every extraction under root_dir, i.e. of all (concept, model) pairs.
+
+    The projected completion assumes the current throughput of the running shards holds
+    for the samples that remain.
+    """
+    now = time.time() if now is None else now
+    pairs = []
+    for status_folder in sorted(Path(root_dir).glob("*/*_status")):
+        dataset_folder = status_folder.parent
+        prefix = status_folder.name[: -len("_status")]
+        if not prefix.startswith(f"{dataset_folder.name}_"):
+            continue
+        model_config_checksum = prefix[len(dataset_folder.name) + 1 :]
+        pairs.append(get_extraction_progress(dataset_folder, model_config_checksum, now))
+
+    num_samples = sum(p["num_samples"] for p in pairs)
+    samples_done = sum(p["samples_done"] for p in pairs)
+    samples_per_sec = sum(p["samples_per_sec"] for p in pairs)
+    remaining = num_samples - samples_done
+    if remaining == 0:
+        eta_sec = 0.0
+    elif samples_per_sec > 0:
+        eta_sec = remaining / samples_per_sec
+    else:
+        eta_sec = None
+    return {
+        "time": now,
+        "num_samples": num_samples,
+        "samples_done": samples_done,
+        "samples_per_sec": samples_per_sec,
+        "eta_sec": eta_sec,
+        "projected_completion": now + eta_sec if eta_sec is not None else None,
+        "pairs": pairs,
+    }
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    minutes, _ = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m"
+
+
+def format_campaign_progress(progress: Dict[str, Any]) -> str:
+    lines = [
+        f"{'dataset':<20} {'model':<28} {'done':>6} {'run':>4} {'fail':>4} {'dead':>4} "
+        f"{'samples':>15} {'samples/s':>9} {'eta':>8}"
+    ]
+    problems = []
+    for p in progress["pairs"]:
+        states = [s["state"] for s in p["shards"]]
+        remaining = p["num_samples"] - p["samples_done"]
+        eta = remaining / p["samples_per_sec"] if p["samples_per_sec"] else None
+        lines.append(
+            f"{p['dataset']:<20} {str(p['model_name']):<28} "
+            f"{states.count(DONE):>3}/{len(states):<2} {states.count(RUNNING):>4} "
+            f"{states.count(FAILED):>4} {states.count(DEAD):>4} "
+            f"{p['samples_done']:>7}/{p['num_samples']:<7} {p['samples_per_sec']:>9.2f} "
+            f"{_format_duration(eta if remaining else 0):>8}"
+        )
+        work_queue = p.get("work_queue")
+        if work_queue and (work_queue["expired"] or work_queue["failed"]):
+            problems.append(
+                f"work queue: {p['dataset']} {p['model_name']} has {work_queue['expired']} samples "
+                f"in expired leases and {work_queue['failed']} failed samples"
+            )
+        for s in p["shards"]:
+            if s["state"] == DEAD:
+                problems.append(
+                    f"dead: {p['dataset']} {p['model_name']} shard {s['shard']} on {s['host']}, "
+                    f"last heartbeat {_format_duration(s['heartbeat_age_sec'])} ago"
+                )
+            elif s["straggler"]:
+                problems.append(
+                    f"straggler: {p['dataset']} {p['model_name']} shard {s['shard']} on "
+                    f"{s['host']}, {s['samples_per_sec']:.2f} samples/s"
+                )
+
+    completion = progress["projected_completion"]
+    lines.append("")
+    lines.append(
+        f"{progress['samples_done']} / {progress['num_samples']} samples, "
+        f"{progress['samples_per_sec']:.2f} samples/s, "
+        f"ETA {_format_duration(progress['eta_sec'])}, projected completion "
+        + (
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(completion))
+            if completion is not None
+            else "unknown, no shard is running"
+        )
+    )
+    return "\n".join(lines + problems)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument(
+        "--watch", type=float, default=None, help="Report again every this many seconds"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the progress as JSON")
+    args = parser.parse_args()
+
+    while True:
+        progress = get_campaign_progress(args.root_dir)
+        if args.json:
+            print(json.dumps(progress))
+        else:
+            print(format_campaign_progress(progress))
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
@@ -0,0 +1,193 @@
+"""
+A work queue of sample ranges for embedding extraction workers, in a SQLite file in the dataset folder.
+
+Instead of a fixed shard per job, workers claim leases on small ranges of zarr indices,
+renew them while they work and mark them done. A lease that is not renewed expires and is
+claimed by the next worker that asks for work, so the work of a slow or dead job is picked
+up by the others and fast nodes process more of the dataset.
+
+SQLite locks the file for each claim, which works on local disks and on shared file systems
+with working POSIX locks. Claims and renewals are short transactions, a worker holds no
+lock while it extracts.
+"""
+import os
+import time
+import socket
+import sqlite3
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+# samples per lease, small enough that leases spread evenly over workers
+WORK_QUEUE_LEASE_SIZE = 32
+
+# a lease that is not renewed for this long is given to another worker
+WORK_QUEUE_LEASE_SEC = 600
+
+# a range whose extraction failed or whose workers died this many times is not retried
+WORK_QUEUE_MAX_ATTEMPTS = 3
+
+# completed leases in this window give the current throughput of the queue
+WORK_QUEUE_THROUGHPUT_WINDOW_SEC = 600
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def get_work_queue_path(dataset_folder: Path, model_config_checksum: str) -> Path:
+    return dataset_folder / f"{dataset_folder.name}_{model_config_checksum}_work_queue.sqlite"
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Leases on ranges [start, stop) of the samples of a dataset, stored in SQLite."""
+
+    def __init__(self, path: Union[str, Path], timeout_sec: float = 60.0) -> None:
+        self.path = Path(path)
+        # transactions are started explicitly, see _transaction
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=timeout_sec, isolation_level=None
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                start INTEGER PRIMARY KEY,
+                stop INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                expires_at REAL,
+                completed_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+
+    @classmethod
+    def create(
+        cls,
+        path: Union[str, Path],
+        num_samples: int,
+        lease_size: int = WORK_QUEUE_LEASE_SIZE,
+    ) -> "WorkQueue":
+        """The queue at path, filled with the ranges of num_samples if it is new."""
+        queue = cls(path)
+        with queue._transaction():
+            if queue._conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0] == 0:
+                queue._conn.executemany(
+                    "INSERT INTO leases (start, stop, state) VALUES (?, ?, ?)",
+                    [
+                        (start, min(start + lease_size, num_samples), PENDING)
+                        for start in range(0, num_samples, lease_size)
+                    ],
+                )
+        return queue
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # take the write lock up front, so that two workers never claim the same lease
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def claim(
+        self, worker: str, lease_sec: float = WORK_QUEUE_LEASE_SEC
+    ) -> Optional[Tuple[int, int]]:
+        """Lease the next range that is pending or whose lease expired, None if there is none."""
+        now = time.time()
+        with self._transaction():
+            # the workers of these ranges keep dying, e.g. because they run out of memory
+            self._conn.execute(
+                "UPDATE leases SET state = ? WHERE state = ? AND expires_at < ? AND attempts >= ?",
+                (FAILED, LEASED, now, WORK_QUEUE_MAX_ATTEMPTS),
+            )
+            row = self._conn.execute(
+                """
+                SELECT start, stop FROM leases
+                WHERE state = ? OR (state = ? AND expires_at < ?)
+                ORDER BY start LIMIT 1
+                """,
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                """
+                UPDATE leases SET state = ?, worker = ?, expires_at = ?, attempts = attempts + 1
+                WHERE start = ?
+                """,
+                (LEASED, worker, now + lease_sec, row[0]),
+            )
+        return row[0], row[1]
+
+    def renew(self, start: int, worker: str, lease_sec: float = WORK_QUEUE_LEASE_SEC) -> bool:
+        """Extend a lease. False if the worker lost it, e.g. because it expired and was claimed."""
+        with self._transaction():
+            cursor = self._conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE start = ? AND state = ? AND worker = ?",
+                (time.time() + lease_sec, start, LEASED, worker),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, start: int, worker: str) -> None:
+        # a worker that lost its lease still wrote the range, the same values as the new owner
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE leases SET state = ?, worker = ?, completed_at = ? WHERE start = ?",
+                (DONE, worker, time.time(), start),
+            )
+
+    def release(self, start: int, worker: str) -> None:
+        """Give a lease back after an error, so that another worker can retry it."""
+        with self._transaction():
+            self._conn.execute(
+                """
+                UPDATE leases SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, expires_at = NULL
+                WHERE start = ? AND state = ? AND worker = ?
+                """,
+                (WORK_QUEUE_MAX_ATTEMPTS, FAILED, PENDING, start, LEASED, worker),
+            )
+
+    def retry_failed(self) -> List[Tuple[int, int]]:
+        """Make the failed ranges pending again, with a fresh number of attempts."""
+        with self._transaction():
+            failed = self._conn.execute(
+                "SELECT start, stop FROM leases WHERE state = ? ORDER BY start", (FAILED,)
+            ).fetchall()
+            self._conn.execute(
+                "UPDATE leases SET state = ?, attempts = 0 WHERE state = ?", (PENDING, FAILED)
+            )
+        return failed
+
+    def progress(self, now: Optional[float] = None) -> Dict[str, float]:
+        """Samples per lease state, and the throughput of the recently completed leases."""
+        now = time.time() if now is None else now
+        progress = {PENDING: 0, LEASED: 0, "expired": 0, FAILED: 0, DONE: 0}
+        rows = self._conn.execute(
+            "SELECT state, expires_at < ?, SUM(stop - start) FROM leases GROUP BY 1, 2",
+            (now,),
+        ).fetchall()
+        for state, expired, num_samples in rows:
+            progress["expired" if state == LEASED and expired else state] += num_samples
+        recent = self._conn.execute(
+            "SELECT SUM(stop - start) FROM leases WHERE state = ? AND completed_at >= ?",
+            (DONE, now - WORK_QUEUE_THROUGHPUT_WINDOW_SEC),
+        ).fetchone()[0]
+        progress["samples_per_sec"] = (recent or 0) / WORK_QUEUE_THROUGHPUT_WINDOW_SEC
+        return progress
+
+    def is_done(self) -> bool:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM leases WHERE state != ?", (DONE,)
+        ).fetchone()[0] == 0
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,282 @@
+"""
+Lightweight timing and resource instrumentation of the stages of the pipeline.
+
+    from instrumentation import span, count, emit, timed
+
+    @timed("trim")
+    def trim(...):
+        ...
+
+    with span("synth"):
+        produce_synth_wav_from_midi(midi_file_path, synth_file_path)
+    count("samples")
+    ...
+    emit("dataset_writer", dataset_name="notes")
+
+Each process records the durations of its spans in histograms with power of two buckets,
+so recording is a few integer operations and memory does not grow with the number of
+spans. emit writes a summary of the histograms (count, total, quantiles), the counters and
+the peak RSS of the process as one JSON record, then starts over. Worker processes hand
+their recordings to the parent with drain, which adds them with merge.
+
+Records are appended to the JSON lines file at $SYNTHEORY_INSTRUMENTATION_LOG if it is
+set, otherwise they are logged to the "instrumentation" logger at INFO level. Set
+SYNTHEORY_INSTRUMENTATION=0 to turn recording off.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # not available on Windows, peak RSS is not reported there
+    resource = None
+
+INSTRUMENTATION_ENV_VAR = "SYNTHEORY_INSTRUMENTATION"
+INSTRUMENTATION_LOG_ENV_VAR = "SYNTHEORY_INSTRUMENTATION_LOG"
+
+# durations are bucketed by powers of two of microseconds, the last bucket holds
+# everything longer than ~35 minutes
+NUM_BUCKETS = 32
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+logger = logging.getLogger("instrumentation")
+
+_NULL_SPAN = nullcontext()
+
+
+def get_peak_rss_bytes() -> Optional[int]:
+    if resource is None:  # pragma: no cover
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class Histogram:
+    """Counts of durations in power of two buckets, with their exact total, min and max."""
+
+    __slots__ = ("buckets", "count", "total_ns", "min_ns", "max_ns")
+
+    def __init__(self) -> None:
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    @staticmethod
+    def bucket(duration_ns: int) -> int:
+        # bucket i holds durations below 2^i microseconds
+        return min((duration_ns >> 10).bit_length(), NUM_BUCKETS - 1)
+
+    def record(self, duration_ns: int) -> None:
+        self.buckets[self.bucket(duration_ns)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if self.min_ns is None or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the q-th quantile, in nanoseconds."""
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min((1 << i) << 10, self.max_ns)
+        return self.max_ns
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            # only the buckets that were used, keyed by their index
+            "buckets": {i: n for i, n in enumerate(self.buckets) if n},
+            "count": self.count,
+            "total_ns": self.total_ns,
+            "min_ns": self.min_ns,
+            "max_ns": self.max_ns,
+        }
+
+    def merge(self, other: Dict[str, Any]) -> None:
+        for i, n in other["buckets"].items():
+            self.buckets[int(i)] += n
+        self.count += other["count"]
+        self.total_ns += other["total_ns"]
+        if other["min_ns"] is not None and (
+            self.min_ns is None or other["min_ns"] < self.min_ns
+        ):
+            self.min_ns = other["min_ns"]
+        self.max_ns = max(self.max_ns, other["max_ns"])
+
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "count": self.count,
+            "total_sec": self.total_ns / 1e9,
+            "mean_ms": self.total_ns / self.count / 1e6 if self.count else None,
+            "min_ms": self.min_ns / 1e6 if self.min_ns is not None else None,
+            "max_ms": self.max_ns / 1e6,
+        }
+        for q in QUANTILES:
+            summary[f"p{int(q * 100)}_ms"] = self.quantile(q) / 1e6
+        return summary
+
+
+class _Span:
+    __slots__ = ("recorder", "name", "start_ns")
+
+    def __init__(self, recorder: "Recorder", name: str) -> None:
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self) -> "_Span":
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.recorder.record(self.name, time.perf_counter_ns() - self.start_ns)
+
+
+class Recorder:
+    """The span histograms and counters of a process."""
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms: Dict[str, Histogram] = {}
+            self.counters: Dict[str, int] = {}
+            # peak RSS of the processes whose recordings were merged into this one
+            self.merged_peak_rss_bytes: Optional[int] = None
+
+    def span(self, name: str):
+        """Context manager that records the time spent in it under name."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name: str, duration_ns: int) -> None:
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(duration_ns)
+
+    def count(self, name: str, n: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def peak_rss_bytes(self) -> Optional[int]:
+        peak_rss = get_peak_rss_bytes()
+        if self.merged_peak_rss_bytes is None:
+            return peak_rss
+        return max(peak_rss or 0, self.merged_peak_rss_bytes)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The recording so far, as plain data that can be sent to another process."""
+        with self._lock:
+            return {
+                "spans": {k: h.to_dict() for k, h in self.histograms.items()},
+                "counters": dict(self.counters),
+                "peak_rss_bytes": self.peak_rss_bytes(),
+            }
+
+    def drain(self) -> Optional[Dict[str, Any]]:
+        """The recording so far, which is then cleared. None if recording is off."""
+        if not self.enabled:
+            return None
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot: Optional[Dict[str, Any]]) -> None:
+        """Adds a recording of another process to this one."""
+        if snapshot is None or not self.enabled:
+            return
+        with self._lock:
+            for name, other in snapshot["spans"].items():
+                self.histograms.setdefault(name, Histogram()).merge(other)
+            for name, n in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            if snapshot["peak_rss_bytes"] is not None:
+                self.merged_peak_rss_bytes = max(
+                    self.merged_peak_rss_bytes or 0, snapshot["peak_rss_bytes"]
+                )
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "spans": {k: h.summary() for k, h in sorted(self.histograms.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "peak_rss_bytes": self.peak_rss_bytes(),
+            }
+
+    def emit(self, event: str, **tags) -> Optional[Dict[str, Any]]:
+        """Writes the summary of the recording to the structured log, then clears it."""
+        if not self.enabled:
+            return None
+        record = {
+            "event": event,
+            "time": time.time(),
+            "pid": os.getpid(),
+            **tags,
+            **self.summary(),
+        }
+        self.reset()
+        line = json.dumps(record, default=str)
+
+        log_path = os.environ.get(INSTRUMENTATION_LOG_ENV_VAR)
+        if log_path:
+            # one short write per record, so records of concurrent processes do not mix
+            with open(log_path, "a") as f:
+                f.write(line + "\n")
+        else:
+            logger.info(line)
+        return record
+
+
+_RECORDER = Recorder(enabled=os.environ.get(INSTRUMENTATION_ENV_VAR, "1") != "0")
+
+
+def get_recorder() -> Recorder:
+    return _RECORDER
+
+
+def span(name: str):
+    return _RECORDER.span(name)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """Decorator that records each call of a function as a span."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _RECORDER.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, n: int = 1) -> None:
+    _RECORDER.count(name, n)
+
+
+def emit(event: str, **tags) -> Optional[Dict[str, Any]]:
+    return _RECORDER.emit(event, **tags)
@@ -0,0 +1,134 @@
+import os
+import tempfile
+from pathlib import Path
+from os import environ as os_env
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from embeddings.config_checksum import compute_checksum
+
+# -- node-local cache shared by every probe run on this machine --
+if "SYNTHEORY_EMBEDDING_CACHE_DIR" in os_env:
+    EMBEDDING_CACHE_DIR = Path(os_env["SYNTHEORY_EMBEDDING_CACHE_DIR"])
+else:
+    EMBEDDING_CACHE_DIR = Path(tempfile.gettempdir(), "syntheory_embedding_cache")
+
+# the least recently used splits are deleted when the cache grows past this size
+EMBEDDING_CACHE_MAX_BYTES = int(
+    float(os_env.get("SYNTHEORY_EMBEDDING_CACHE_MAX_GB", 20)) * 1024**3
+)
+
+SPLIT_NAMES = ("train", "valid", "test")
+
+
+class EmbeddingCache:
+    """Node-local cache of the per-split embedding arrays that probes train on.
+
+    The first probe run for a given (embeddings, layer, split seed) writes the float32 split
+    arrays as .npy files; subsequent runs memory map them read-only. All runs on a node then
+    share a single copy of the data through the page cache, instead of each one re-reading
+    and re-slicing the zarr.
+
+    The cache holds at most max_bytes of splits, the splits of the least recently used keys
+    are deleted to make room for new ones. Runs that memory mapped a deleted file keep
+    reading it until they close it.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = EMBEDDING_CACHE_DIR,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def get_key(
+        self,
+        embeddings_zarr_filepath: Union[str, Path],
+        model_layer: int,
+        seed: Optional[int],
+        **split_settings: Any,
+    ) -> str:
+        """Key of the cached splits, given the embeddings and everything that determines the split."""
+        zarr_path = Path(embeddings_zarr_filepath).resolve()
+        key_info = {
+            "zarr_filepath": str(zarr_path),
+            # invalidate the cache if the embeddings are rewritten
+            "zarr_mtime_ns": zarr_path.stat().st_mtime_ns,
+            "model_layer": model_layer,
+            "seed": seed,
+            **{k: str(v) for k, v in split_settings.items()},
+        }
+        return compute_checksum(key_info, algorithm="sha1")
+
+    def _get_path(self, key: str, split_name: str) -> Path:
+        return self.cache_dir / f"{key}_{split_name}.npy"
+
+    def load(
+        self, key: str, split_names: Iterable[str] = SPLIT_NAMES
+    ) -> Optional[Dict[str, np.ndarray]]:
+        """Memory map the cached splits. Returns None unless every split is cached."""
+        paths = {split_name: self._get_path(key, split_name) for split_name in split_names}
+        if not all(p.is_file() for p in paths.values()):
+            return None
+        try:
+            # mark the key as recently used, see evict
+            for p in paths.values():
+                os.utime(p)
+        except FileNotFoundError:
+            # evicted by another run
+            return None
+        return {
+            split_name: np.load(p, mmap_mode="r") for split_name, p in paths.items()
+        }
+
+    def save(self, key: str, split_to_X: Dict[str, np.ndarray]) -> None:
+        """Write the splits to the cache, unless they alone are larger than the cache.
+
+        Each file is written to a temporary name and moved into place, so concurrent runs that
+        populate the same key at once never read a partially written array.
+        """
+        num_bytes = sum(
+            np.asarray(X).size * np.dtype(np.float32).itemsize for X in split_to_X.values()
+        )
+        if num_bytes > self.max_bytes:
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for split_name, X in split_to_X.items():
+            path = self._get_path(key, split_name)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(X, dtype=np.float32))
+            os.replace(tmp_path, path)
+
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Delete the splits of the least recently used keys until the cache fits in max_bytes."""
+        key_to_files: Dict[str, List[Tuple[Path, os.stat_result]]] = {}
+        for path in self.cache_dir.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # evicted by another run
+                continue
+            key = path.stem.rsplit("_", 1)[0]
+            key_to_files.setdefault(key, []).append((path, stat))
+
+        total_bytes = sum(
+            stat.st_size for files in key_to_files.values() for _, stat in files
+        )
+        least_recently_used = sorted(
+            key_to_files,
+            key=lambda k: max(stat.st_mtime_ns for _, stat in key_to_files[k]),
+        )
+        for key in least_recently_used:
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path, stat in key_to_files[key]:
+                path.unlink(missing_ok=True)
+                total_bytes -= stat.st_size
@@ -0,0 +1,213 @@
+"""
+Run a grid sweep of SWEEP_CONFIGS on local worker processes, without wandb or SLURM.
+"""
+import math
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config import OUTPUT_DIR
+from embeddings.config_checksum import compute_checksum
+from probe.embedding_cache import EmbeddingCache
+from probe.main import get_probe_config, start, start_many
+from probe.metrics_sink import JsonlSink
+from probe.probe_config import SWEEP_CONFIGS, expand_sweep_config
+from probe.probes import CACHE_PROBES_DIR
+from probe.result_store import ProbeResultStore
+
+# configs that probe the same embeddings, a worker loads their data once
+GROUP_BY = ("concept", "model_type", "model_size", "model_layer")
+
+# aim for at least this many work units per worker, so that workers that finish early
+# can take over the remaining work
+WORK_UNITS_PER_WORKER = 4
+
+# shared by the sweep configs that run in a worker process
+_EMBEDDING_CACHE: Optional[EmbeddingCache] = None
+
+
+def is_done(
+    sweep_config: Dict[str, Any], finished_uids: Set[str], random_seed: int = 0
+) -> bool:
+    """Whether a sweep config already has a result, known without loading any data."""
+    if sweep_config["model_layer"] == "all":
+        # the number of layers is only known once the embeddings are found, start checks
+        # these configs itself before it loads the data
+        return False
+    cfg = get_probe_config(SimpleNamespace(**sweep_config), random_seed)
+    return cfg.uid() in finished_uids
+
+
+def group_sweep_configs(
+    sweep_configs: List[Dict[str, Any]], max_group_size: Optional[int] = None
+) -> List[List[Dict[str, Any]]]:
+    """Work units of sweep configs that probe the same embeddings, largest first.
+
+    Groups larger than max_group_size are split, trading a repeated data load for work
+    units that can be spread over more workers.
+    """
+    groups: Dict[Tuple[Any, ...], List[Dict[str, Any]]] = {}
+    for sweep_config in sweep_configs:
+        key = tuple(sweep_config[k] for k in GROUP_BY)
+        groups.setdefault(key, []).append(sweep_config)
+
+    work_units = []
+    for group in groups.values():
+        size = max_group_size or len(group)
+        work_units.extend(group[i : i + size] for i in range(0, len(group), size))
+
+    # the largest units start first and the small ones fill in at the end of the sweep
+    return sorted(work_units, key=len, reverse=True)
+
+
+def run_sweep_configs(
+    sweep_configs: List[Dict[str, Any]],
+    metrics_dir: Path,
+    result_store_dir: Path,
+    random_seed: int = 0,
+    base_path_parent: Path = OUTPUT_DIR,
+) -> List[Tuple[Dict[str, Any], Optional[str]]]:
+    """Train the probes of a work unit, in one process so they share loaded data.
+
+    Compatible configs are trained together, see start_many. The metrics of each config are
+    written to <metrics_dir>/<run>.jsonl, where the run is named by the checksum of the sweep
+    config. Returns each config with its error, if the run failed. A failed config does not
+    stop the others.
+    """
+    global _EMBEDDING_CACHE
+    if _EMBEDDING_CACHE is None:
+        _EMBEDDING_CACHE = EmbeddingCache()
+
+    result_store = ProbeResultStore(result_store_dir)
+    run_kwargs = dict(
+        random_seed=random_seed,
+        base_path_parent=base_path_parent,
+        embedding_cache=_EMBEDDING_CACHE,
+        result_store=result_store,
+    )
+    sinks = [
+        JsonlSink(metrics_dir / f"{compute_checksum(c)}.jsonl", tags=c)
+        for c in sweep_configs
+    ]
+    try:
+        try:
+            start_many(sweep_configs, sinks, **run_kwargs)
+            errors = [None] * len(sweep_configs)
+        except Exception:
+            traceback.print_exc()
+            # run the configs the batched run did not finish one at a time, so that only the
+            # configs that fail report an error
+            finished_uids = result_store.uids()
+            errors = []
+            for sweep_config, sink in zip(sweep_configs, sinks):
+                if is_done(sweep_config, finished_uids, random_seed):
+                    errors.append(None)
+                    continue
+                # the metrics file of a run holds one curve, not the partial one of the batch
+                sink.discard()
+                errors.append(_run_sweep_config(sweep_config, sink, run_kwargs))
+    finally:
+        for sink in sinks:
+            sink.close()
+    return list(zip(sweep_configs, errors))
+
+
+def _run_sweep_config(
+    sweep_config: Dict[str, Any], sink: JsonlSink, run_kwargs: Dict[str, Any]
+) -> Optional[str]:
+    try:
+        start(use_wandb=False, sweep_config=sweep_config, metrics_sink=sink, **run_kwargs)
+    except Exception as e:
+        sink.log({"error": str(e), "traceback": traceback.format_exc()})
+        return str(e)
+    return None
+
+
+def run_local_sweep(
+    sweep_config_name: str,
+    metrics_dir: Path,
+    num_workers: int = 1,
+    random_seed: int = 0,
+    base_path_parent: Path = OUTPUT_DIR,
+    result_store_dir: Path = CACHE_PROBES_DIR,
+) -> List[Tuple[Dict[str, Any], str]]:
+    """Run every config of a grid sweep that does not have a result yet.
+
+    Results are recorded in the result store as configs finish, so an interrupted sweep
+    resumes where it stopped when it is run again. Work units are handed to the workers
+    as they become free. Returns the configs that failed, with their errors.
+    """
+    sweep_configs = expand_sweep_config(sweep_config_name)
+    finished_uids = ProbeResultStore(result_store_dir).uids()
+    pending = [c for c in sweep_configs if not is_done(c, finished_uids, random_seed)]
+    print(
+        f"{len(sweep_configs) - len(pending)} of {len(sweep_configs)} configs of "
+        f"{sweep_config_name} are done, running {len(pending)} on {num_workers} worker(s)."
+    )
+    if not pending:
+        return []
+
+    max_group_size = math.ceil(len(pending) / (num_workers * WORK_UNITS_PER_WORKER))
+    work_units = group_sweep_configs(pending, max_group_size)
+    run_kwargs = dict(
+        metrics_dir=metrics_dir / sweep_config_name,
+        result_store_dir=result_store_dir,
+        random_seed=random_seed,
+        base_path_parent=base_path_parent,
+    )
+
+    failures = []
+    num_finished = 0
+
+    def _report(results) -> None:
+        nonlocal num_finished
+        for sweep_config, error in results:
+            num_finished += 1
+            if error is not None:
+                print(f"Failed: {sweep_config}: {error}")
+                failures.append((sweep_config, error))
+        print(f"Finished {num_finished} / {len(pending)} configs.")
+
+    if num_workers == 1:
+        for work_unit in work_units:
+            _report(run_sweep_configs(work_unit, **run_kwargs))
+        return failures
+
+    # workers must not inherit the CUDA state of this process
+    with ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(run_sweep_configs, work_unit, **run_kwargs)
+            for work_unit in work_units
+        ]
+        for future in as_completed(futures):
+            _report(future.result())
+    return failures
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep_config", type=str, default="jukebox")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--metrics_dir", type=Path, default=OUTPUT_DIR / "probe_metrics")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.sweep_config not in SWEEP_CONFIGS:
+        raise ValueError(
+            f"Unknown Sweep Configuration Given - Got: {args.sweep_config}"
+        )
+
+    failures = run_local_sweep(
+        args.sweep_config,
+        args.metrics_dir,
+        num_workers=args.workers,
+        random_seed=args.seed,
+    )
+    if failures:
+        raise SystemExit(f"{len(failures)} config(s) failed, run again to retry them.")
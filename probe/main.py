@@ -1,17 +1,44 @@
 import os
+import functools
 import traceback
 import argparse
 from pathlib import Path
-from json import loads
+from types import SimpleNamespace
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
-import zarr
 import wandb
 
 from config import OUTPUT_DIR
-from probe.probes import ProbeExperiment, ProbeExperimentConfig
+from embeddings.catalog import EmbeddingsCatalog
+from probe.probes import (
+    CACHE_PROBES_DIR,
+    LayerwiseProbeExperiment,
+    ProbeExperiment,
+    ProbeExperimentConfig,
+    train_probes_batched,
+)
+from probe.embedding_cache import EmbeddingCache
+from probe.metrics_sink import MetricsSink, get_metrics_sink
+from probe.result_store import ProbeResultStore
 from probe.probe_config import CONCEPT_LABELS, CONDS
 
 
+# the data loaded most recently in this process, see ProbeExperiment.get_data. When many
+# configs run in one process (--count), consecutive configs that probe the same embeddings
+# reuse it. Only the data is kept, not the probe and metrics of the run that loaded it.
+_LOADED_DATA: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+
+
+def get_dataset_labels_path(concept_name: str, base_path_parent: Path = OUTPUT_DIR) -> Path:
+    base_path = base_path_parent / concept_name
+
+    # TODO: fix so that we can do both text and audio
+    if "text" in CONDS:
+        return base_path / "prompts.csv"
+    elif "audio" in CONDS:
+        return base_path / "info.csv"
+
+
 def get_all_embedding_exports(
     concept_name: str,
     base_path_parent: Path = OUTPUT_DIR,
@@ -23,63 +50,13 @@ def get_all_embedding_exports(
     - model size [S | M | L]
     - model layer [1 ... n]
 
+    They are listed in the embeddings catalog of the concept.
     """
-    base_path = base_path_parent / concept_name
-
-    # TODO: fix so that we can do both text and audio
-    if "text" in CONDS:
-        dataset_info = base_path / "prompts.csv"
-    elif "audio" in CONDS:
-        dataset_info = base_path / "info.csv"
-    zarr_files = list(base_path.glob("*.zarr"))
-    model_embeddings_infos = []
-    for z in zarr_files:
-        f_name = z.parts[-1]
-
-        if not f_name.startswith(concept_name):
-            # expect embeddings arrays to be prefixed with the concept name
-            continue
-
-        # get the settings associated with the model that produced these embeddings
-        model_hash = f_name.split(".zarr")[0].split("_")[-1]
-        model_settings_path = base_path / (concept_name + "_" + model_hash + ".json")
-        model_settings = loads(model_settings_path.read_text())
-
-        emb = zarr.open(z)
-
-        model_name = model_settings["model_name"]
-        if model_name == "JUKEBOX":
-            model_size = "L"
-            model_type = "JUKEBOX"
-        elif "MUSICGEN_DECODER" in model_name:
-            model_size = model_name.split("_LM_")[-1]
-            model_type = "MUSICGEN_DECODER"
-        elif "MUSICGEN_AUDIO_ENCODER" in model_name:
-            model_size = "L"
-            model_type = "MUSICGEN_AUDIO_ENCODER"
-        elif "MUSICGEN_TEXT_ENCODER" in model_name:
-            model_size = "L"
-            model_type = "MUSICGEN_TEXT_ENCODER"
-        elif "BERT" in model_name:
-            model_size = "L"
-            model_type = "BERT"
-        else:
-            # handcrafted features, default to L
-            model_size = "L"
-            model_type = model_settings["model_name"]
-
-        exp_info = {
-            "zarr_filepath": z,
-            "dataset_labels_path": dataset_info,
-            "embeddings_dataset_shape": emb.shape,
-            "model_hash": model_hash,
-            "model_settings": model_settings,
-            "model_size": model_size,
-            "model_type": model_type,
-        }
-        model_embeddings_infos.append(exp_info)
-
-    return model_embeddings_infos
+    dataset_info = get_dataset_labels_path(concept_name, base_path_parent)
+    return [
+        {**e, "dataset_labels_path": dataset_info}
+        for e in EmbeddingsCatalog.load(base_path_parent / concept_name)
+    ]
 
 
 def _set_attr_if_exists(probe_config, hparams, attr_name, default=None):
@@ -88,41 +65,31 @@ def _set_attr_if_exists(probe_config, hparams, attr_name, default=None):
         hparams[attr_name] = x
 
 
-def _is_equal_model_types(mt_a: str, mt_b: str) -> bool:
-    # in some configs we neglected the "LM" suffix. Consider
-    # "MUSICGEN_DECODER_LM" to be equal to "MUSICGEN_DECODER"
-    if mt_a.startswith("MUSICGEN_DECODER") and mt_b.startswith("MUSICGEN_DECODER"):
-        return mt_a.split("_LM")[0] == mt_b.split("_LM")[0]
-
-    return mt_a == mt_b
-
+def get_output_type(concept: str) -> str:
+    # can be: 'multiclass' or 'regression'
+    return "regression" if concept == "tempos" else "multiclass"
 
-def start(
-    use_wandb: bool = True, random_seed: int = 0, base_path_parent: Path = OUTPUT_DIR
-) -> ProbeExperiment:
-    # the sweep configuration will exist in this object, use it to get the
-    # dataset and experiment configuration
-    probe_config = wandb.config
 
-    # model type: [ JUKEBOX | MUSICGEN_DECODER | MUSICGEN_AUDIO_ENCODER | MUSICGEN_TEXT_ENCODER | BERT | MFCC | CHROMA | MELSPEC | HANDCRAFT ]
-    model_type = probe_config.model_type
-    # model size: [S | M | L]
-    model_size = probe_config.model_size
-    # model layer: [0, ... 71]
-    model_layer = probe_config.model_layer
-    # concept: [notes, tempos, time_signatures, etc. ] + a specific label
+def get_probe_config_kwargs(probe_config, random_seed: int = 0) -> Dict[str, Any]:
+    """Settings of the ProbeExperimentConfig of a sweep config, all but the model_hash."""
     concept = probe_config.concept
-
     num_classes = getattr(probe_config, "num_classes", None)
 
     # set hyperparameters
     hparams = {}
     _set_attr_if_exists(probe_config, hparams, "data_standardization")
+    _set_attr_if_exists(probe_config, hparams, "precompute_standardization")
     _set_attr_if_exists(probe_config, hparams, "batch_size")
     _set_attr_if_exists(probe_config, hparams, "learning_rate")
     _set_attr_if_exists(probe_config, hparams, "dropout_p")
     _set_attr_if_exists(probe_config, hparams, "l2_weight_decay")
+    _set_attr_if_exists(probe_config, hparams, "early_stopping_eval_frequency")
+    _set_attr_if_exists(probe_config, hparams, "early_stopping_boredom")
     _set_attr_if_exists(probe_config, hparams, "hidden_layer_sizes", [512])
+    _set_attr_if_exists(probe_config, hparams, "solver")
+    if hparams["hidden_layer_sizes"]:
+        # only linear probes can be fit with the convex solver
+        hparams.pop("solver", None)
 
     # get the concept label that is given by parent concept and the target we wish to probe
     dataset_settings = CONCEPT_LABELS[concept][0]
@@ -130,85 +97,327 @@ def start(
 
     # allow override of number of classes if given in config directly
     num_classes = num_classes or _num_classes
-    concept_parent_name = concept
-
-    # look up the correct location for the embeddings given experiment config
-    exp_info = None
-    for e in get_all_embedding_exports(concept_parent_name, base_path_parent):
-        if (
-            e["model_size"] == model_size
-            and _is_equal_model_types(e["model_type"], model_type)
-            # shape is (all samples, layer, embedding dimension)
-            and e["embeddings_dataset_shape"][1] > model_layer
-        ):
-            exp_info = e
+    num_outputs = 1 if get_output_type(concept) == "regression" else num_classes
 
-    if exp_info is None:
-        print(
-            "There is no dataset corresponding to the config specified in the sweep."
-        )
-        # nothing to do if a configuration for this does not exist. This might happen if
-        # we try to run a probe for S or M models of JUKEBOX or for larger layers of
-        # MUSICGEN that do not exist. Return nothing instead of throwing an error to treat it
-        # as a noop instead of a job failure.
-        return
-
-    is_regression = concept_parent_name == "tempos"
-    num_outputs = 1 if is_regression else num_classes
-    # can be: 'multiclass' or 'regression'
-    output_type = "regression" if is_regression else "multiclass"
-
-    # 12
-    wandb.config["num_outputs"] = num_outputs
-    # multiclass
-    wandb.config["output_type"] = output_type
-    # root note pitch class
-    wandb.config["label_column_name"] = label_column_name
-
-    cfg = ProbeExperimentConfig(
+    return dict(
         dataset_embeddings_label_column_name=label_column_name,
         dataset=concept,
         num_outputs=num_outputs,
-        model_hash=f"{model_type}-{model_size}-{model_layer}",
         max_num_epochs=100,
         **hparams,
         seed=random_seed,
         # intervals and chord progressions are too large to fit in ram, for all others
         # we can load into memory, but for those we need to load off disk as we train.
         load_embeddings_in_memory=(
-            concept_parent_name not in ("intervals", "chord_progressions")
+            concept not in ("intervals", "chord_progressions")
         ),
     )
 
+
+def get_probe_config(
+    probe_config, random_seed: int = 0, model_layer: Optional[int] = None
+) -> ProbeExperimentConfig:
+    """The ProbeExperimentConfig that a sweep config trains, for the given layer if set."""
+    if model_layer is None:
+        model_layer = probe_config.model_layer
+    return ProbeExperimentConfig(
+        model_hash=f"{probe_config.model_type}-{probe_config.model_size}-{model_layer}",
+        **get_probe_config_kwargs(probe_config, random_seed),
+    )
+
+
+def start(
+    use_wandb: bool = True,
+    random_seed: int = 0,
+    base_path_parent: Path = OUTPUT_DIR,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    result_store: Optional[ProbeResultStore] = None,
+    sweep_config: Optional[Mapping[str, Any]] = None,
+    metrics_sink: Optional[MetricsSink] = None,
+) -> ProbeExperiment:
+    """Train the probe of the given sweep config, or of the one in wandb.config.
+
+    If a result store is given, configs that already finished are skipped before any data
+    is loaded, and the result of a new run is saved to it. Metrics go to the given sink, by
+    default to wandb if use_wandb is set.
+    """
+    # the sweep configuration will exist in this object, use it to get the
+    # dataset and experiment configuration
+    if sweep_config is None:
+        probe_config = wandb.config
+    else:
+        probe_config = SimpleNamespace(**sweep_config)
+    metrics_sink = get_metrics_sink(use_wandb, metrics_sink)
+
+    # model type: [ JUKEBOX | MUSICGEN_DECODER | MUSICGEN_AUDIO_ENCODER | MUSICGEN_TEXT_ENCODER | BERT | MFCC | CHROMA | MELSPEC | HANDCRAFT ]
+    model_type = probe_config.model_type
+    # model size: [S | M | L]
+    model_size = probe_config.model_size
+    # model layer: [0, ... 71], or "all" to probe every layer of the model at once
+    model_layer = probe_config.model_layer
+    probe_all_layers = model_layer == "all"
+    # concept: [notes, tempos, time_signatures, etc. ] + a specific label
+    concept = probe_config.concept
+
+    # look up the correct location for the embeddings given experiment config
+    exp_info = _find_embeddings(probe_config, base_path_parent)
+    if exp_info is None:
+        return
+
+    cfg_kwargs = get_probe_config_kwargs(probe_config, random_seed)
+    label_column_name = cfg_kwargs["dataset_embeddings_label_column_name"]
+    num_outputs = cfg_kwargs["num_outputs"]
+    output_type = get_output_type(concept)
+
+    if sweep_config is None:
+        # 12
+        wandb.config["num_outputs"] = num_outputs
+        # multiclass
+        wandb.config["output_type"] = output_type
+        # root note pitch class
+        wandb.config["label_column_name"] = label_column_name
+
+    if probe_all_layers:
+        num_layers = exp_info["embeddings_dataset_shape"][1]
+        cfgs = [
+            get_probe_config(probe_config, random_seed, model_layer=layer)
+            for layer in range(num_layers)
+        ]
+        if _is_done(cfgs, result_store, metrics_sink):
+            return
+        return _train_all_layers(
+            cfgs,
+            exp_info,
+            label_column_name,
+            output_type,
+            model_type,
+            metrics_sink,
+            embedding_cache,
+            result_store,
+        )
+
+    cfg = get_probe_config(probe_config, random_seed)
+    if _is_done([cfg], result_store, metrics_sink):
+        return
+
     exp = ProbeExperiment(
         cfg,
         summarize_frequency=100,
         use_wandb=use_wandb,
-        model_type=model_type
+        model_type=model_type,
+        embedding_cache=embedding_cache,
+        metrics_sink=metrics_sink,
     )
 
-    emb_in_mem = cfg["load_embeddings_in_memory"]
-
     # --- TRAIN PROBE ---
+    _load_data(exp, exp_info, probe_config, random_seed)
+    exp.train()
+
+    if result_store is not None:
+        exp.save(result_store.root_dir)
+
+    # # TODO: this does not need to run every time we train a probe - maybe when embeddings are extracted this can be its separate step
+    # exp.plot_umap()
+
+    return exp
+
+
+def _find_embeddings(probe_config, base_path_parent: Path) -> Optional[Dict[str, Any]]:
+    """The catalog entry of the embeddings a sweep config probes, with the path of its labels."""
+    exp_info = EmbeddingsCatalog.load(base_path_parent / probe_config.concept).find(
+        probe_config.model_type, probe_config.model_size, probe_config.model_layer
+    )
+
+    if exp_info is None:
+        print(
+            "There is no dataset corresponding to the config specified in the sweep."
+        )
+        # nothing to do if a configuration for this does not exist. This might happen if
+        # we try to run a probe for S or M models of JUKEBOX or for larger layers of
+        # MUSICGEN that do not exist. Return nothing instead of throwing an error to treat it
+        # as a noop instead of a job failure.
+        return None
+    return {
+        **exp_info,
+        "dataset_labels_path": get_dataset_labels_path(
+            probe_config.concept, base_path_parent
+        ),
+    }
+
+
+def _load_data(
+    exp: ProbeExperiment, exp_info: Dict[str, Any], probe_config, random_seed: int
+) -> None:
+    """Load the data of a sweep config, or reuse it if the previous config loaded the same."""
+    label_column_name = exp.cfg["dataset_embeddings_label_column_name"]
+    output_type = get_output_type(probe_config.concept)
+    data_key = (
+        str(exp_info["dataset_labels_path"]),
+        label_column_name,
+        str(exp_info["zarr_filepath"]),
+        output_type,
+        probe_config.model_layer,
+        probe_config.concept,
+        random_seed,
+        exp.cfg["load_embeddings_in_memory"],
+    )
+    if data_key in _LOADED_DATA:
+        exp.set_data(_LOADED_DATA[data_key])
+        return
+
     exp.load_data(
         dataset_labels_filepath=exp_info["dataset_labels_path"],
         dataset_label_column_name=label_column_name,
         embeddings_zarr_filepath=exp_info["zarr_filepath"],
         output_type=output_type,
-        model_layer=model_layer,
+        model_layer=probe_config.model_layer,
+    )
+    # hold on to at most one dataset at a time
+    _LOADED_DATA.clear()
+    _LOADED_DATA[data_key] = exp.get_data()
+
+
+def start_many(
+    sweep_configs: List[Mapping[str, Any]],
+    metrics_sinks: List[MetricsSink],
+    random_seed: int = 0,
+    base_path_parent: Path = OUTPUT_DIR,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    result_store: Optional[ProbeResultStore] = None,
+) -> List[Optional[ProbeExperiment]]:
+    """Train the probes of many sweep configs, as start does for each, batching what it can.
+
+    The configs that probe the same embeddings load them once, and are then trained
+    together with train_probes_batched, so configs that only differ in e.g. their learning
+    rate or dropout train side by side on the same batches. The metrics of each config go
+    to its own sink. Configs that probe all layers are trained by start, one at a time.
+
+    Returns: The trained experiment of each config, None if it had nothing to train.
+    """
+    experiments: List[Optional[ProbeExperiment]] = [None] * len(sweep_configs)
+    # the configs that still have to be trained, by the data they probe. Each entry holds
+    # the sweep config and embeddings of its first config, and the index and config of all
+    pending: Dict[Tuple[Any, ...], Tuple[Any, Dict[str, Any], List[Tuple[int, Any]]]] = {}
+    for i, (sweep_config, metrics_sink) in enumerate(zip(sweep_configs, metrics_sinks)):
+        if sweep_config["model_layer"] == "all":
+            # already trained side by side, one probe per layer
+            experiments[i] = start(
+                use_wandb=False,
+                random_seed=random_seed,
+                base_path_parent=base_path_parent,
+                embedding_cache=embedding_cache,
+                result_store=result_store,
+                sweep_config=sweep_config,
+                metrics_sink=metrics_sink,
+            )
+            continue
+
+        probe_config = SimpleNamespace(**sweep_config)
+        exp_info = _find_embeddings(probe_config, base_path_parent)
+        if exp_info is None:
+            continue
+        cfg = get_probe_config(probe_config, random_seed)
+        if _is_done([cfg], result_store, metrics_sink):
+            continue
+
+        data_key = (
+            str(exp_info["zarr_filepath"]),
+            probe_config.concept,
+            probe_config.model_layer,
+        )
+        pending.setdefault(data_key, (probe_config, exp_info, []))[2].append((i, cfg))
+
+    for probe_config, exp_info, runs in pending.values():
+        data = ProbeExperiment(
+            runs[0][1],
+            summarize_frequency=100,
+            use_wandb=False,
+            model_type=probe_config.model_type,
+            embedding_cache=embedding_cache,
+        )
+        _load_data(data, exp_info, probe_config, random_seed)
+
+        trained = train_probes_batched(
+            [cfg for _, cfg in runs],
+            data,
+            summarize_frequency=100,
+            metrics_sinks=[metrics_sinks[i] for i, _ in runs],
+        )
+        for (i, _), exp in zip(runs, trained):
+            if result_store is not None:
+                exp.save(result_store.root_dir)
+            experiments[i] = exp
+
+    return experiments
+
+
+def _train_all_layers(
+    cfgs,
+    exp_info,
+    label_column_name: str,
+    output_type: str,
+    model_type: str,
+    metrics_sink: MetricsSink,
+    embedding_cache: Optional[EmbeddingCache],
+    result_store: Optional[ProbeResultStore] = None,
+) -> LayerwiseProbeExperiment:
+    """Train a probe for each layer of the model, reading the embeddings of a batch once."""
+    data = ProbeExperiment(
+        cfgs[0],
+        summarize_frequency=100,
+        model_type=model_type,
+        embedding_cache=embedding_cache,
+        metrics_sink=metrics_sink,
+    )
+    data.load_data(
+        dataset_labels_filepath=exp_info["dataset_labels_path"],
+        dataset_label_column_name=label_column_name,
+        embeddings_zarr_filepath=exp_info["zarr_filepath"],
+        output_type=output_type,
+        model_layer=None,
     )
+    exp = LayerwiseProbeExperiment(cfgs, data, summarize_frequency=100)
     exp.train()
 
-    # # TODO: this does not need to run every time we train a probe - maybe when embeddings are extracted this can be its separate step
-    # exp.plot_umap()
+    all_metrics = exp.eval("valid")
+    # one step per layer, so that the metrics of the run are plotted against depth
+    for model_layer, metrics in enumerate(all_metrics):
+        metrics_sink.log({"model_layer": model_layer, **metrics}, step=model_layer)
+
+    if result_store is not None:
+        # saved as the probe of each layer, as if it was trained on that layer alone
+        for layer_exp, metrics in zip(exp.to_experiments(), all_metrics):
+            layer_exp.save(result_store.root_dir, metrics)
 
     return exp
 
 
-def wrapped_train() -> None:  # pragma: no cover
+def _is_done(
+    cfgs, result_store: Optional[ProbeResultStore], metrics_sink: MetricsSink
+) -> bool:
+    """Whether every config already finished, e.g. in a duplicated or resubmitted job."""
+    if result_store is None:
+        return False
+
+    records = [result_store.get(cfg.uid()) for cfg in cfgs]
+    if any(record is None for record in records):
+        return False
+
+    print(f"Already finished {len(records)} probe(s), skipping.")
+    # report the stored results, so the sweep still sees the metrics of this config
+    for step, record in enumerate(records):
+        metrics_sink.log(record["metrics"], step=step)
+    return True
+
+
+def wrapped_train(skip_done: bool = False) -> None:  # pragma: no cover
     try:
         wandb.init()
-        start()
+        # every run of the sweep on this node shares the loaded embeddings
+        start(
+            embedding_cache=EmbeddingCache(),
+            result_store=ProbeResultStore(CACHE_PROBES_DIR) if skip_done else None,
+        )
     except Exception as e:
         wandb.log({"error": str(e), "traceback": traceback.format_exc()})
         raise e
@@ -222,6 +431,11 @@ if __name__ == "__main__":  # pragma: no cover
     parser = argparse.ArgumentParser()
     parser.add_argument("--sweep_id", type=str, required=True)
     parser.add_argument("--wandb_project", type=str, required=True)
+    # number of sweep configs to run in this process. Embeddings and splits are loaded once
+    # and reused by consecutive configs that probe the same data.
+    parser.add_argument("--count", type=int, default=1)
+    # skip configs whose results are already in the result store, and record new results
+    parser.add_argument("--skip_done", action="store_true")
     args = parser.parse_args()
 
     # interesting bug, see: https://github.com/wandb/wandb/issues/5272#issuecomment-1881950880
@@ -230,6 +444,8 @@ if __name__ == "__main__":  # pragma: no cover
 
     # get the wandb sweep ID and launch the agent to perform some runs
     wandb.agent(
-        args.sweep_id, project=args.wandb_project, function=wrapped_train, count=1
+        args.sweep_id,
+        project=args.wandb_project,
+        function=functools.partial(wrapped_train, skip_done=args.skip_done),
+        count=args.count,
     )
-
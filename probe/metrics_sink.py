@@ -0,0 +1,145 @@
+import os
+import json
+import queue
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import wandb
+
+# records buffered by a JsonlSink before they are handed to its writer thread
+JSONL_SINK_BATCH_SIZE = 256
+
+
+class MetricsSink:
+    """Where a probe run reports its metrics, in place of calling wandb.log directly."""
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "MetricsSink":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class NullSink(MetricsSink):
+    """Drops every record, for runs that only need the saved probe and its results."""
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None) -> None:
+        pass
+
+
+class WandbSink(MetricsSink):
+    """Logs to the active wandb run, wandb.init must have been called."""
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None) -> None:
+        wandb.log(metrics, step=step)
+
+
+class JsonlSink(MetricsSink):
+    """Appends metrics to a local JSON lines file, one record per call to log.
+
+    Records are buffered and written in batches by a background thread, so logging never
+    waits on the filesystem and does not need a network connection. Each record is the
+    metrics with their step and the given tags, e.g. the sweep config of the run. Call close
+    (or use the sink as a context manager) to write the remaining records. The file is
+    opened here, so a path that can not be written fails at once, and an error of the writer
+    thread is raised by the next call to log or close.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        tags: Optional[Dict[str, Any]] = None,
+        batch_size: int = JSONL_SINK_BATCH_SIZE,
+    ) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tags = dict(tags or {})
+        self.batch_size = batch_size
+        self._buffer: List[str] = []
+        self._open()
+        # records of earlier runs end here, see discard
+        self._start_offset = self.path.stat().st_size
+
+    def _open(self) -> None:
+        self._batches: "queue.Queue[Optional[List[str]]]" = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._file = open(self.path, "a")
+        self._writer = threading.Thread(target=self._write_batches, daemon=True)
+        self._writer.start()
+
+    def _write_batches(self) -> None:
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                return
+            try:
+                self._file.writelines(batch)
+                self._file.flush()
+            except OSError as e:
+                self._error = e
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None) -> None:
+        if self._writer is None:
+            raise ValueError(f"Metrics sink for {self.path} is closed")
+        if self._error is not None:
+            raise self._error
+        record = {**self.tags, **metrics, "step": step}
+        # serialize now, the metrics dict may be changed by the caller after logging
+        self._buffer.append(json.dumps(record, default=_to_json) + "\n")
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Hand the buffered records to the writer thread."""
+        if self._buffer:
+            self._batches.put(self._buffer)
+            self._buffer = []
+
+    def discard(self) -> None:
+        """Drop the records logged to this sink, e.g. by an attempt that is run again.
+
+        The records of earlier sinks of the same file are kept.
+        """
+        self.close()
+        os.truncate(self.path, self._start_offset)
+        self._open()
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self.flush()
+        self._batches.put(None)
+        self._writer.join()
+        self._writer = None
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+
+
+def _to_json(x: Any) -> Any:
+    # numpy and torch scalars and arrays
+    if hasattr(x, "tolist"):
+        return x.tolist()
+    raise TypeError(f"Object of type {type(x).__name__} is not JSON serializable")
+
+
+def read_jsonl_metrics(path: Union[str, Path]) -> List[Dict[str, Any]]:
+    """The records written by a JsonlSink, in the order they were logged."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_metrics_sink(
+    use_wandb: bool, metrics_sink: Optional[MetricsSink] = None
+) -> MetricsSink:
+    """The given sink, or the sink that use_wandb used to mean."""
+    if metrics_sink is not None:
+        return metrics_sink
+    return WandbSink() if use_wandb else NullSink()
@@ -1,4 +1,7 @@
 import json
+import itertools
+from typing import Any, Dict, List
+
 from embeddings.config_checksum import compute_checksum
 
 
@@ -94,6 +97,34 @@ SWEEP_CONFIGS = {
         },
         "wandb_project_name": "music-theory-musicgen",
     },
+    # same as the jukebox and musicgen sweeps, but each run trains the probes of all layers
+    # of a model at once, reading its embeddings once instead of once per layer
+    "jukebox_all_layers": {
+        "wandb_sweep_parameters": {
+            "method": "grid",
+            "metric": {"goal": "minimize", "name": "primary_eval_metric"},
+            "parameters": {
+                "model_type": {"values": ["JUKEBOX"]},
+                "model_size": {"values": ["L"]},
+                "model_layer": {"values": ["all"]},
+                "concept": {"values": list(CONCEPT_LABELS.keys())},
+            },
+        },
+        "wandb_project_name": "music-theory-jukebox",
+    },
+    "musicgen_all_layers": {
+        "wandb_sweep_parameters": {
+            "method": "grid",
+            "metric": {"goal": "minimize", "name": "primary_eval_metric"},
+            "parameters": {
+                "model_type": {"values": ["MUSICGEN_DECODER"]},
+                "model_size": {"values": ["L", "M", "S"]},
+                "model_layer": {"values": ["all"]},
+                "concept": {"values": list(CONCEPT_LABELS.keys())},
+            },
+        },
+        "wandb_project_name": "music-theory-musicgen",
+    },
     "text": {
         "wandb_sweep_parameters": {
             "method": "grid",
@@ -129,6 +160,26 @@ SWEEP_CONFIGS = {
 }
 
 
+def expand_sweep_config(sweep_config_name: str) -> List[Dict[str, Any]]:
+    """The run configs of a grid sweep in SWEEP_CONFIGS, without going through wandb.
+
+    Each run config maps every sweep parameter to one of its values, in the same form as
+    wandb.config of a run of the sweep.
+    """
+    sweep_parameters = SWEEP_CONFIGS[sweep_config_name]["wandb_sweep_parameters"]
+    if sweep_parameters["method"] != "grid":
+        raise ValueError(
+            f"Only grid sweeps can be expanded locally, got: {sweep_parameters['method']}"
+        )
+
+    names = list(sweep_parameters["parameters"].keys())
+    values = [
+        param["values"] if "values" in param else [param["value"]]
+        for param in sweep_parameters["parameters"].values()
+    ]
+    return [dict(zip(names, run_values)) for run_values in itertools.product(*values)]
+
+
 class ProbeExperimentConfig(dict):
     """Defines the parameters of the probe experiment to use."""
 
@@ -137,6 +188,9 @@ class ProbeExperimentConfig(dict):
         "dataset": None,
         "dataset_embeddings_label_column_name": None,
         "data_standardization": True,
+        # if this is true, the standardization statistics are computed exactly on the train
+        # split before training and then frozen. Otherwise they are updated on every batch.
+        "precompute_standardization": False,
         "hidden_layer_sizes": [],
         "batch_size": 64,
         "learning_rate": 1e-3,
@@ -145,6 +199,8 @@ class ProbeExperimentConfig(dict):
         "max_num_epochs": None,
         "early_stopping_metric": "primary",
         "early_stopping": True,
+        # evaluate every n steps, and stop after n evaluations without improvement. If "auto",
+        # these adapt to the size of the train split, see probes.get_early_stopping_schedule
         "early_stopping_eval_frequency": 8,
         "early_stopping_boredom": 256,
         "seed": 0,
@@ -152,7 +208,15 @@ class ProbeExperimentConfig(dict):
         # if this is true, all the embedding files used in test/train are loaded into RAM
         # otherwise, we load only their location in a zarr file on disk and load as needed
         "load_embeddings_in_memory": False,
+        # how to fit the probe: 'adam' trains with minibatches. 'convex' is only for linear
+        # probes, it fits them on the full train split with L-BFGS (multiclass) or a
+        # closed-form ridge solve (regression).
+        "solver": "adam",
     }
+    # fields added after probes were first cached. They are left out of the uid when set to
+    # their default, so the uids of existing probes do not change.
+    _UID_OPTIONAL = ["solver", "precompute_standardization"]
+    _SOLVERS = ("adam", "convex")
     _REQUIRED = [
         "dataset",
         "dataset_embeddings_label_column_name",
@@ -183,8 +247,23 @@ class ProbeExperimentConfig(dict):
         except Exception as e:
             raise ValueError(f"All values must be JSON-serializable. Got error: {e}")
 
+        if self["solver"] not in self._SOLVERS:
+            raise ValueError(f"Unknown solver {self['solver']}")
+
+        if self["solver"] == "convex" and self["hidden_layer_sizes"]:
+            raise ValueError("The convex solver can only fit linear probes")
+
+        for field in ("early_stopping_eval_frequency", "early_stopping_boredom"):
+            if self[field] != "auto" and not isinstance(self[field], int):
+                raise ValueError(f"{field} must be an integer or 'auto'")
+
     def uid(self) -> str:
+        cfg = {
+            k: v
+            for k, v in self.items()
+            if not (k in self._UID_OPTIONAL and v == self._DEFAULTS[k])
+        }
         # hash the config
         return compute_checksum(
-            json.dumps(self, indent=2, sort_keys=True).encode("utf-8"), algorithm="sha1"
+            json.dumps(cfg, indent=2, sort_keys=True).encode("utf-8"), algorithm="sha1"
         )
@@ -1,21 +1,21 @@
 """
 Adapted from: https://github.com/p-lambda/jukemir/blob/main/jukemir/probe/__init__.py
 """
+import copy
 import json
 import logging
 import math
+import os
 import pickle
 import random
-import tempfile
 from pathlib import Path
 from os import environ as os_env
-from typing import List, Optional, Tuple, Any, Union
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Any, Union
 
 import pandas as pd
 import numpy as np
 import sklearn
 import zarr
-import wandb
 
 import torch
 import torch.nn as nn
@@ -31,10 +31,19 @@ from sklearn.metrics import (
     roc_auc_score,
     confusion_matrix,
 )
-from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler, MinMaxScaler, normalize
 
 from probe.probe_config import ProbeExperimentConfig
+from probe.embedding_cache import EmbeddingCache
+from probe.metrics_sink import MetricsSink, NullSink, get_metrics_sink
+from probe.result_store import ProbeResultStore
+from probe.splits import (
+    RANDOM_SPLIT,
+    compute_split_positions,
+    get_split_policy,
+    load_split_positions,
+)
+from embeddings.export_embeddings import load_exported_embeddings
 
 
 # -- handle jukemir cache --
@@ -45,6 +54,75 @@ else:
 CACHE_DIR = CACHE_DIR.resolve()
 CACHE_PROBES_DIR = Path(CACHE_DIR, "probes")
 
+# iterations of L-BFGS for linear probes fit with the convex solver
+CONVEX_SOLVER_MAX_ITER = 500
+
+# train samples read at a time when precomputing the standardization statistics
+STANDARDIZATION_CHUNK_SIZE = 4096
+
+# with "auto" early stopping settings, evaluate this many times per epoch and stop after
+# this many epochs without improvement
+EARLY_STOPPING_AUTO_EVALS_PER_EPOCH = 4
+EARLY_STOPPING_AUTO_PATIENCE_EPOCHS = 10
+
+
+def get_early_stopping_schedule(
+    cfg: ProbeExperimentConfig, num_train_samples: int
+) -> Tuple[int, int]:
+    """The early stopping eval frequency, in steps, and boredom, in evals, of a config.
+
+    Fixed values are measured in steps and evals, regardless of the size of the dataset.
+    "auto" values are measured in epochs instead, so that a small dataset is not evaluated
+    many times per epoch while a large one is evaluated often enough.
+    """
+    steps_per_epoch = math.ceil(
+        num_train_samples / min(cfg["batch_size"], num_train_samples)
+    )
+    eval_frequency = cfg["early_stopping_eval_frequency"]
+    if eval_frequency == "auto":
+        eval_frequency = max(
+            1, math.ceil(steps_per_epoch / EARLY_STOPPING_AUTO_EVALS_PER_EPOCH)
+        )
+
+    boredom = cfg["early_stopping_boredom"]
+    if boredom == "auto":
+        boredom = math.ceil(
+            EARLY_STOPPING_AUTO_PATIENCE_EPOCHS * steps_per_epoch / eval_frequency
+        )
+    return eval_frequency, boredom
+
+
+def get_standardization_tensors(
+    scaler: StandardScaler, device: torch.device
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """A fitted scaler as (shift, inv_scale) tensors, its transform is X * inv_scale + shift."""
+    num_features = scaler.n_features_in_
+    inv_scale = np.ones(num_features) if scaler.scale_ is None else 1 / scaler.scale_
+    shift = np.zeros(num_features) if scaler.mean_ is None else -scaler.mean_ * inv_scale
+    return (
+        torch.tensor(shift, dtype=torch.float32, device=device),
+        torch.tensor(inv_scale, dtype=torch.float32, device=device),
+    )
+
+
+def slice_scaler(scaler: StandardScaler, features: slice) -> StandardScaler:
+    """A copy of a fitted scaler that standardizes only the given slice of its features."""
+    sliced = copy.deepcopy(scaler)
+    for attr in ("mean_", "var_", "scale_", "n_samples_seen_"):
+        value = getattr(scaler, attr, None)
+        if isinstance(value, np.ndarray):
+            setattr(sliced, attr, value[features])
+    sliced.n_features_in_ = len(range(scaler.n_features_in_)[features])
+    return sliced
+
+
+def standardize(
+    X: torch.Tensor, standardization: Tuple[torch.Tensor, torch.Tensor]
+) -> torch.Tensor:
+    """Apply the tensors of get_standardization_tensors to a batch, in a single fused op."""
+    shift, inv_scale = standardization
+    return torch.addcmul(shift, X, inv_scale)
+
 
 class SimpleMLP(nn.Module):
     def __init__(
@@ -74,8 +152,102 @@ class SimpleMLP(nn.Module):
         return self.output(x)
 
 
+class BatchedMLP(nn.Module):
+    """K independent SimpleMLPs of the same architecture, evaluated together with batched matmuls.
+
+    Each probe has its own weights and dropout probability. Inputs are either shared by all
+    probes, of shape (batch, features), or given per probe, of shape (K, batch, features).
+    Outputs are of shape (K, batch, num_outputs).
+    """
+
+    def __init__(
+        self,
+        num_probes: int,
+        num_features: int,
+        hidden_layer_sizes: List[int],
+        num_outputs: int,
+        dropout_ps: List[float],
+    ) -> None:
+        super().__init__()
+        if len(dropout_ps) != num_probes:
+            raise ValueError(
+                f"Expected {num_probes} dropout probabilities, got {len(dropout_ps)}"
+            )
+
+        self.num_probes = num_probes
+        self.num_layers = len(hidden_layer_sizes)
+        dims = [num_features] + list(hidden_layer_sizes) + [num_outputs]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for d_in, d_out in zip(dims[:-1], dims[1:]):
+            # same initialization as nn.Linear
+            bound = 1 / math.sqrt(d_in)
+            self.weights.append(
+                nn.Parameter(torch.empty(num_probes, d_in, d_out).uniform_(-bound, bound))
+            )
+            self.biases.append(
+                nn.Parameter(torch.empty(num_probes, 1, d_out).uniform_(-bound, bound))
+            )
+
+        self.register_buffer(
+            "dropout_p", torch.tensor(dropout_ps, dtype=torch.float32).view(-1, 1, 1)
+        )
+
+    def dropout(self, x: torch.Tensor) -> torch.Tensor:
+        if not self.training:
+            return x
+        keep_p = 1 - self.dropout_p
+        mask = torch.rand_like(x) < keep_p
+        return x * mask / keep_p.clamp_min(1e-8)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.num_probes, -1, -1)
+        x = self.dropout(x)
+        for i in range(self.num_layers):
+            x = torch.baddbmm(self.biases[i], x, self.weights[i])
+            x = F.relu(x)
+            x = self.dropout(x)
+        return torch.baddbmm(self.biases[-1], x, self.weights[-1])
+
+    def to_simple_mlp(self, k: int) -> SimpleMLP:
+        """Copy the weights of the k-th probe into a standalone SimpleMLP."""
+        hidden_layer_sizes = [w.shape[2] for w in self.weights[:-1]]
+        probe = SimpleMLP(
+            self.weights[0].shape[1],
+            hidden_layer_sizes,
+            num_outputs=self.weights[-1].shape[2],
+            dropout_p=self.dropout_p[k].item(),
+        )
+        layers = [getattr(probe, f"hidden_{i}") for i in range(self.num_layers)]
+        layers.append(probe.output)
+        with torch.no_grad():
+            for layer, w, b in zip(layers, self.weights, self.biases):
+                # nn.Linear stores weights as (out, in)
+                layer.weight.copy_(w[k].T)
+                layer.bias.copy_(b[k, 0])
+        return probe
+
+
+# labels and splits recently prepared in this process, see ProbeExperiment.load_labels_and_splits
+_LABELS_AND_SPLITS_CACHE: Dict[Tuple[Any, ...], Tuple[pd.DataFrame, ...]] = {}
+LABELS_AND_SPLITS_CACHE_SIZE = 8
+
+
 class ProbeExperiment:
-    OHE_SUFFIX = "_ohe"
+    ENCODED_SUFFIX = "_encoded"
+
+    # everything set by load_data, these can be shared by experiments that use the same data
+    DATA_ATTRIBUTES = (
+        "dataset_labels_filepath",
+        "dataset_labels",
+        "is_foundation_model_layers",
+        "embeddings",
+        "split_to_uids",
+        "split_to_X",
+        "split_to_y",
+        "output_type",
+    )
 
     def __init__(
         self,
@@ -85,6 +257,8 @@ class ProbeExperiment:
         summarize_frequency: int = 20,
         use_wandb: bool = True,
         model_type=None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        metrics_sink: Optional[MetricsSink] = None,
     ) -> None:
         if not cfg["early_stopping"] and cfg["max_num_epochs"] is None:
             raise ValueError("No termination criteria specified")
@@ -94,6 +268,14 @@ class ProbeExperiment:
         self.probe = pretrained_probe
         self.label_column = cfg["dataset_embeddings_label_column_name"]
         self.use_wandb = use_wandb
+        # training metrics are reported here, to wandb unless another sink is given
+        self.metrics_sink = get_metrics_sink(use_wandb, metrics_sink)
+        # if given, in-memory splits are shared with other runs on this node through this cache
+        self.embedding_cache = embedding_cache
+        # standardized splits kept on the device, see get_device_split
+        self.device_splits = {}
+        # splits kept on the device for evaluation during training, see get_raw_device_split
+        self.raw_device_splits = {}
 
         # model type: [ JUKEBOX | MUSICGEN_DECODER | MUSICGEN_AUDIO_ENCODER | MUSICGEN_TEXT_ENCODER | MFCC | CHROMA | MELSPEC | HANDCRAFT ]
         self.model_type = model_type
@@ -122,23 +304,15 @@ class ProbeExperiment:
     def get_train_test_valid_split_from_pandas_df(
         self, df: pd.DataFrame, train_size: float = 0.7
     ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-        df_shuffled = df.sample(frac=1, random_state=self.random_seed)
-
-        # k train, (1-k)/2 test, (1-k)/2 valid
-        train_df, non_train_df = train_test_split(
-            df_shuffled, train_size=train_size, random_state=self.random_seed
+        positions = compute_split_positions(
+            df, self.random_seed, RANDOM_SPLIT, train_size=train_size
         )
-        valid_df, test_df = train_test_split(
-            non_train_df, test_size=0.5, random_state=self.random_seed
+        # reset the index of the split DataFrames
+        return tuple(
+            df.iloc[positions[split_name]].reset_index(drop=True)
+            for split_name in ("train", "test", "valid")
         )
 
-        # Optionally, reset the index of the split DataFrames
-        train_df.reset_index(drop=True, inplace=True)
-        valid_df.reset_index(drop=True, inplace=True)
-        test_df.reset_index(drop=True, inplace=True)
-
-        return train_df, test_df, valid_df
-
     def format_dataset_labels(
         self, output_type: str, dataset_label_column_name: str, dataset_labels
     ):
@@ -152,28 +326,67 @@ class ProbeExperiment:
                 dataset_label_column_name
             ].astype("float32")
         elif output_type == "multiclass":
-            # we are doing multiclass classification, column values to categoricals
-            dataset_labels[dataset_label_column_name + "_encoded"] = pd.Categorical(
-                dataset_labels[dataset_label_column_name]
-            ).codes
+            # we are doing multiclass classification, column values to integer classes.
+            # categories are sorted, as in _get_map_for_col_name
+            dataset_labels[dataset_label_column_name + self.ENCODED_SUFFIX] = (
+                pd.Categorical(dataset_labels[dataset_label_column_name]).codes.astype(
+                    np.int64
+                )
+            )
         else:
             raise ValueError(f"Unsupported output type, got: {output_type}")
 
-        label_map = self._get_map_for_col_name(
-            dataset_label_column_name, dataset_labels
+        return dataset_labels
+
+    def load_labels_and_splits(
+        self, dataset_labels_filepath, dataset_label_column_name: str, output_type: str
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """The encoded labels and their train, test and valid splits.
+
+        These only depend on the labels file, the label column and the seed, so they are
+        cached in the process and shared by every run that probes the same labels. The
+        returned DataFrames must not be modified.
+        """
+        labels_path = Path(dataset_labels_filepath).resolve()
+        cache_key = (
+            str(labels_path),
+            labels_path.stat().st_mtime_ns,
+            dataset_label_column_name,
+            output_type,
+            self.cfg["dataset"],
+            self.random_seed,
         )
+        if cache_key in _LABELS_AND_SPLITS_CACHE:
+            return _LABELS_AND_SPLITS_CACHE[cache_key]
 
-        dataset_labels[dataset_label_column_name + "_encoded"] = dataset_labels[
-            dataset_label_column_name
-        ].apply(lambda x: label_map[x])
+        # load the dataset and encode categorical targets
+        dataset_labels = pd.read_csv(dataset_labels_filepath)
+        dataset_labels = self.format_dataset_labels(
+            output_type, dataset_label_column_name, dataset_labels
+        )
 
-        # add one hot encoded labels to the dataframe
-        dataset_labels[self.label_column + self.OHE_SUFFIX] = (
-            pd.get_dummies(dataset_labels[self.label_column])
-            .astype(np.float32)
-            .values.tolist()
+        # add the zarr idx if not listed explicitly
+        if "zarr_idx" not in set(dataset_labels.columns):
+            dataset_labels["zarr_idx"] = np.arange(dataset_labels.shape[0])
+
+        # get test / train / validation split, shared with every other run on this dataset
+        # through the split index files
+        positions = load_split_positions(
+            dataset_labels_filepath,
+            dataset_labels,
+            self.random_seed,
+            get_split_policy(self.cfg["dataset"], output_type),
         )
-        return dataset_labels
+        train_df, test_df, valid_df = (
+            dataset_labels.iloc[positions[split_name]]
+            for split_name in ("train", "test", "valid")
+        )
+
+        if len(_LABELS_AND_SPLITS_CACHE) >= LABELS_AND_SPLITS_CACHE_SIZE:
+            # drop the oldest entry
+            del _LABELS_AND_SPLITS_CACHE[next(iter(_LABELS_AND_SPLITS_CACHE))]
+        _LABELS_AND_SPLITS_CACHE[cache_key] = (dataset_labels, train_df, test_df, valid_df)
+        return _LABELS_AND_SPLITS_CACHE[cache_key]
 
     def load_data(
         self,
@@ -181,56 +394,61 @@ class ProbeExperiment:
         dataset_label_column_name: str,
         embeddings_zarr_filepath,
         output_type: str,
-        model_layer: int = 0,
+        model_layer: Optional[int] = 0,
     ) -> None:
-        self.dataset_labels_filepath = dataset_labels_filepath
+        """Load the labels, split them and load the embeddings of each split.
 
-        # load the dataset and encode categorical targets
-        dataset_labels = pd.read_csv(dataset_labels_filepath)
-        dataset_labels = self.format_dataset_labels(
-            output_type, dataset_label_column_name, dataset_labels
+        If model_layer is None, the embeddings of all layers are used, concatenated per
+        sample, as used by LayerwiseProbeExperiment. They are many times larger than a single
+        layer, so they are always read from disk a batch at a time, whatever
+        load_embeddings_in_memory says.
+        """
+        self.dataset_labels_filepath = dataset_labels_filepath
+        self.dataset_labels, train_df, test_df, valid_df = self.load_labels_and_splits(
+            dataset_labels_filepath, dataset_label_column_name, output_type
         )
 
-        self.dataset_labels = dataset_labels
-
-        # add the zarr idx if not listed explicitly
-        if "zarr_idx" not in set(dataset_labels.columns):
-            dataset_labels["zarr_idx"] = np.arange(dataset_labels.shape[0])
-
-        # get test / train / validation split
-        if self.cfg["dataset"] == "tempos" and output_type == "regression":
-            # order is important, we want to test the out of domain extrapolation power of
-            # the embeddings.
-            dataset_labels = dataset_labels.sort_values(by=["bpm"])
-            ends = 0.15
-            dataset_size = dataset_labels.shape[0]
-            lb_idx = int(dataset_size * (ends))
-            ub_idx = int(dataset_size * (1 - ends))
-
-            # train on BPMs within a specific middle range
-            train_df = dataset_labels.iloc[lb_idx:ub_idx]
-            hold_out_df = pd.concat(
-                [dataset_labels.iloc[:lb_idx], dataset_labels.iloc[ub_idx:]],
-                axis=0,
-            )
-            hold_out_shuffled = hold_out_df.sample(
-                frac=1, random_state=self.random_seed
-            )
-            test_df, valid_df = train_test_split(
-                hold_out_shuffled, train_size=0.5, random_state=self.random_seed
-            )
-            # our train/test/valid splits are still 0.7, 0.15, 0.15.
-        else:
-            train_df, test_df, valid_df = (
-                self.get_train_test_valid_split_from_pandas_df(dataset_labels)
-            )
-
         # load the zarr, read only mode
         data = zarr.open(embeddings_zarr_filepath, mode="r")
 
         self.is_foundation_model_layers = len(data.shape) == 3
+        all_layers = self.is_foundation_model_layers and model_layer is None
+
+        # prefer the uncompressed float32 export of this layer if it exists, it is memory
+        # mapped so it is shared through the page cache and needs no decompression.
+        exported = None
+        if not all_layers:
+            exported = load_exported_embeddings(
+                embeddings_zarr_filepath,
+                model_layer if self.is_foundation_model_layers else None,
+            )
+        if exported is not None:
+            # the export holds a single layer, of shape (n, k)
+            data = exported
+            self.is_foundation_model_layers = False
+
         self.embeddings = data
 
+        # splits that a previous run on this node already loaded in memory. An export is
+        # already shared through the page cache, so it is not copied to the cache.
+        cache_key = None
+        cached_split_to_X = None
+        if (
+            self.embedding_cache is not None
+            and self.cfg["load_embeddings_in_memory"]
+            and exported is None
+            and not all_layers
+        ):
+            cache_key = self.embedding_cache.get_key(
+                embeddings_zarr_filepath,
+                model_layer,
+                self.random_seed,
+                dataset=self.cfg["dataset"],
+                dataset_labels_filepath=Path(dataset_labels_filepath).resolve(),
+                output_type=output_type,
+            )
+            cached_split_to_X = self.embedding_cache.load(cache_key)
+
         # Organize data
         self.split_to_uids = {"train": [], "valid": [], "test": []}
         self.split_to_X = {}
@@ -240,7 +458,10 @@ class ProbeExperiment:
             split_name, data_df = split
             selector = data_df["zarr_idx"].to_numpy()
 
-            if self.cfg["load_embeddings_in_memory"]:
+            if cached_split_to_X is not None:
+                # memory mapped, zero-copy
+                X = cached_split_to_X[split_name]
+            elif self.cfg["load_embeddings_in_memory"] and not all_layers:
                 # load embeddings in memory for faster training.
                 # they will be in an array of dimension: (n, layer_num, k)
                 # where
@@ -253,10 +474,10 @@ class ProbeExperiment:
                     # handcrafted features
                     X = np.array(data[selector], dtype=np.float32)
             else:
-                if self.is_foundation_model_layers:
+                if self.is_foundation_model_layers and not all_layers:
                     X = (selector, model_layer)
                 else:
-                    # handcrafted features
+                    # handcrafted features, or all layers
                     X = (selector,)
 
             # label
@@ -264,18 +485,41 @@ class ProbeExperiment:
                 # assume y is some numerical value, may have been scaled
                 y = data_df[self.label_column].to_list()
             else:
-                # encode it using ohe
-                y = np.array(
-                    data_df[self.label_column + self.OHE_SUFFIX].tolist()
-                ).astype(np.float32)
+                # integer classes
+                y = data_df[self.label_column + self.ENCODED_SUFFIX].to_numpy(
+                    dtype=np.int64
+                )
 
             # tuple of numpy_array, integer of model layer
             self.split_to_X[split_name] = X
             self.split_to_y[split_name] = y
 
+        if cache_key is not None and cached_split_to_X is None:
+            # first run on this node to use these splits, populate the cache
+            self.embedding_cache.save(cache_key, self.split_to_X)
+
         # multi-class, multi-label, regression
         self.output_type = output_type
 
+    def get_data(self) -> Dict[str, Any]:
+        """Everything load_data set, without the probe, scaler and metrics of this experiment."""
+        return {attr: getattr(self, attr) for attr in self.DATA_ATTRIBUTES}
+
+    def set_data(self, data: Mapping[str, Any]) -> None:
+        """Use data returned by get_data instead of calling load_data.
+
+        The arrays are not copied, so they may not be modified.
+        """
+        for attr in self.DATA_ATTRIBUTES:
+            setattr(self, attr, data[attr])
+
+    def share_data_from(self, other: "ProbeExperiment") -> None:
+        """Use the data another experiment loaded instead of calling load_data.
+
+        The arrays are not copied, so neither experiment may modify them.
+        """
+        self.set_data(other.get_data())
+
     def compute_loss(self, logits: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         output_type = self.output_type
         if output_type == "multiclass":
@@ -307,19 +551,130 @@ class ProbeExperiment:
         except ValueError:
             return t[0], -1
 
-    def train(self) -> None:
+    def has_splits_in_memory(self) -> bool:
+        """Whether load_data read the embeddings of the splits, or only their zarr indexes."""
+        return not isinstance(self.split_to_X["train"], tuple)
+
+    def get_num_samples(self, split_name: str) -> int:
+        X, _ = self.destructure(self.split_to_X[split_name])
+        return X.shape[0]
+
+    def get_split_X(self, split_name: str, idxs=None) -> np.ndarray:
+        """Embeddings of a split, or only of the samples at idxs within the split.
+
+        Must have run load_data beforehand. Reads from memory or disk, depending on where
+        the embeddings are stored.
+        """
+        if self.has_splits_in_memory():
+            # load embeddings directly, since they are stored in splits
+            X = self.split_to_X[split_name]
+            return X if idxs is None else X[idxs, :]
+
+        # indexes are stored in splits, retrieve them from disk
+        X_idxs, model_layer = self.destructure(self.split_to_X[split_name])
+        if idxs is not None:
+            X_idxs = X_idxs[idxs]
+        if model_layer != -1:
+            return self.embeddings[X_idxs, model_layer, :]
+        # handcrafted features, or all layers of a foundation model concatenated. zarr only
+        # supports orthogonal selections with an index for every dimension
+        X = self.embeddings[(X_idxs,) + (slice(None),) * (self.embeddings.ndim - 1)]
+        return X.reshape(X.shape[0], -1)
+
+    def get_embedding_dimension(self) -> int:
         # extract a single embedding to get its dimension
-        if self.cfg["load_embeddings_in_memory"]:
-            single_X = self.split_to_X["train"][0, :]
-            embedding_dimension = single_X.shape[0]
+        return self.get_split_X("train", np.arange(1)).shape[1]
+
+    def uses_device_splits(self) -> bool:
+        """Whether splits can be standardized once and kept on the device.
+
+        This needs the splits in memory and a scaler that is frozen during training.
+        """
+        return self.has_splits_in_memory() and self.cfg["precompute_standardization"]
+
+    def load_split_to_device(
+        self, split_name: str, scaler: Optional[StandardScaler]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The embeddings of a split standardized by a frozen scaler, and its labels, on the device.
+
+        If scaler is None, the embeddings are not standardized.
+        """
+        X = torch.tensor(
+            np.asarray(self.get_split_X(split_name)),
+            dtype=torch.float32,
+            device=self.device,
+        )
+        if scaler is not None:
+            X = standardize(X, get_standardization_tensors(scaler, self.device))
+        y = torch.tensor(np.array(self.split_to_y[split_name]), device=self.device)
+        return X, y
+
+    def get_device_split(self, split_name: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Like load_split_to_device with this experiment's scaler, the split is only moved once."""
+        if split_name not in self.device_splits:
+            self.device_splits[split_name] = self.load_split_to_device(
+                split_name, self.scaler
+            )
+        return self.device_splits[split_name]
+
+    def get_raw_device_split(
+        self, split_name: str
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The split as tensors on the device, not standardized. It is only read and moved once."""
+        if split_name not in self.raw_device_splits:
+            self.raw_device_splits[split_name] = self.load_split_to_device(
+                split_name, None
+            )
+        return self.raw_device_splits[split_name]
+
+    def get_standardized_device_split(
+        self, split_name: str, scaler: StandardScaler
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The split on the device, standardized by the current state of a scaler."""
+        X, y = self.get_raw_device_split(split_name)
+        if not hasattr(scaler, "n_samples_seen_"):
+            # as in eval_logits, a scaler that has not seen any training batch yet is fit
+            # to the split that is evaluated
+            scaler.partial_fit(X.cpu().numpy())
+        return standardize(X, get_standardization_tensors(scaler, self.device)), y
+
+    def fit_scaler(self, data_standardization: bool) -> StandardScaler:
+        """Fit a scaler to the exact statistics of the train split, in one streaming pass.
+
+        The split is read in chunks, so it never has to fit in memory. Splits on disk are read
+        in the order they are stored, so that each chunk of the zarr is decompressed about once.
+        """
+        scaler = StandardScaler(
+            with_mean=data_standardization, with_std=data_standardization
+        )
+        for chunk_idxs in self.iter_split_chunks("train", STANDARDIZATION_CHUNK_SIZE):
+            scaler.partial_fit(self.get_split_X("train", chunk_idxs))
+        return scaler
+
+    def iter_split_chunks(self, split_name: str, chunk_size: int) -> Iterator[np.ndarray]:
+        """Positions within a split, chunk_size samples of a single layer at a time.
+
+        Splits on disk are read in the order they are stored, so that each chunk of the zarr
+        is decompressed about once. A sample of all layers counts as a sample per layer.
+        """
+        num_samples = self.get_num_samples(split_name)
+        if self.has_splits_in_memory():
+            order = np.arange(num_samples)
         else:
-            X_train, model_layer = self.destructure(self.split_to_X["train"])
-            if model_layer != -1:
-                single_X = self.embeddings[X_train[:1]][:, model_layer, :]
-            else:
-                single_X = self.embeddings[X_train[:1]]
+            X_idxs, model_layer = self.destructure(self.split_to_X[split_name])
+            order = np.argsort(X_idxs, kind="stable")
+            if model_layer == -1 and self.embeddings.ndim == 3:
+                chunk_size = max(1, chunk_size // self.embeddings.shape[1])
 
-            embedding_dimension = single_X.shape[1]
+        for start in range(0, num_samples, chunk_size):
+            yield order[start : start + chunk_size]
+
+    def train(self) -> None:
+        if self.cfg["solver"] == "convex":
+            self.train_convex()
+            return
+
+        embedding_dimension = self.get_embedding_dimension()
 
         self.probe = SimpleMLP(
             embedding_dimension,
@@ -342,20 +697,37 @@ class ProbeExperiment:
         )
 
         # Retrieve dataset, must have run load_data beforehand
-        X_train, model_layer = self.destructure(self.split_to_X["train"])
+        num_train_samples = self.get_num_samples("train")
 
         y_train = np.array(self.split_to_y["train"])
 
         # Fit scaler
-        self.scaler = StandardScaler(
-            with_mean=self.cfg["data_standardization"],
-            with_std=self.cfg["data_standardization"],
-        )
-        # not feasible to fit all at once, see in training we use partial_fit which is
-        # online computation of mean/std for batches.
-        # self.scaler.fit(X_train)
+        if self.cfg["precompute_standardization"]:
+            # exact statistics of the train split, frozen for all of training
+            self.scaler = self.fit_scaler(self.cfg["data_standardization"])
+            standardization = get_standardization_tensors(self.scaler, self.device)
+            # splits standardized by a previous scaler are stale
+            self.device_splits = {}
+        else:
+            self.scaler = StandardScaler(
+                with_mean=self.cfg["data_standardization"],
+                with_std=self.cfg["data_standardization"],
+            )
+            # not feasible to fit all at once, see in training we use partial_fit which is
+            # online computation of mean/std for batches.
+            # self.scaler.fit(X_train)
         self.metrics_for_graph = []
 
+        batch_size = min(self.cfg["batch_size"], num_train_samples)
+        eval_frequency, max_boredom = get_early_stopping_schedule(
+            self.cfg, num_train_samples
+        )
+        if self.uses_device_splits():
+            # the train split lives on the device, minibatches are drawn from a permutation
+            # of it per epoch, so that a step needs no host to device copies
+            X_train_device, y_train_device = self.get_device_split("train")
+            permutation = torch.empty(0, dtype=torch.long, device=self.device)
+
         # Train model
         step = 0
         early_stopping_best_score = float("-inf")
@@ -364,7 +736,7 @@ class ProbeExperiment:
 
         while True:
             # Check if exceeded max num epochs
-            epoch = (step * self.cfg["batch_size"]) / X_train.shape[0]
+            epoch = (step * self.cfg["batch_size"]) / num_train_samples
             if (
                 self.cfg["max_num_epochs"] is not None
                 and epoch > self.cfg["max_num_epochs"]
@@ -374,16 +746,16 @@ class ProbeExperiment:
             # Evaluate for early stopping
             if (
                 self.cfg["early_stopping"]
-                and step % self.cfg["early_stopping_eval_frequency"] == 0
+                and step % eval_frequency == 0
             ):
-                if early_stopping_boredom >= self.cfg["early_stopping_boredom"]:
+                if early_stopping_boredom >= max_boredom:
                     if early_stopping_state_dict is not None:
                         self.probe.load_state_dict(early_stopping_state_dict)
                     break
 
                 with torch.no_grad():
                     self.probe.eval()
-                    metrics = self.eval("valid")
+                    metrics = self.eval_on_device("valid")
 
                     if self.cfg["early_stopping_metric"].startswith("-"):
                         score = -1 * metrics[self.cfg["early_stopping_metric"][1:]]
@@ -402,8 +774,7 @@ class ProbeExperiment:
                             "early_stopping_boredom": early_stopping_boredom,
                         }
                     )
-                    if self.use_wandb:
-                        wandb.log(metrics, step=step)
+                    self.metrics_sink.log(metrics, step=step)
 
                     if math.isnan(score):
                         raise Exception("NaN score")
@@ -411,35 +782,36 @@ class ProbeExperiment:
                     if score > early_stopping_best_score:
                         early_stopping_best_score = score
                         early_stopping_boredom = 0
-                        with tempfile.NamedTemporaryFile(suffix=".pt") as f:
-                            torch.save(self.probe.state_dict(), f.name)
-                            early_stopping_state_dict = torch.load(f.name)
+                        # snapshot the best weights on the device
+                        early_stopping_state_dict = {
+                            k: v.detach().clone()
+                            for k, v in self.probe.state_dict().items()
+                        }
                     else:
                         early_stopping_boredom += 1
 
             # Create batch
-            idxs = random.sample(
-                list(range(X_train.shape[0])),
-                min(self.cfg["batch_size"], X_train.shape[0]),
-            )
-
-            if self.cfg["load_embeddings_in_memory"]:
-                # load embeddings directly, since they are stored in training splits
-                X = X_train[idxs, :]
+            if self.uses_device_splits():
+                if permutation.shape[0] < batch_size:
+                    permutation = torch.randperm(num_train_samples, device=self.device)
+                idxs, permutation = permutation[:batch_size], permutation[batch_size:]
+                X = X_train_device[idxs]
+                y = y_train_device[idxs]
             else:
-                # indexes are stored in splits, retrieve them from disk
-                if model_layer != -1:
-                    X = self.embeddings[X_train[idxs], model_layer, :]
+                # sampling from the range directly is O(batch_size), not O(num_train_samples)
+                idxs = random.sample(range(num_train_samples), batch_size)
+                X = self.get_split_X("train", idxs)
+                y = y_train[idxs]
+
+                if self.cfg["precompute_standardization"]:
+                    X = torch.tensor(X, dtype=torch.float32, device=self.device)
+                    X = standardize(X, standardization)
                 else:
-                    X = self.embeddings[X_train[idxs], :]
+                    self.scaler.partial_fit(X)
+                    X = self.scaler.transform(X)
+                    X = torch.tensor(X, dtype=torch.float32, device=self.device)
 
-            y = y_train[idxs]
-
-            self.scaler.partial_fit(X)
-            X = self.scaler.transform(X)
-            X = torch.tensor(X, dtype=torch.float32, device=self.device)
-
-            y = torch.tensor(y, device=self.device)
+                y = torch.tensor(y, device=self.device)
 
             # Update
             optimizer.zero_grad()
@@ -453,46 +825,175 @@ class ProbeExperiment:
                 loss = loss.item()
                 logging.debug(f"train,{step},{loss}")
 
-                if self.use_wandb:
-                    wandb.log({"train_loss": loss}, step=step)
+                self.metrics_sink.log({"train_loss": loss}, step=step)
+
+    def train_convex(self) -> None:
+        """Fit a linear probe on the full train split with a convex solver.
+
+        This minimizes the same objective as train, the task loss plus the l2 penalty that Adam
+        applies through weight_decay, but exactly rather than by minibatch updates. Multiclass
+        probes are fit with full-batch L-BFGS, regression probes with a closed-form ridge solve.
+        There is no dropout and no early stopping.
+        """
+        X = np.asarray(self.get_split_X("train"), dtype=np.float32)
+        y_train = np.array(self.split_to_y["train"])
+
+        # the whole split is available, so the scaler statistics are exact
+        self.scaler = StandardScaler(
+            with_mean=self.cfg["data_standardization"],
+            with_std=self.cfg["data_standardization"],
+        )
+        X = self.scaler.fit_transform(X)
+        X = torch.tensor(X, dtype=torch.float32, device=self.device)
+        self.metrics_for_graph = []
+
+        self.probe = SimpleMLP(
+            X.shape[1],
+            [],
+            num_outputs=self.cfg["num_outputs"],
+            dropout_p=self.cfg["dropout_p"],
+        )
+        self.probe.to(self.device)
+        self.probe.eval()
+
+        weight_decay = (
+            0 if self.cfg["l2_weight_decay"] is None else self.cfg["l2_weight_decay"]
+        )
+
+        if self.output_type == "regression":
+            # minimize mean((A @ theta - y)^2) + (weight_decay / 2) * |theta|^2, where A has a
+            # column of ones for the bias. Adam decays the bias too, so it is penalized here.
+            n = X.shape[0]
+            A = torch.cat([X, torch.ones(n, 1, device=self.device)], dim=1).double()
+            y = torch.tensor(y_train, device=self.device).double().view(n, -1)
+            if weight_decay == 0:
+                theta = torch.linalg.lstsq(A.cpu(), y.cpu()).solution.to(self.device)
+            else:
+                gram = A.T @ A
+                gram += (n * weight_decay / 2) * torch.eye(
+                    gram.shape[0], dtype=gram.dtype, device=self.device
+                )
+                theta = torch.linalg.solve(gram, A.T @ y)
+
+            with torch.no_grad():
+                self.probe.output.weight.copy_(theta[:-1].T)
+                self.probe.output.bias.copy_(theta[-1])
+        elif self.output_type == "multiclass":
+            y = torch.tensor(y_train, device=self.device)
+            optimizer = torch.optim.LBFGS(
+                self.probe.parameters(),
+                lr=1,
+                max_iter=CONVEX_SOLVER_MAX_ITER,
+                line_search_fn="strong_wolfe",
+            )
+
+            def closure() -> torch.Tensor:
+                optimizer.zero_grad()
+                loss = self.compute_loss(self.probe(X), y)
+                if weight_decay:
+                    loss = loss + (weight_decay / 2) * sum(
+                        p.pow(2).sum() for p in self.probe.parameters()
+                    )
+                loss.backward()
+                return loss
+
+            optimizer.step(closure)
+        else:
+            raise NotImplementedError()
+
+        if not isinstance(self.metrics_sink, NullSink):
+            self.metrics_sink.log(self.eval("valid"), step=0)
 
     def eval_logits(self, X: torch.Tensor) -> torch.Tensor:
-        try:
-            X = self.scaler.transform(X)
-        except sklearn.exceptions.NotFittedError:
-            self.scaler.partial_fit(X)
-            X = self.scaler.transform(X)
+        standardization = None
+        if isinstance(X, torch.Tensor):
+            # a split from get_device_split, already standardized
+            pass
+        elif self.cfg["precompute_standardization"]:
+            # the scaler is frozen, standardize on the device
+            standardization = get_standardization_tensors(self.scaler, self.device)
+        else:
+            try:
+                X = self.scaler.transform(X)
+            except sklearn.exceptions.NotFittedError:
+                self.scaler.partial_fit(X)
+                X = self.scaler.transform(X)
 
         with torch.no_grad():
             self.probe.eval()
             logits = []
             for i in range(0, X.shape[0], self.cfg["batch_size"]):
-                X_batch = torch.tensor(
-                    X[i : i + self.cfg["batch_size"]],
-                    dtype=torch.float32,
-                    device=self.device,
-                )
+                X_batch = X[i : i + self.cfg["batch_size"]]
+                if not isinstance(X_batch, torch.Tensor):
+                    X_batch = torch.tensor(
+                        X_batch, dtype=torch.float32, device=self.device
+                    )
+                if standardization is not None:
+                    X_batch = standardize(X_batch, standardization)
                 logits.append(self.probe(X_batch))
             logits = torch.cat(logits, dim=0)
 
         return logits
 
+    def eval_on_device(self, split_name: str) -> Dict[str, float]:
+        """The metrics of eval, computed on the device. Used to evaluate during training.
+
+        The split is read and moved to the device once. Accuracy and f1 come from a confusion
+        matrix computed on the device and r2 is computed in torch, so an evaluation makes a
+        single device to host copy. The sklearn metrics are left for the final eval.
+        """
+        if self.uses_device_splits():
+            X, y = self.get_device_split(split_name)
+        else:
+            X, y = self.get_standardized_device_split(split_name, self.scaler)
+
+        with torch.no_grad():
+            logits = self.eval_logits(X)
+            values = {"loss": self.compute_loss(logits, y)}
+
+            if self.output_type == "multiclass":
+                primary_metric_name = "accuracy"
+                num_classes = self.cfg["num_outputs"]
+                y_preds = logits.argmax(dim=1)
+                # rows are true classes, columns predicted classes
+                cm = torch.bincount(
+                    y * num_classes + y_preds, minlength=num_classes**2
+                ).view(num_classes, num_classes)
+                tp = cm.diagonal()
+                fp = cm.sum(dim=0) - tp
+                fn = cm.sum(dim=1) - tp
+                values["accuracy"] = tp.sum() / cm.sum()
+                # micro averaged, as torcheval's multiclass_f1_score
+                values["f1"] = 2 * tp.sum() / (2 * tp.sum() + fp.sum() + fn.sum())
+            elif self.output_type == "regression":
+                primary_metric_name = "r2"
+                y = y.double().view(-1)
+                ss_res = ((y - logits.double().view(-1)) ** 2).sum()
+                ss_tot = ((y - y.mean()) ** 2).sum()
+                values["r2"] = 1 - ss_res / ss_tot
+            else:
+                raise NotImplementedError()
+
+            # copy all metrics to the host at once
+            names = list(values.keys())
+            stacked = torch.stack([values[name].double() for name in names])
+            metrics = dict(zip(names, stacked.tolist()))
+
+        metrics["primary_eval_metric"] = metrics[primary_metric_name]
+        metrics["primary"] = metrics[primary_metric_name]
+        return metrics
+
     def eval(
         self, uids_or_split_name: str, X=None, y=None, with_confusion_matrix: bool = False
     ):
         assert isinstance(uids_or_split_name, str)
         split_name = uids_or_split_name
         uids = self.split_to_uids[split_name]
-        if self.cfg["load_embeddings_in_memory"]:
-            X = self.split_to_X[split_name]
-        else:
-            X_idxs, model_layer = self.destructure(self.split_to_X[split_name])
-            if model_layer != -1:
-                X = self.embeddings[X_idxs, model_layer, :]
-            else:
-                X = self.embeddings[X_idxs, :]
-
         y = self.split_to_y[split_name]
+        if self.uses_device_splits():
+            X, _ = self.get_device_split(split_name)
+        else:
+            X = self.get_split_X(split_name)
 
         if self.output_type == "regression":
             # [bs] --> [bs, 1]
@@ -514,7 +1015,7 @@ class ProbeExperiment:
         if self.output_type == "multiclass":
             primary_metric_name = "accuracy"
             y_preds = np.argmax(logits, axis=1)
-            y = np.argmax(y, axis=1)
+            y = np.asarray(y)
             y_correct = y_preds == y
 
             metrics["accuracy"] = y_correct.astype(np.float32).mean()
@@ -548,7 +1049,15 @@ class ProbeExperiment:
         metrics["primary"] = metrics[primary_metric_name]
         return metrics
 
-    def save(self, root_dir: Optional[Union[str, Path]] = None) -> Tuple[str, Path]:
+    def save(
+        self,
+        root_dir: Optional[Union[str, Path]] = None,
+        metrics: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[str, Path]:
+        """Save the probe, its scaler and config, and record its valid metrics.
+
+        The metrics are computed unless given, e.g. by the experiment that trained the probe.
+        """
         if root_dir is None:
             root_dir = CACHE_PROBES_DIR
 
@@ -563,7 +1072,10 @@ class ProbeExperiment:
             pickle.dump(self.scaler, f)
 
         torch.save(self.probe.state_dict(), Path(model_dir, "probe.pt"))
-        self.save_metrics(root_dir)
+        metrics = self.save_metrics(root_dir, metrics)
+
+        # index the run, so that it can be found by uid without searching root_dir
+        ProbeResultStore(root_dir).put(uid, self.cfg, metrics, model_dir=model_dir)
 
         return uid, root_dir
 
@@ -580,22 +1092,47 @@ class ProbeExperiment:
         if delete_metrics_and_config:
             Path(model_dir, "metrics.json").unlink(missing_ok=True)
             Path(model_dir, "cfg.json").unlink(missing_ok=True)
+            ProbeResultStore(root_dir).delete(uid)
 
         Path(model_dir, "scaler.pkl").unlink(missing_ok=True)
         Path(model_dir, "probe.pt").unlink(missing_ok=True)
 
-    def save_metrics(self, root_dir: Optional[str] = None) -> None:
-        with open(Path(root_dir, "metrics.json"), "w") as f:
-            f.write(json.dumps(self.eval("valid"), indent=2, sort_keys=True))
+    def save_metrics(
+        self, root_dir: Optional[str] = None, metrics: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        if root_dir is None:
+            root_dir = CACHE_PROBES_DIR
+
+        # next to the probe, each run has its own metrics
+        model_dir = Path(root_dir, self.cfg["dataset"], self.cfg.uid())
+        model_dir.mkdir(parents=True, exist_ok=True)
+
+        if metrics is None:
+            metrics = self.eval("valid")
+        with open(Path(model_dir, "metrics.json"), "w") as f:
+            f.write(json.dumps(metrics, indent=2, sort_keys=True))
+
+        # the metrics of the most recently saved run are also kept at the root, where they
+        # were written before each run had its own. Concurrent runs replace the file whole.
+        latest_path = Path(root_dir, "metrics.json")
+        tmp_path = latest_path.with_name(f"{latest_path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(metrics, indent=2, sort_keys=True))
+        os.replace(tmp_path, latest_path)
+        return metrics
 
     @classmethod
     def load(cls, uid: str, root_dir=CACHE_PROBES_DIR, **kwargs) -> "ProbeExperiment":
         # load the model state
-        model_dir = [d for d in Path(root_dir).rglob(f"{uid}*") if d.is_dir()]
-        if len(model_dir) < 1:
-            raise ValueError("Could not find model directory")
+        record = ProbeResultStore(root_dir).get(uid)
+        if record is not None and record["model_dir"] is not None:
+            model_dir = record["model_dir"]
+        else:
+            # probes saved before the result store existed are not indexed
+            model_dir = [d for d in Path(root_dir).rglob(f"{uid}*") if d.is_dir()]
+            if len(model_dir) < 1:
+                raise ValueError("Could not find model directory")
 
-        model_dir = model_dir[0]
+            model_dir = model_dir[0]
 
         with open(Path(model_dir, "cfg.json"), "r") as f:
             cfg = ProbeExperimentConfig(json.load(f))
@@ -648,4 +1185,525 @@ class ProbeExperiment:
 
         ax.get_figure().savefig(f"umap_plot_{str(self.dataset_labels_filepath).split("/")[6]}_{self.label_column}_{self.model_type}.png")
 
-        print("done")
\ No newline at end of file
+        print("done")
+
+# probes can only be trained together if they agree on the data they see (the same batches,
+# standardized the same way), their architecture and their termination criteria.
+BATCHED_SHARED_FIELDS = (
+    "model_hash",
+    "dataset",
+    "dataset_embeddings_label_column_name",
+    "num_outputs",
+    "data_standardization",
+    "precompute_standardization",
+    "hidden_layer_sizes",
+    "batch_size",
+    "max_num_epochs",
+    "early_stopping",
+    "early_stopping_eval_frequency",
+    "seed",
+    "load_embeddings_in_memory",
+    "solver",
+)
+
+
+def group_probe_configs(
+    cfgs: List[ProbeExperimentConfig],
+) -> List[List[ProbeExperimentConfig]]:
+    """Partition configs into groups that can be trained together by a BatchedProbeExperiment."""
+    groups = {}
+    for cfg in cfgs:
+        key = json.dumps([cfg[field] for field in BATCHED_SHARED_FIELDS])
+        groups.setdefault(key, []).append(cfg)
+    return list(groups.values())
+
+
+class BatchedProbeExperiment:
+    """Trains many probes together, on the data loaded by a ProbeExperiment.
+
+    The probes are stacked into a single BatchedMLP and trained on shared minibatches, each
+    with its own learning rate, dropout and weight decay. Each probe does its own early
+    stopping: once it runs out of patience its weights are frozen and later restored to its
+    best checkpoint, exactly as ProbeExperiment.train would have done.
+    """
+
+    def __init__(
+        self,
+        cfgs: List[ProbeExperimentConfig],
+        data: ProbeExperiment,
+        summarize_frequency: int = 20,
+    ) -> None:
+        if len(cfgs) == 0 or len(group_probe_configs(cfgs)) != 1:
+            raise ValueError(
+                "Configs must agree on all shared fields, split them with group_probe_configs"
+            )
+        if cfgs[0]["solver"] != "adam":
+            raise ValueError("Only probes trained with adam can be batched")
+        for cfg in cfgs:
+            if not cfg["early_stopping"] and cfg["max_num_epochs"] is None:
+                raise ValueError("No termination criteria specified")
+
+        self.cfgs = cfgs
+        # settings shared by all probes
+        self.cfg = cfgs[0]
+        self.data = data
+        self.scaler = None
+        self.probe = None
+        self.summarize_frequency = summarize_frequency
+        self.device = data.device
+        # standardized splits kept on the device, see ProbeExperiment.get_device_split
+        self.device_splits = {}
+
+    def _per_probe_tensor(self, field: str, default: float = 0) -> torch.Tensor:
+        values = [default if cfg[field] is None else cfg[field] for cfg in self.cfgs]
+        return torch.tensor(values, dtype=torch.float32, device=self.device).view(
+            -1, 1, 1
+        )
+
+    def uses_device_splits(self) -> bool:
+        """See ProbeExperiment.uses_device_splits."""
+        return self.data.has_splits_in_memory() and self.cfg["precompute_standardization"]
+
+    def get_probe_input_dimension(self) -> int:
+        return self.data.get_embedding_dimension()
+
+    def to_probe_inputs(self, X: torch.Tensor) -> torch.Tensor:
+        """The input of the batched probe for a standardized batch, here shared by all probes."""
+        return X
+
+    def compute_losses(self, logits: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        """Mean loss of each probe, logits are of shape (K, batch, num_outputs)."""
+        num_probes, batch_size, num_outputs = logits.shape
+        if self.data.output_type == "multiclass":
+            losses = F.cross_entropy(
+                logits.reshape(num_probes * batch_size, num_outputs),
+                y.repeat(num_probes, *([1] * (y.dim() - 1))),
+                reduction="none",
+            ).view(num_probes, batch_size)
+        elif self.data.output_type == "regression":
+            losses = (logits.squeeze(-1).float() - y.float().view(1, -1)) ** 2
+        else:
+            raise NotImplementedError()
+
+        return losses.mean(dim=1)
+
+    @staticmethod
+    def adam_step(
+        params: List[torch.Tensor],
+        exp_avgs: List[torch.Tensor],
+        exp_avg_sqs: List[torch.Tensor],
+        step: int,
+        lr: torch.Tensor,
+        weight_decay: torch.Tensor,
+        betas: Tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+    ) -> None:
+        """The update of torch.optim.Adam, with a learning rate and weight decay per probe."""
+        beta1, beta2 = betas
+        bias_correction1 = 1 - beta1**step
+        bias_correction2 = 1 - beta2**step
+        with torch.no_grad():
+            for p, exp_avg, exp_avg_sq in zip(params, exp_avgs, exp_avg_sqs):
+                if p.grad is None:
+                    continue
+                # l2 penalty, as in torch.optim.Adam
+                grad = p.grad + p * weight_decay
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+                p.sub_(lr / bias_correction1 * exp_avg / denom)
+
+    def eval_logits(self, X: torch.Tensor) -> torch.Tensor:
+        """Logits of each probe, X is a standardized split on the device."""
+        with torch.no_grad():
+            self.probe.eval()
+            logits = []
+            for i in range(0, X.shape[0], self.cfg["batch_size"]):
+                X_batch = self.to_probe_inputs(X[i : i + self.cfg["batch_size"]])
+                logits.append(self.probe(X_batch))
+            logits = torch.cat(logits, dim=1)
+
+        return logits
+
+    def eval_logits_from_disk(self, split_name: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Logits of each probe and the labels of a split on disk, read a batch at a time.
+
+        The split is never held in memory as a whole, see ProbeExperiment.iter_split_chunks.
+        """
+        batch_size = self.cfg["batch_size"]
+        if not hasattr(self.scaler, "n_samples_seen_"):
+            # as in ProbeExperiment.eval_logits, a scaler that has not seen any training
+            # batch yet is fit to the split that is evaluated
+            for chunk_idxs in self.data.iter_split_chunks(split_name, batch_size):
+                self.scaler.partial_fit(self.data.get_split_X(split_name, chunk_idxs))
+        standardization = get_standardization_tensors(self.scaler, self.device)
+
+        with torch.no_grad():
+            self.probe.eval()
+            logits = []
+            order = []
+            for chunk_idxs in self.data.iter_split_chunks(split_name, batch_size):
+                X = torch.tensor(
+                    self.data.get_split_X(split_name, chunk_idxs),
+                    dtype=torch.float32,
+                    device=self.device,
+                )
+                X = standardize(X, standardization)
+                logits.append(self.probe(self.to_probe_inputs(X)))
+                order.append(chunk_idxs)
+            logits = torch.cat(logits, dim=1)
+
+        order = np.concatenate(order)
+        y = torch.tensor(np.array(self.data.split_to_y[split_name])[order], device=self.device)
+        return logits, y
+
+    def eval(self, split_name: str) -> List[Dict[str, float]]:
+        """Loss and primary metric of each probe on a split."""
+        if self.uses_device_splits():
+            if split_name not in self.device_splits:
+                self.device_splits[split_name] = self.data.load_split_to_device(
+                    split_name, self.scaler
+                )
+            X, y = self.device_splits[split_name]
+            logits = self.eval_logits(X)
+        elif self.data.has_splits_in_memory():
+            X, y = self.data.get_standardized_device_split(split_name, self.scaler)
+            logits = self.eval_logits(X)
+        else:
+            logits, y = self.eval_logits_from_disk(split_name)
+        losses = self.compute_losses(logits, y)
+
+        if self.data.output_type == "multiclass":
+            primary_metric_name = "accuracy"
+            primary = (logits.argmax(dim=-1) == y).float().mean(dim=1)
+        elif self.data.output_type == "regression":
+            primary_metric_name = "r2"
+            y_preds = logits.squeeze(-1)
+            ss_res = ((y.view(1, -1) - y_preds) ** 2).sum(dim=1)
+            ss_tot = ((y - y.mean()) ** 2).sum()
+            primary = 1 - ss_res / ss_tot
+        else:
+            raise NotImplementedError()
+
+        all_metrics = []
+        for loss, value in zip(losses.tolist(), primary.tolist()):
+            metrics = {
+                "loss": loss,
+                primary_metric_name: value,
+                "primary_eval_metric": value,
+                "primary": value,
+            }
+            if self.data.output_type == "multiclass":
+                # micro averaged, as in ProbeExperiment.eval
+                metrics["f1"] = value
+            all_metrics.append(metrics)
+        return all_metrics
+
+    def _get_score(self, cfg: ProbeExperimentConfig, metrics: Dict[str, float]) -> float:
+        if cfg["early_stopping_metric"].startswith("-"):
+            return -1 * metrics[cfg["early_stopping_metric"][1:]]
+        return metrics[cfg["early_stopping_metric"]]
+
+    def train(self) -> None:
+        num_probes = len(self.cfgs)
+        if self.cfg["seed"] is not None:
+            random.seed(self.cfg["seed"])
+            torch.manual_seed(self.cfg["seed"])
+
+        self.probe = BatchedMLP(
+            num_probes,
+            self.get_probe_input_dimension(),
+            self.cfg["hidden_layer_sizes"],
+            num_outputs=self.cfg["num_outputs"],
+            dropout_ps=[cfg["dropout_p"] for cfg in self.cfgs],
+        )
+        self.probe.to(self.device)
+        self.probe.train()
+
+        params = list(self.probe.parameters())
+        exp_avgs = [torch.zeros_like(p) for p in params]
+        exp_avg_sqs = [torch.zeros_like(p) for p in params]
+        learning_rate = self._per_probe_tensor("learning_rate")
+        weight_decay = self._per_probe_tensor("l2_weight_decay")
+        num_train_samples = self.data.get_num_samples("train")
+        # the eval frequency is shared by all probes, the boredom may differ
+        eval_frequency, _ = get_early_stopping_schedule(self.cfg, num_train_samples)
+        max_boredom = torch.tensor(
+            [
+                get_early_stopping_schedule(cfg, num_train_samples)[1]
+                for cfg in self.cfgs
+            ],
+            device=self.device,
+        )
+        y_train = np.array(self.data.split_to_y["train"])
+
+        # all probes see the same batches, so they share a scaler
+        if self.cfg["precompute_standardization"]:
+            self.scaler = self.data.fit_scaler(self.cfg["data_standardization"])
+            standardization = get_standardization_tensors(self.scaler, self.device)
+            self.device_splits = {}
+        else:
+            self.scaler = StandardScaler(
+                with_mean=self.cfg["data_standardization"],
+                with_std=self.cfg["data_standardization"],
+            )
+        self.metrics_for_graph = [[] for _ in range(num_probes)]
+
+        batch_size = min(self.cfg["batch_size"], num_train_samples)
+        if self.uses_device_splits():
+            self.device_splits["train"] = self.data.load_split_to_device(
+                "train", self.scaler
+            )
+            X_train_device, y_train_device = self.device_splits["train"]
+            permutation = torch.empty(0, dtype=torch.long, device=self.device)
+
+        # Train model
+        step = 0
+        best_scores = torch.full((num_probes,), float("-inf"), device=self.device)
+        boredom = torch.zeros(num_probes, dtype=torch.long, device=self.device)
+        # probes that have not yet run out of patience
+        is_active = torch.ones(num_probes, dtype=torch.bool, device=self.device)
+        has_best = torch.zeros(num_probes, dtype=torch.bool, device=self.device)
+        best_params = [p.detach().clone() for p in params]
+
+        while True:
+            # Check if exceeded max num epochs
+            epoch = (step * self.cfg["batch_size"]) / num_train_samples
+            if (
+                self.cfg["max_num_epochs"] is not None
+                and epoch > self.cfg["max_num_epochs"]
+            ):
+                break
+
+            # Evaluate for early stopping
+            if (
+                self.cfg["early_stopping"]
+                and step % eval_frequency == 0
+            ):
+                is_active &= boredom < max_boredom
+                if not is_active.any():
+                    break
+
+                with torch.no_grad():
+                    all_metrics = self.eval("valid")
+                    self.probe.train()
+
+                    scores = torch.tensor(
+                        [
+                            self._get_score(cfg, metrics)
+                            for cfg, metrics in zip(self.cfgs, all_metrics)
+                        ],
+                        device=self.device,
+                    )
+                    # unlike a single run, a diverged probe must not fail the whole group,
+                    # it stops here and keeps its best weights. Its metrics are reported as
+                    # those of a failed run, not as an early stop
+                    is_nan = torch.isnan(scores)
+                    diverged = torch.nonzero(is_nan & is_active).flatten().tolist()
+                    if diverged:
+                        logging.warning(f"NaN score for probes: {diverged}")
+
+                    for k in torch.nonzero(is_active).flatten().tolist():
+                        metrics = all_metrics[k]
+                        metrics.update(
+                            {
+                                "epoch": epoch,
+                                "early_stopping_score": scores[k].item(),
+                                "early_stopping_best_score": best_scores[k].item(),
+                                "early_stopping_boredom": boredom[k].item(),
+                            }
+                        )
+                        self.metrics_for_graph[k].append((step, metrics))
+                    for k in diverged:
+                        # as ProbeExperiment.train raises, see local_sweep
+                        self.metrics_for_graph[k].append((step, {"error": "NaN score"}))
+                    is_active &= ~is_nan
+                    logging.info(f"eval,{step},{scores.tolist()}")
+
+                    improved = is_active & (scores > best_scores)
+                    best_scores = torch.where(improved, scores, best_scores)
+                    boredom = torch.where(improved, 0, boredom + is_active.long())
+                    has_best |= improved
+                    for p, best_p in zip(params, best_params):
+                        best_p[improved] = p[improved]
+
+            # Create batch
+            if self.uses_device_splits():
+                if permutation.shape[0] < batch_size:
+                    permutation = torch.randperm(num_train_samples, device=self.device)
+                idxs, permutation = permutation[:batch_size], permutation[batch_size:]
+                X = X_train_device[idxs]
+                y = y_train_device[idxs]
+            else:
+                idxs = random.sample(range(num_train_samples), batch_size)
+                X = self.data.get_split_X("train", idxs)
+                y = y_train[idxs]
+
+                if self.cfg["precompute_standardization"]:
+                    X = torch.tensor(X, dtype=torch.float32, device=self.device)
+                    X = standardize(X, standardization)
+                else:
+                    self.scaler.partial_fit(X)
+                    X = self.scaler.transform(X)
+                    X = torch.tensor(X, dtype=torch.float32, device=self.device)
+                y = torch.tensor(y, device=self.device)
+
+            # Update, probes that stopped early are frozen
+            for p in params:
+                p.grad = None
+            losses = self.compute_losses(self.probe(self.to_probe_inputs(X)), y)
+            (losses * is_active).sum().backward()
+            step += 1
+            self.adam_step(
+                params,
+                exp_avgs,
+                exp_avg_sqs,
+                step,
+                learning_rate * is_active.view(-1, 1, 1),
+                weight_decay,
+            )
+
+            # Summarize
+            if step % self.summarize_frequency == 0:
+                losses = losses.tolist()
+                logging.debug(f"train,{step},{losses}")
+
+                for k in torch.nonzero(is_active).flatten().tolist():
+                    self.metrics_for_graph[k].append((step, {"train_loss": losses[k]}))
+
+        # probes that ran out of patience go back to their best weights
+        restore = ~is_active & has_best
+        with torch.no_grad():
+            for p, best_p in zip(params, best_params):
+                p[restore] = best_p[restore]
+
+    def to_experiments(self) -> List[ProbeExperiment]:
+        """A ProbeExperiment for each trained probe, in the order of the configs."""
+        experiments = []
+        for k, cfg in enumerate(self.cfgs):
+            exp = ProbeExperiment(
+                cfg,
+                pretrained_scaler=copy.deepcopy(self.scaler),
+                pretrained_probe=self.probe.to_simple_mlp(k),
+                summarize_frequency=self.summarize_frequency,
+                use_wandb=False,
+                model_type=self.data.model_type,
+            )
+            exp.share_data_from(self.data)
+            exp.metrics_for_graph = self.metrics_for_graph[k]
+            experiments.append(exp)
+        return experiments
+
+
+class LayerwiseProbeExperiment(BatchedProbeExperiment):
+    """Trains a probe for every layer of a foundation model side by side.
+
+    The data must be loaded with model_layer=None, so that a sample holds the embeddings of
+    all layers, concatenated. Each batch is then read once for all layers, and probe k is
+    trained on the slice of layer k. The configs are given per layer, in layer order, and
+    may only differ in their model_hash.
+    """
+
+    def __init__(
+        self,
+        cfgs: List[ProbeExperimentConfig],
+        data: ProbeExperiment,
+        summarize_frequency: int = 20,
+    ) -> None:
+        # the layers of a model differ in their model_hash, which batching requires to agree
+        super().__init__(
+            [
+                ProbeExperimentConfig({**cfg, "model_hash": cfgs[0]["model_hash"]})
+                for cfg in cfgs
+            ],
+            data,
+            summarize_frequency,
+        )
+        self.cfgs = cfgs
+
+        if data.get_embedding_dimension() % len(cfgs) != 0:
+            raise ValueError(
+                f"Embeddings of dimension {data.get_embedding_dimension()} can not be split into {len(cfgs)} layers"
+            )
+
+    def get_probe_input_dimension(self) -> int:
+        return self.data.get_embedding_dimension() // len(self.cfgs)
+
+    def to_probe_inputs(self, X: torch.Tensor) -> torch.Tensor:
+        """(batch, layers * dim) --> (layers, batch, dim), so that probe k sees layer k."""
+        return X.reshape(X.shape[0], len(self.cfgs), -1).transpose(0, 1)
+
+    def to_experiments(self) -> List[ProbeExperiment]:
+        """A ProbeExperiment for each layer, in layer order.
+
+        The probe and scaler of layer k take the embeddings of layer k only, and the
+        experiment shares the data of this one, restricted to that layer without a copy.
+        """
+        dim = self.get_probe_input_dimension()
+        experiments = []
+        for k, cfg in enumerate(self.cfgs):
+            exp = ProbeExperiment(
+                cfg,
+                pretrained_scaler=slice_scaler(self.scaler, slice(k * dim, (k + 1) * dim)),
+                pretrained_probe=self.probe.to_simple_mlp(k),
+                summarize_frequency=self.summarize_frequency,
+                use_wandb=False,
+                model_type=self.data.model_type,
+            )
+            split_to_X = {}
+            for split_name, X in self.data.split_to_X.items():
+                if isinstance(X, tuple):
+                    # the indexes of the samples in the zarr, read from the layer axis
+                    split_to_X[split_name] = (X[0], k)
+                else:
+                    split_to_X[split_name] = X[:, k * dim : (k + 1) * dim]
+            exp.set_data({**self.data.get_data(), "split_to_X": split_to_X})
+            exp.metrics_for_graph = self.metrics_for_graph[k]
+            experiments.append(exp)
+        return experiments
+
+
+def train_probes_batched(
+    cfgs: List[ProbeExperimentConfig],
+    data: ProbeExperiment,
+    summarize_frequency: int = 20,
+    metrics_sinks: Optional[List[MetricsSink]] = None,
+) -> List[ProbeExperiment]:
+    """Train probes for many configs on the same loaded data, batching compatible configs.
+
+    If given, the metrics of each config are reported to its sink as ProbeExperiment.train
+    reports them: the train loss and the metrics of every early stopping evaluation, or the
+    valid metrics of a convex fit. A batched probe whose score went NaN stops without failing
+    the others, and its sink gets the error that ProbeExperiment.train would have raised.
+
+    Returns: A trained ProbeExperiment for each config, in the order the configs were given.
+    """
+    if metrics_sinks is None:
+        metrics_sinks = [NullSink() for _ in cfgs]
+    cfg_to_sink = {id(cfg): sink for cfg, sink in zip(cfgs, metrics_sinks)}
+
+    trained = {}
+    for group in group_probe_configs(cfgs):
+        if group[0]["solver"] == "convex":
+            # already fast, fit each on its own
+            for cfg in group:
+                exp = ProbeExperiment(
+                    cfg,
+                    summarize_frequency=summarize_frequency,
+                    use_wandb=False,
+                    model_type=data.model_type,
+                    metrics_sink=cfg_to_sink[id(cfg)],
+                )
+                exp.share_data_from(data)
+                exp.train()
+                trained[id(cfg)] = exp
+            continue
+
+        batched = BatchedProbeExperiment(group, data, summarize_frequency)
+        batched.train()
+        for cfg, exp in zip(group, batched.to_experiments()):
+            exp.metrics_sink = cfg_to_sink[id(cfg)]
+            for step, metrics in exp.metrics_for_graph:
+                exp.metrics_sink.log(metrics, step=step)
+            trained[id(cfg)] = exp
+    return [trained[id(cfg)] for cfg in cfgs]
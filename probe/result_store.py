@@ -0,0 +1,103 @@
+import json
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, Optional, Set, Union
+
+RESULT_STORE_FILENAME = "results.sqlite"
+
+
+class ProbeResultStore:
+    """Index of finished probe runs, keyed by the uid of their config.
+
+    A single SQLite file at the root of the probes directory, next to the per-dataset model
+    directories written by ProbeExperiment.save. Finding a run is one indexed lookup instead
+    of a walk of the directory tree, so a sweep job can check whether its config already
+    finished before loading any data. Every operation opens its own connection, so jobs
+    running at the same time can share the store.
+    """
+
+    def __init__(self, root_dir: Union[str, Path], timeout: float = 60) -> None:
+        self.root_dir = Path(root_dir)
+        self.path = self.root_dir / RESULT_STORE_FILENAME
+        # seconds to wait for another job's write to finish
+        self.timeout = timeout
+
+    def _connect(self) -> sqlite3.Connection:
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                uid TEXT PRIMARY KEY,
+                dataset TEXT NOT NULL,
+                model_dir TEXT,
+                cfg TEXT NOT NULL,
+                metrics TEXT NOT NULL,
+                finished_at REAL NOT NULL
+            )
+            """
+        )
+        return conn
+
+    def put(
+        self,
+        uid: str,
+        cfg: Dict[str, Any],
+        metrics: Dict[str, Any],
+        model_dir: Optional[Union[str, Path]] = None,
+    ) -> None:
+        """Record a finished run, replacing any earlier record of the same config.
+
+        model_dir is where the probe was saved, if it was.
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    uid,
+                    cfg["dataset"],
+                    None if model_dir is None else str(model_dir),
+                    json.dumps(cfg, sort_keys=True),
+                    json.dumps(metrics, sort_keys=True),
+                    time.time(),
+                ),
+            )
+
+    def get(self, uid: str) -> Optional[Dict[str, Any]]:
+        """The record of a finished run, or None if the config has not finished."""
+        if not self.path.is_file():
+            return None
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT uid, dataset, model_dir, cfg, metrics, finished_at FROM results WHERE uid = ?",
+                (uid,),
+            ).fetchone()
+        if row is None:
+            return None
+        uid, dataset, model_dir, cfg, metrics, finished_at = row
+        return {
+            "uid": uid,
+            "dataset": dataset,
+            "model_dir": None if model_dir is None else Path(model_dir),
+            "cfg": json.loads(cfg),
+            "metrics": json.loads(metrics),
+            "finished_at": finished_at,
+        }
+
+    def uids(self) -> Set[str]:
+        """The uids of every finished run, in one query."""
+        if not self.path.is_file():
+            return set()
+        with closing(self._connect()) as conn:
+            return {uid for (uid,) in conn.execute("SELECT uid FROM results")}
+
+    def __contains__(self, uid: str) -> bool:
+        return self.get(uid) is not None
+
+    def delete(self, uid: str) -> None:
+        if not self.path.is_file():
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM results WHERE uid = ?", (uid,))
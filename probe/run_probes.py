@@ -24,7 +24,7 @@ SLURM_JOB_BASE = r"""
 conda activate {conda_env_name}
 
 # Run the script
-python probe/main.py --sweep_id {sweep_id} --wandb_project {wandb_project}
+python probe/main.py --sweep_id {sweep_id} --wandb_project {wandb_project} --count {configs_per_job}{extra_args}
 """
 
 if __name__ == "__main__":
@@ -35,6 +35,10 @@ if __name__ == "__main__":
     parser.add_argument("--conda_env_name", type=str, default="syntheory")
     parser.add_argument("--sweep_config", type=str, default="jukebox")
     parser.add_argument("--slurm_jobs", type=int, default=1000)
+    # each job runs this many sweep configs in one process, sharing the loaded embeddings
+    parser.add_argument("--configs_per_job", type=int, default=1)
+    # skip sweep configs that already finished, so resubmitted jobs do not redo them
+    parser.add_argument("--skip_done", action="store_true")
     parser.add_argument("--gpu_partition", type=str)
     args = parser.parse_args()
 
@@ -75,6 +79,8 @@ if __name__ == "__main__":
             sweep_id=sweep_id,
             wandb_project=wandb_project_name,
             slurm_partition=args.gpu_partition,
+            configs_per_job=args.configs_per_job,
+            extra_args=" --skip_done" if args.skip_done else "",
         ).strip()
 
         # write the slurm jobs to a shell script, change permissions of that file
@@ -0,0 +1,130 @@
+import os
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+SPLIT_NAMES = ("train", "test", "valid")
+
+# shuffle, then split 0.7 / 0.15 / 0.15
+RANDOM_SPLIT = "random"
+# train on the middle 70% of tempos, test and validate on the lowest and highest 15%
+TEMPO_EXTRAPOLATION_SPLIT = "tempo_extrapolation"
+SPLIT_POLICIES = (RANDOM_SPLIT, TEMPO_EXTRAPOLATION_SPLIT)
+
+# split indices are stored compactly, labels files have far fewer than 2^31 rows
+SPLIT_INDEX_DTYPE = np.int32
+
+
+def get_split_policy(dataset: str, output_type: str) -> str:
+    if dataset == "tempos" and output_type == "regression":
+        # order is important, we want to test the out of domain extrapolation power of
+        # the embeddings.
+        return TEMPO_EXTRAPOLATION_SPLIT
+    return RANDOM_SPLIT
+
+
+def compute_split_positions(
+    dataset_labels: pd.DataFrame,
+    seed: Optional[int],
+    policy: str = RANDOM_SPLIT,
+    train_size: float = 0.7,
+) -> Dict[str, np.ndarray]:
+    """The row positions in dataset_labels of the samples in each split, in split order.
+
+    train_size only applies to the random policy.
+    """
+    # track the rows through the same DataFrame operations that used to build the splits,
+    # so that the splits are exactly the same
+    df = pd.DataFrame({"position": np.arange(dataset_labels.shape[0])})
+
+    if policy == RANDOM_SPLIT:
+        df_shuffled = df.sample(frac=1, random_state=seed)
+
+        # k train, (1-k)/2 test, (1-k)/2 valid
+        train_df, non_train_df = train_test_split(
+            df_shuffled, train_size=train_size, random_state=seed
+        )
+        valid_df, test_df = train_test_split(
+            non_train_df, test_size=0.5, random_state=seed
+        )
+    elif policy == TEMPO_EXTRAPOLATION_SPLIT:
+        df["bpm"] = dataset_labels["bpm"].to_numpy()
+        df = df.sort_values(by=["bpm"])
+        ends = 0.15
+        dataset_size = df.shape[0]
+        lb_idx = int(dataset_size * (ends))
+        ub_idx = int(dataset_size * (1 - ends))
+
+        # train on BPMs within a specific middle range, our train/test/valid splits are
+        # still 0.7, 0.15, 0.15.
+        train_df = df.iloc[lb_idx:ub_idx]
+        hold_out_df = pd.concat([df.iloc[:lb_idx], df.iloc[ub_idx:]], axis=0)
+        hold_out_shuffled = hold_out_df.sample(frac=1, random_state=seed)
+        test_df, valid_df = train_test_split(
+            hold_out_shuffled, train_size=0.5, random_state=seed
+        )
+    else:
+        raise ValueError(f"Unknown split policy {policy}")
+
+    return {
+        "train": train_df["position"].to_numpy(dtype=SPLIT_INDEX_DTYPE),
+        "test": test_df["position"].to_numpy(dtype=SPLIT_INDEX_DTYPE),
+        "valid": valid_df["position"].to_numpy(dtype=SPLIT_INDEX_DTYPE),
+    }
+
+
+def get_split_filepath(
+    dataset_labels_filepath: Union[str, Path], seed: int, policy: str, split_name: str
+) -> Path:
+    """Split index files live next to the labels file they index, e.g. prompts.csv."""
+    dataset_labels_filepath = Path(dataset_labels_filepath)
+    return dataset_labels_filepath.parent / (
+        f"{dataset_labels_filepath.stem}_split_{policy}_seed_{seed}_{split_name}.npy"
+    )
+
+
+def load_split_positions(
+    dataset_labels_filepath: Union[str, Path],
+    dataset_labels: pd.DataFrame,
+    seed: Optional[int],
+    policy: str = RANDOM_SPLIT,
+) -> Dict[str, np.ndarray]:
+    """The row positions of each split, computed once per (labels file, seed, policy).
+
+    The first call writes them as int32 .npy files next to the labels file, later calls
+    memory map them. Index files older than the labels file are recomputed. Without a
+    seed the splits are not reproducible, so they are computed and never stored.
+    """
+    if seed is None:
+        return compute_split_positions(dataset_labels, seed, policy)
+
+    labels_mtime_ns = Path(dataset_labels_filepath).stat().st_mtime_ns
+    paths = {
+        split_name: get_split_filepath(dataset_labels_filepath, seed, policy, split_name)
+        for split_name in SPLIT_NAMES
+    }
+    if all(
+        p.is_file() and p.stat().st_mtime_ns >= labels_mtime_ns for p in paths.values()
+    ):
+        positions = {
+            split_name: np.load(p, mmap_mode="r") for split_name, p in paths.items()
+        }
+        if sum(len(v) for v in positions.values()) == dataset_labels.shape[0]:
+            return positions
+
+    positions = compute_split_positions(dataset_labels, seed, policy)
+    try:
+        for split_name, path in paths.items():
+            # write to a temporary name and move it into place, so that concurrent runs
+            # never read a partially written file
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, positions[split_name])
+            os.replace(tmp_path, path)
+    except OSError:
+        # the dataset folder may be read only, the splits are still correct
+        pass
+    return positions
@@ -0,0 +1,55 @@
+import tempfile
+from pathlib import Path
+
+import mido
+import soundfile as sf
+
+from benchmarks.run_benchmarks import (
+    STUB_SYNTH_SAMPLE_RATE,
+    benchmark_probe,
+    compare_results,
+    stub_synth_wav_from_midi,
+)
+
+
+def test_stub_synth() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        midi_file = mido.MidiFile()
+        track = mido.MidiTrack()
+        track.append(mido.Message("note_on", note=60, time=0))
+        # two beats at the default tempo, one second
+        track.append(mido.Message("note_off", note=60, time=2 * midi_file.ticks_per_beat))
+        midi_file.tracks.append(track)
+        midi_path = Path(tmp_dir, "a.mid")
+        midi_file.save(midi_path)
+
+        stub_synth_wav_from_midi(midi_path)
+        audio, sample_rate = sf.read(str(midi_path.with_suffix(".wav")))
+        assert sample_rate == STUB_SYNTH_SAMPLE_RATE
+        # the MIDI and one second of release
+        assert audio.shape == (2 * STUB_SYNTH_SAMPLE_RATE, 2)
+        assert abs(audio).max() > 0
+
+
+def test_benchmark_probe() -> None:
+    result = benchmark_probe(num_samples=256, embedding_dimension=16, num_epochs=1)
+    # one epoch of batches of 64
+    assert result["num_items"] == 5
+    assert result["items_per_sec"] > 0
+
+
+def test_compare_results() -> None:
+    old = {
+        "probes": {"linear": {"items_per_sec": 100.0}, "mlp": {"items_per_sec": 10.0}},
+        "embeddings": {"JUKEBOX": {"skipped": "no weights"}},
+    }
+    new = {
+        "probes": {
+            "linear": {"items_per_sec": 50.0},
+            "mlp": {"error": "failed"},
+            "new": {"items_per_sec": 1.0},
+        },
+        "embeddings": {"JUKEBOX": {"skipped": "no weights"}},
+    }
+    # only benchmarks that ran both times are compared
+    assert compare_results(old, new) == [("probes/linear", 0.5)]
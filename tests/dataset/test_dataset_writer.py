@@ -1,5 +1,7 @@
 from typing import Iterator, List
 from pathlib import Path
+from unittest.mock import patch
+import json
 import tempfile
 import uuid
 
@@ -7,6 +9,7 @@ import pytest
 import pandas as pd
 
 from dataset.synthetic.dataset_writer import DatasetWriter, DatasetRowDescription
+from instrumentation import INSTRUMENTATION_LOG_ENV_VAR
 
 
 def _get_row_iterator() -> Iterator[DatasetRowDescription]:
@@ -113,3 +116,21 @@ def test_dataset_writer_row_processor_throws_exception() -> None:
         # the row processor failed, so there should not be any residual files
         # that leaves the dataset in an inconsistent state
         assert len(list(tmp_path.rglob("*"))) == 0
+
+
+def test_dataset_writer_instrumentation() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_path = Path(tmp_dir, "log.jsonl")
+        with patch.dict("os.environ", {INSTRUMENTATION_LOG_ENV_VAR: str(log_path)}):
+            DatasetWriter(
+                "test", Path(tmp_dir), _get_row_iterator(), _row_processor, max_processes=2
+            ).create_dataset()
+
+        record = json.loads(log_path.read_text())
+        assert record["event"] == "dataset_writer"
+        assert record["dataset_name"] == "test"
+        assert record["status"] == "done"
+        # the rows were processed in the worker processes
+        assert record["spans"]["dataset_writer.row"]["count"] == 100
+        assert record["spans"]["dataset_writer.csv_write"]["count"] == 1
+        assert record["counters"] == {"dataset_writer.samples": 100}
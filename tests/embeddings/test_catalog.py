@@ -0,0 +1,72 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import zarr
+
+from embeddings.catalog import (
+    CATALOG_FILENAME,
+    EmbeddingsCatalog,
+    get_model_type_and_size,
+    register_embeddings,
+)
+
+
+def _extract(dataset_folder: Path, model_name: str, model_hash: str, shape) -> Path:
+    zarr_filepath = dataset_folder / f"{dataset_folder.name}_{model_name}_{model_hash}.zarr"
+    zarr.save(str(zarr_filepath), np.zeros(shape, dtype=np.float32))
+    (dataset_folder / f"{dataset_folder.name}_{model_hash}.json").write_text(
+        json.dumps({"model_name": model_name})
+    )
+    return zarr_filepath
+
+
+def test_get_model_type_and_size() -> None:
+    assert get_model_type_and_size("JUKEBOX") == ("JUKEBOX", "L")
+    assert get_model_type_and_size("MUSICGEN_DECODER_LM_S") == ("MUSICGEN_DECODER", "S")
+    assert get_model_type_and_size("MUSICGEN_AUDIO_ENCODER") == ("MUSICGEN_AUDIO_ENCODER", "L")
+    assert get_model_type_and_size("CHROMA") == ("CHROMA", "L")
+
+
+def test_catalog() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        dataset_folder.mkdir()
+        decoder_path = _extract(dataset_folder, "MUSICGEN_DECODER_LM_S", "abc", (4, 3, 2))
+        chroma_path = _extract(dataset_folder, "CHROMA", "def", (4, 12))
+
+        # zarrs extracted before the catalog existed are added to it
+        catalog = EmbeddingsCatalog.load(dataset_folder)
+        assert len(catalog) == 2
+        assert (dataset_folder / CATALOG_FILENAME).is_file()
+
+        entry = catalog.find("MUSICGEN_DECODER_LM", "S", 2)
+        assert entry["zarr_filepath"] == decoder_path
+        assert entry["embeddings_dataset_shape"] == (4, 3, 2)
+        assert entry["dtype"] == "float32"
+        assert entry["model_hash"] == "abc"
+        assert catalog.find("MUSICGEN_DECODER", "S", 3) is None
+        assert catalog.find("MUSICGEN_DECODER", "L", 0) is None
+        assert catalog.find("MUSICGEN_DECODER", "S", "all") is entry
+        assert catalog.find("CHROMA", "L", "all") is None
+        assert catalog.find("CHROMA", "L", 0)["zarr_filepath"] == chroma_path
+
+        # later loads open no arrays
+        with patch("embeddings.catalog.zarr.open", side_effect=AssertionError):
+            catalog = EmbeddingsCatalog.load(dataset_folder)
+            assert catalog.find("MUSICGEN_DECODER", "S", 2)["zarr_filepath"] == decoder_path
+
+        # a zarr that is extracted again replaces its entry
+        register_embeddings(
+            dataset_folder,
+            decoder_path,
+            "abc",
+            {"model_name": "MUSICGEN_DECODER_LM_S"},
+            (4, 5, 2),
+            np.float32,
+        )
+        catalog = EmbeddingsCatalog.load(dataset_folder)
+        assert len(catalog) == 2
+        assert catalog.find("MUSICGEN_DECODER", "S", 4)["embeddings_dataset_shape"] == (4, 5, 2)
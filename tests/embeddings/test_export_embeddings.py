@@ -0,0 +1,62 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import zarr
+
+from embeddings.export_embeddings import (
+    export_zarr_to_npy,
+    get_exported_embeddings_path,
+    load_exported_embeddings,
+)
+
+
+def test_export_zarr_to_npy() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zarr_path = Path(tmp_dir) / "notes_CHROMA_abc.zarr"
+        embeddings = np.random.rand(37, 3, 5)
+        zarr.save(str(zarr_path), embeddings)
+
+        # no export yet
+        assert load_exported_embeddings(zarr_path, 0) is None
+
+        # chunk size does not evenly divide the number of samples
+        written = export_zarr_to_npy(zarr_path, chunk_size=10)
+        assert written == [get_exported_embeddings_path(zarr_path, i) for i in range(3)]
+
+        for layer in range(3):
+            exported = load_exported_embeddings(zarr_path, layer)
+            assert isinstance(exported, np.memmap)
+            assert exported.dtype == np.float32
+            assert np.allclose(exported, embeddings[:, layer, :].astype(np.float32))
+
+        # already exported, nothing to do
+        assert export_zarr_to_npy(zarr_path) == []
+
+
+def test_export_zarr_to_npy_without_layers() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zarr_path = Path(tmp_dir) / "notes_MFCC_abc.zarr"
+        embeddings = np.random.rand(12, 4)
+        zarr.save(str(zarr_path), embeddings)
+
+        written = export_zarr_to_npy(zarr_path)
+        assert written == [Path(tmp_dir) / "notes_MFCC_abc.npy"]
+        assert np.allclose(load_exported_embeddings(zarr_path), embeddings)
+
+
+def test_stale_export_is_ignored_and_rewritten() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zarr_path = Path(tmp_dir) / "notes_CHROMA_abc.zarr"
+        zarr.save(str(zarr_path), np.zeros((8, 2, 3)))
+        export_zarr_to_npy(zarr_path)
+        export_path = get_exported_embeddings_path(zarr_path, 1)
+
+        # the embeddings are extracted again after the export was written
+        zarr.save(str(zarr_path), np.ones((8, 2, 3)))
+        os.utime(export_path, ns=(0, 0))
+        assert load_exported_embeddings(zarr_path, 1) is None
+
+        assert export_path in export_zarr_to_npy(zarr_path)
+        assert np.allclose(load_exported_embeddings(zarr_path, 1), 1.0)
@@ -1,4 +1,19 @@
-from embeddings.extract_embeddings import DatasetEmbeddingInformation
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import zarr
+
+from embeddings.config_checksum import compute_checksum
+from embeddings.extract_embeddings import (
+    DatasetEmbeddingInformation,
+    extract_embeddings_for_dataset_with_model,
+    extract_from_work_queue,
+)
+from embeddings.work_queue import DONE, FAILED, WorkQueue, get_work_queue_path
 
 def test_get_shard_sizes() -> None:
     # evenly divides
@@ -19,3 +34,136 @@ def test_get_shard_sizes() -> None:
         300,
         1
     ]
+
+
+def test_extract_from_work_queue() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        dataset_folder.mkdir()
+        model_config = {"model_name": "CHROMA", "model_type": "CHROMA", "minimum_duration_in_sec": 1}
+        checksum = compute_checksum(model_config)
+        prefix = f"notes_{checksum}"
+        (dataset_folder / f"{prefix}.json").write_text(json.dumps(model_config))
+        # the extraction of a loaded model config reads the prompts of the dataset
+        pd.DataFrame({"prompt": [f"prompt {i}" for i in range(10)]}).to_csv(
+            dataset_folder / "prompts.csv"
+        )
+        pd.DataFrame(
+            {
+                "zarr_idx": range(10),
+                "dataset_shard": [0] * 10,
+                "audio_file_path": [f"{i}.wav" for i in range(10)],
+            }
+        ).to_csv(dataset_folder / f"{prefix}_embeddings_info.csv")
+        zarr_file = zarr.open(
+            str(dataset_folder / f"notes_CHROMA_{checksum}.zarr"), mode="w", shape=(10, 3), dtype="f4"
+        )
+        WorkQueue.create(get_work_queue_path(dataset_folder, checksum), 10, lease_size=4).close()
+
+        def fake_extract_sample(sample_info, dataset_folder, zarr_file, *args, **kwargs):
+            zarr_file[sample_info["zarr_idx"]] = sample_info["zarr_idx"] + 1
+            return True
+
+        with patch("embeddings.extract_embeddings.extract_sample", side_effect=fake_extract_sample):
+            _, written_idx = extract_from_work_queue("notes", checksum, root_dir=Path(tmp_dir))
+
+        assert sorted(written_idx) == list(range(10))
+        np.testing.assert_array_equal(zarr_file[:, 0], np.arange(1, 11))
+        queue = WorkQueue(get_work_queue_path(dataset_folder, checksum))
+        assert queue.is_done()
+        queue.close()
+
+        # a bad sample fails its range, the worker still extracts the other ranges
+        get_work_queue_path(dataset_folder, checksum).unlink()
+        WorkQueue.create(get_work_queue_path(dataset_folder, checksum), 10, lease_size=4).close()
+        zarr_file[:] = 0
+
+        def failing_extract_sample(sample_info, *args, **kwargs):
+            if sample_info["zarr_idx"] == 5:
+                raise RuntimeError("bad audio file")
+            return fake_extract_sample(sample_info, *args, **kwargs)
+
+        with patch("embeddings.extract_embeddings.extract_sample", side_effect=failing_extract_sample):
+            _, written_idx = extract_from_work_queue("notes", checksum, root_dir=Path(tmp_dir))
+
+        assert sorted(written_idx) == [0, 1, 2, 3, 8, 9]
+        queue = WorkQueue(get_work_queue_path(dataset_folder, checksum))
+        progress = queue.progress()
+        assert progress[FAILED] == 4
+        assert progress[DONE] == 6
+        queue.close()
+
+
+def test_work_queue_extraction_writes_no_shard_scripts() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        dataset_folder.mkdir()
+        pd.DataFrame({"synth_file_path": [f"{i}.wav" for i in range(7)]}).to_csv(
+            dataset_folder / "info.csv"
+        )
+        model_config = {"model_name": "CHROMA", "model_type": "CHROMA", "minimum_duration_in_sec": 1}
+        checksum = compute_checksum(model_config)
+
+        with patch("subprocess.run") as mock_run:
+            slurm_files = extract_embeddings_for_dataset_with_model(
+                dataset_folder, model_config, "syntheory", "gpu", ["audio"], 3, work_queue_workers=2
+            )
+
+        # only the workers are submitted, and no shard script is left that looks submittable
+        assert [p.name for p in slurm_files] == [
+            f"tmp_slurm_{checksum}_worker_0.sh",
+            f"tmp_slurm_{checksum}_worker_1.sh",
+        ]
+        assert sorted(dataset_folder.glob("tmp_slurm_*.sh")) == slurm_files
+        assert mock_run.call_count == 4
+        assert (dataset_folder / f"notes_{checksum}_embeddings_info.csv").is_file()
+        assert get_work_queue_path(dataset_folder, checksum).is_file()
+
+
+def test_shard_manifests() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        dataset_folder.mkdir()
+        pd.DataFrame(
+            {"synth_file_path": [f"{i}.wav" for i in range(7)], "note": list("ABCDEFG")}
+        ).to_csv(dataset_folder / "info.csv")
+        model_config = {"model_name": "CHROMA", "model_type": "CHROMA", "minimum_duration_in_sec": 1}
+        embedding_info = DatasetEmbeddingInformation(dataset_folder, model_config, 3, ["audio"])
+        embedding_info.write_shard_runner_scripts_and_embedding_info_csv("syntheory", "gpu")
+
+        # each shard has its own rows, without the details of the samples
+        manifest = embedding_info.read_shard_manifest(2)
+        assert list(manifest.columns) == ["zarr_idx", "dataset_shard", "audio_file_path"]
+        assert manifest["zarr_idx"].tolist() == [6]
+        assert embedding_info.read_shard_manifest(1)["audio_file_path"].tolist() == ["3.wav", "4.wav", "5.wav"]
+
+        # extractions from before the manifests read the embeddings info csv
+        embedding_info.get_shard_manifest_path(1).unlink()
+        pd.testing.assert_frame_equal(
+            embedding_info.read_shard_manifest(1),
+            pd.DataFrame(
+                {"zarr_idx": [3, 4, 5], "dataset_shard": 1, "audio_file_path": ["3.wav", "4.wav", "5.wav"]}
+            ),
+        )
+
+
+def test_get_or_create_zarr_file_writes_no_chunks() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        dataset_folder.mkdir()
+        # the audio files do not exist, nothing is extracted to find the shape
+        pd.DataFrame({"synth_file_path": [f"{i}.wav" for i in range(700)]}).to_csv(
+            dataset_folder / "info.csv"
+        )
+        model_config = {"model_name": "CHROMA", "model_type": "CHROMA", "minimum_duration_in_sec": 1}
+        embedding_info = DatasetEmbeddingInformation(dataset_folder, model_config, 300, ["audio"])
+        zarr_file = embedding_info.get_or_create_zarr_file()
+
+        assert zarr_file.shape == (700, 72)
+        assert zarr_file.dtype == np.float32
+        assert zarr_file.nchunks_initialized == 0
+        assert not np.any(zarr_file[699])
+
+        # written samples are kept when the array is opened again
+        zarr_file[3] = 1.0
+        assert np.all(embedding_info.get_or_create_zarr_file()[3] == 1.0)
@@ -0,0 +1,35 @@
+import numpy as np
+from librosa.feature import melspectrogram, chroma_cqt, mfcc
+
+from embeddings.models import (
+    DURATION_IN_SEC,
+    SAMPLE_RATE_FEATS,
+    Model,
+    concat_features,
+    get_embedding_shape,
+)
+
+
+def test_get_embedding_shape_of_handcrafted_features() -> None:
+    t = np.arange(int(SAMPLE_RATE_FEATS * DURATION_IN_SEC)) / SAMPLE_RATE_FEATS
+    audio = np.sin(2 * np.pi * 440 * t).astype(np.float32)
+
+    melspec = concat_features(melspectrogram(y=audio, sr=SAMPLE_RATE_FEATS))
+    chroma = concat_features(chroma_cqt(y=audio, sr=SAMPLE_RATE_FEATS))
+    mfccs = concat_features(mfcc(y=audio, sr=SAMPLE_RATE_FEATS))
+
+    assert get_embedding_shape(Model.MELSPEC) == melspec.shape
+    assert get_embedding_shape(Model.CHROMA) == chroma.shape
+    assert get_embedding_shape(Model.MFCC) == mfccs.shape
+    assert get_embedding_shape(Model.HANDCRAFT) == np.concatenate([melspec, chroma, mfccs]).shape
+
+
+def test_get_embedding_shape_of_musicgen_decoders() -> None:
+    # the hidden states of every layer and of the embedding layer
+    assert get_embedding_shape(Model.MUSICGEN_DECODER_LM_S) == (25, 1024)
+    assert get_embedding_shape(Model.MUSICGEN_DECODER_LM_L, extract_from_layer=3) == (2048,)
+    # the attention weights of every layer, averaged per head
+    assert get_embedding_shape(Model.MUSICGEN_DECODER_LM_M, decoder_hidden_states=False) == (48, 24)
+    # without meanpool the shape depends on the length of the input
+    assert get_embedding_shape(Model.MUSICGEN_DECODER_LM_S, meanpool=False) is None
+    assert get_embedding_shape(Model.JUKEBOX) == (72, 4800)
@@ -0,0 +1,174 @@
+import os
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import zarr
+
+from embeddings import plot_embeddings
+from embeddings.plot_embeddings import (
+    EmbeddingsPlot,
+    get_plot_jobs,
+    run_plot_job,
+    stratified_sample_positions,
+)
+
+
+def _load(dataset_folder: Path, **kwargs) -> EmbeddingsPlot:
+    emb = EmbeddingsPlot()
+    emb.load_embeddings(
+        dataset_labels_filepath=dataset_folder / "prompts.csv",
+        dataset_settings=[(3, "a"), (2, "b")],
+        embeddings_zarr_filepath=dataset_folder / "notes_CHROMA_abc.zarr",
+        model_type="CHROMA",
+        **kwargs,
+    )
+    return emb
+
+
+def _make_dataset(tmp_dir: str, num_samples: int = 100, shape=(8,)) -> Path:
+    dataset_folder = Path(tmp_dir, "notes")
+    dataset_folder.mkdir()
+    rng = np.random.default_rng(0)
+    pd.DataFrame(
+        {"a": rng.integers(0, 3, num_samples), "b": rng.integers(0, 2, num_samples)}
+    ).to_csv(dataset_folder / "prompts.csv", index=False)
+    zarr.save(
+        str(dataset_folder / "notes_CHROMA_abc.zarr"),
+        rng.normal(size=(num_samples, *shape)).astype(np.float32),
+    )
+    return dataset_folder
+
+
+def test_stratified_sample_positions() -> None:
+    labels = pd.DataFrame({"a": [0] * 90 + [1] * 9 + [2], "b": [0, 1] * 50})
+    positions = stratified_sample_positions(labels, ["a"], 20)
+    assert np.all(np.diff(positions) > 0)
+    sampled = labels.iloc[positions]["a"].value_counts().to_dict()
+    # classes keep their share, rare ones keep at least one sample
+    assert sampled == {0: 18, 1: 2, 2: 1}
+    assert np.array_equal(positions, stratified_sample_positions(labels, ["a"], 20))
+
+
+def test_umap_is_fit_once() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = _make_dataset(tmp_dir)
+
+        emb = _load(dataset_folder)
+        embedding = emb.fit_umap()
+        assert embedding.shape == (100, 2)
+
+        # later runs reuse the cached coordinates
+        with patch.object(plot_embeddings.umap, "UMAP", side_effect=AssertionError):
+            assert np.array_equal(_load(dataset_folder).fit_umap(), embedding)
+
+        # unless asked to fit again
+        with patch.object(
+            plot_embeddings.umap, "UMAP", wraps=plot_embeddings.umap.UMAP
+        ) as mapper:
+            assert _load(dataset_folder).fit_umap(refit=True).shape == (100, 2)
+            assert mapper.call_count == 1
+
+        # or the embeddings were extracted again after the fit
+        zarr_path = dataset_folder / "notes_CHROMA_abc.zarr"
+        (cache_path,) = dataset_folder.glob("*_umap_embedding_*.npz")
+        future_ns = cache_path.stat().st_mtime_ns + 10**9
+        os.utime(zarr_path, ns=(future_ns, future_ns))
+        with patch.object(
+            plot_embeddings.umap, "UMAP", wraps=plot_embeddings.umap.UMAP
+        ) as mapper:
+            assert _load(dataset_folder).fit_umap().shape == (100, 2)
+            assert mapper.call_count == 1
+
+
+def test_umap_on_subsample() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = _make_dataset(tmp_dir, num_samples=300, shape=(4, 8))
+
+        emb = _load(dataset_folder, max_fit_samples=120, pca_components=4)
+        # only the subsample of the last layer is loaded
+        assert emb.X.shape[1] == 8
+        assert len(emb.X) < 300
+        assert np.array_equal(
+            emb.X[0], zarr.open(str(emb.embeddings_zarr_filepath))[emb.fit_positions[0], 3]
+        )
+
+        # every sample is placed on the plot
+        embedding = emb.fit_umap()
+        assert embedding.shape == (300, 2)
+        assert np.all(np.isfinite(embedding))
+
+
+def test_plot_jobs_are_incremental() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        dataset_folder.mkdir()
+        rng = np.random.default_rng(0)
+        pd.DataFrame(
+            {
+                "root_note_pitch_class": rng.integers(0, 12, 100),
+                "octave": rng.integers(0, 9, 100),
+            }
+        ).to_csv(dataset_folder / "prompts.csv", index=False)
+        zarr.save(
+            str(dataset_folder / "notes_MUSICGEN_DECODER_LM_L_abc.zarr"),
+            rng.normal(size=(100, 2, 8)).astype(np.float32),
+        )
+        (dataset_folder / "notes_abc.json").write_text(
+            json.dumps({"model_name": "MUSICGEN_DECODER_LM_L"})
+        )
+
+        config = {
+            "concepts": ["notes"],
+            "conditionings": ["text"],
+            "models": ["MUSICGEN_DECODER_LM_L"],
+        }
+        plot_settings = {
+            "split_name": None,
+            "seed": 0,
+            "max_fit_samples": None,
+            "pca_components": None,
+        }
+        output_dir = Path(tmp_dir, "plots")
+        jobs = get_plot_jobs(config, output_dir, plot_settings, base_path_parent=Path(tmp_dir))
+        assert len(jobs) == 1
+        assert list(jobs[0]["fingerprints"]) == ["root_note_pitch_class", "octave"]
+
+        plot_paths = run_plot_job(jobs[0])
+        assert plot_paths == [
+            output_dir / "notes" / "umap_plot_notes_root_note_pitch_class_MUSICGEN_DECODER.png",
+            output_dir / "notes" / "umap_plot_notes_octave_MUSICGEN_DECODER.png",
+        ]
+        assert all(p.is_file() for p in plot_paths)
+
+        # nothing changed, nothing to plot
+        assert get_plot_jobs(config, output_dir, plot_settings, base_path_parent=Path(tmp_dir)) == []
+
+        # extracting the embeddings again changes the plots, once the extraction finished
+        zarr_path = dataset_folder / "notes_MUSICGEN_DECODER_LM_L_abc.zarr"
+        future_ns = zarr_path.stat().st_mtime_ns + 10**9
+        os.utime(zarr_path, ns=(future_ns, future_ns))
+        status_folder = dataset_folder / "notes_abc_status"
+        status_folder.mkdir()
+        (status_folder / "total_shards.txt").write_text("1")
+        assert get_plot_jobs(config, output_dir, plot_settings, base_path_parent=Path(tmp_dir)) == []
+        (status_folder / "0.txt").write_text("done")
+        jobs = get_plot_jobs(config, output_dir, plot_settings, base_path_parent=Path(tmp_dir))
+        plot_paths = run_plot_job(jobs[0])
+
+        # only the missing plot is made again
+        plot_paths[1].unlink()
+        jobs = get_plot_jobs(config, output_dir, plot_settings, base_path_parent=Path(tmp_dir))
+        assert list(jobs[0]["fingerprints"]) == ["octave"]
+
+        # every plot of other samples is made
+        jobs = get_plot_jobs(
+            config,
+            output_dir,
+            {**plot_settings, "split_name": "train"},
+            base_path_parent=Path(tmp_dir),
+        )
+        assert len(jobs[0]["fingerprints"]) == 2
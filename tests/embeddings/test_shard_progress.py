@@ -0,0 +1,183 @@
+import json
+import time
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+from embeddings.shard_progress import (
+    DEAD,
+    DONE,
+    FAILED,
+    HEARTBEAT_TIMEOUT_SEC,
+    NOT_STARTED,
+    RUNNING,
+    ShardHeartbeat,
+    format_campaign_progress,
+    get_campaign_progress,
+    get_heartbeat_path,
+    get_shard_state,
+    is_extraction_finished,
+    read_heartbeat,
+)
+from embeddings.work_queue import WorkQueue, get_work_queue_path
+
+NOW = 1_700_000_000.0
+
+
+def _heartbeat(shard: int, samples_done: int, samples_per_sec: float, age_sec: float = 10.0):
+    return {
+        "shard": shard,
+        "state": RUNNING,
+        "host": "node1",
+        "started_at": NOW - 3600,
+        "updated_at": NOW - age_sec,
+        "num_samples": 100,
+        "samples_done": samples_done,
+        "samples_per_sec": samples_per_sec,
+        "eta_sec": (100 - samples_done) / samples_per_sec,
+    }
+
+
+def test_get_shard_state() -> None:
+    started = f"in progress\n{int(NOW - 3600)}"
+    assert get_shard_state(None, None, NOW) == NOT_STARTED
+    assert get_shard_state("done", None, NOW) == DONE
+    assert get_shard_state("failed. Error: oops", None, NOW) == FAILED
+
+    # without heartbeats, a shard that started recently is still running
+    assert get_shard_state(started, None, NOW) == RUNNING
+    assert get_shard_state(f"in progress\n{int(NOW - 7 * 3600)}", None, NOW) == DEAD
+
+    # with heartbeats, the age of the last one decides
+    assert get_shard_state(started, _heartbeat(0, 10, 1.0), NOW) == RUNNING
+    stale = _heartbeat(0, 10, 1.0, age_sec=HEARTBEAT_TIMEOUT_SEC + 1)
+    assert get_shard_state(started, stale, NOW) == DEAD
+    # the heartbeat of an earlier run of the shard is ignored
+    restarted = f"in progress\n{int(NOW - 60)}"
+    assert get_shard_state(restarted, stale, NOW) == RUNNING
+
+
+def test_shard_heartbeat() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        heartbeat = ShardHeartbeat(Path(tmp_dir), 3, num_samples=10, dataset="notes")
+        assert read_heartbeat(Path(tmp_dir), 3)["samples_done"] == 0
+
+        # written at most once per interval
+        heartbeat.update(5, samples_skipped=1)
+        assert read_heartbeat(Path(tmp_dir), 3)["samples_done"] == 0
+
+        heartbeat.finish(DONE)
+        written = read_heartbeat(Path(tmp_dir), 3)
+        assert written["state"] == DONE
+        assert written["dataset"] == "notes"
+        assert written["samples_done"] == 5
+        assert written["samples_skipped"] == 1
+        assert written["samples_per_sec"] > 0
+
+
+def test_shard_heartbeat_is_written_in_the_background() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # e.g. while the model loads, nothing calls update
+        heartbeat = ShardHeartbeat(Path(tmp_dir), 0, num_samples=10, interval_sec=0.01)
+        first = read_heartbeat(Path(tmp_dir), 0)
+        deadline = time.monotonic() + 10
+        while read_heartbeat(Path(tmp_dir), 0)["updated_at"] == first["updated_at"]:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        heartbeat.update(4)
+        heartbeat.finish(DONE)
+        written = read_heartbeat(Path(tmp_dir), 0)
+        assert written["state"] == DONE
+        assert written["samples_done"] == 4
+        # no heartbeat replaces the final state
+        time.sleep(0.05)
+        assert read_heartbeat(Path(tmp_dir), 0) == written
+
+
+def test_campaign_progress() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        status_folder = dataset_folder / "notes_abc_status"
+        status_folder.mkdir(parents=True)
+        (dataset_folder / "notes_abc.json").write_text(json.dumps({"model_name": "CHROMA"}))
+        pd.DataFrame({"dataset_shard": [i // 100 for i in range(500)]}).to_csv(
+            dataset_folder / "notes_abc_embeddings_info.csv"
+        )
+        (status_folder / "total_shards.txt").write_text("5")
+
+        # shard 0 is done, 1 and 2 are running, 3 stopped sending heartbeats, 4 has not started
+        (status_folder / "0.txt").write_text("done")
+        for shard, heartbeat in (
+            (1, _heartbeat(1, 50, 2.0)),
+            (2, _heartbeat(2, 10, 0.5)),
+            (3, _heartbeat(3, 20, 2.0, age_sec=HEARTBEAT_TIMEOUT_SEC + 1)),
+        ):
+            (status_folder / f"{shard}.txt").write_text(f"in progress\n{int(NOW - 3600)}")
+            get_heartbeat_path(status_folder, shard).write_text(json.dumps(heartbeat))
+
+        progress = get_campaign_progress(tmp_dir, now=NOW)
+        (pair,) = progress["pairs"]
+        assert pair["model_name"] == "CHROMA"
+        assert [s["state"] for s in pair["shards"]] == [DONE, RUNNING, RUNNING, DEAD, NOT_STARTED]
+        # shard 2 runs at a quarter of the speed of shard 1
+        assert [s["straggler"] for s in pair["shards"]] == [False, False, True, False, False]
+
+        assert progress["num_samples"] == 500
+        assert progress["samples_done"] == 100 + 50 + 10 + 20
+        assert progress["samples_per_sec"] == 2.5
+        assert progress["eta_sec"] == 320 / 2.5
+        assert progress["projected_completion"] == NOW + 320 / 2.5
+
+        report = format_campaign_progress(progress)
+        assert "dead: notes CHROMA shard 3" in report
+        assert "straggler: notes CHROMA shard 2" in report
+
+
+def test_work_queue_progress() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        (dataset_folder / "notes_abc_status").mkdir(parents=True)
+        (dataset_folder / "notes_abc_status" / "total_shards.txt").write_text("0")
+
+        queue = WorkQueue.create(get_work_queue_path(dataset_folder, "abc"), 100, lease_size=10)
+        queue.claim("a")
+        queue.complete(0, "a")
+        queue.claim("dead", lease_sec=-1)
+        queue.close()
+
+        progress = get_campaign_progress(tmp_dir)
+        (pair,) = progress["pairs"]
+        assert pair["work_queue"]["done"] == 10
+        assert pair["work_queue"]["expired"] == 10
+        assert progress["num_samples"] == 100
+        assert progress["samples_done"] == 10
+        assert "work queue: notes None has 10 samples in expired leases" in format_campaign_progress(progress)
+
+
+def test_is_extraction_finished() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_folder = Path(tmp_dir, "notes")
+        dataset_folder.mkdir()
+        # nothing records the extraction
+        assert is_extraction_finished(dataset_folder, "abc")
+
+        status_folder = dataset_folder / "notes_abc_status"
+        status_folder.mkdir()
+        (status_folder / "total_shards.txt").write_text("2")
+        (status_folder / "0.txt").write_text("done")
+        (status_folder / "1.txt").write_text(f"in progress\n{NOW}")
+        assert not is_extraction_finished(dataset_folder, "abc")
+        (status_folder / "1.txt").write_text("done")
+        assert is_extraction_finished(dataset_folder, "abc")
+
+        # the work queue has the progress of extractions run by workers
+        queue = WorkQueue.create(get_work_queue_path(dataset_folder, "abc"), 20, lease_size=10)
+        queue.claim("a")
+        queue.complete(0, "a")
+        assert not is_extraction_finished(dataset_folder, "abc")
+        queue.claim("a")
+        queue.complete(10, "a")
+        queue.close()
+        assert is_extraction_finished(dataset_folder, "abc")
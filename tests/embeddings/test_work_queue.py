@@ -0,0 +1,60 @@
+import tempfile
+from pathlib import Path
+
+from embeddings.work_queue import WORK_QUEUE_MAX_ATTEMPTS, WorkQueue
+
+
+def test_work_queue_leases() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir, "queue.sqlite")
+        queue = WorkQueue.create(path, num_samples=10, lease_size=4)
+        # creating it again keeps the existing leases
+        WorkQueue.create(path, num_samples=10, lease_size=4).close()
+
+        other = WorkQueue(path)
+        assert queue.claim("a") == (0, 4)
+        assert other.claim("b") == (4, 8)
+        assert queue.claim("a") == (8, 10)
+        assert other.claim("b") is None
+
+        queue.complete(0, "a")
+        assert queue.renew(4, "b")
+        # only the worker holding a lease renews it
+        assert not queue.renew(4, "a")
+        assert queue.progress() == {
+            "pending": 0,
+            "leased": 4 + 2,
+            "expired": 0,
+            "failed": 0,
+            "done": 4,
+            "samples_per_sec": 4 / 600,
+        }
+        queue.close()
+        other.close()
+
+
+def test_work_queue_expired_and_failed_leases() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = WorkQueue.create(Path(tmp_dir, "queue.sqlite"), num_samples=4, lease_size=2)
+
+        # the lease of a dead worker expires and is claimed by another worker
+        assert queue.claim("dead", lease_sec=-1) == (0, 2)
+        assert queue.progress()["expired"] == 2
+        assert queue.claim("b") == (0, 2)
+        assert not queue.renew(0, "dead")
+
+        # a range is given up after failing on every attempt
+        for _ in range(WORK_QUEUE_MAX_ATTEMPTS - 2):
+            queue.release(0, "b")
+            assert queue.claim("b") == (0, 2)
+        queue.release(0, "b")
+        assert queue.progress()["failed"] == 2
+        assert queue.claim("b") == (2, 4)
+        queue.complete(2, "b")
+        assert not queue.is_done()
+
+        assert queue.retry_failed() == [(0, 2)]
+        assert queue.claim("b") == (0, 2)
+        queue.complete(0, "b")
+        assert queue.is_done()
+        queue.close()
@@ -0,0 +1,72 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+from instrumentation import INSTRUMENTATION_LOG_ENV_VAR, Histogram, Recorder
+
+
+def test_histogram() -> None:
+    histogram = Histogram()
+    # 1ms, 10 times, then one 1s outlier
+    for _ in range(10):
+        histogram.record(1_000_000)
+    histogram.record(1_000_000_000)
+
+    summary = histogram.summary()
+    assert summary["count"] == 11
+    assert summary["max_ms"] == 1000.0
+    # quantiles are the upper bound of their power of two bucket
+    assert 1.0 <= summary["p50_ms"] < 2.1
+    assert summary["p99_ms"] == 1000.0
+
+    # merging a histogram into an empty one gives the same summary
+    merged = Histogram()
+    merged.merge(json.loads(json.dumps(histogram.to_dict())))
+    assert merged.summary() == summary
+
+
+def test_recorder() -> None:
+    recorder = Recorder()
+    with recorder.span("a"):
+        pass
+    recorder.count("samples", 3)
+
+    # e.g. the recording of a worker process
+    worker = Recorder()
+    with worker.span("a"):
+        pass
+    with worker.span("b"):
+        pass
+    worker.count("samples")
+    recorder.merge(worker.drain())
+    assert worker.drain() == {
+        "spans": {},
+        "counters": {},
+        "peak_rss_bytes": worker.peak_rss_bytes(),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_path = Path(tmp_dir, "log.jsonl")
+        with patch.dict("os.environ", {INSTRUMENTATION_LOG_ENV_VAR: str(log_path)}):
+            recorder.emit("test", dataset="notes")
+            recorder.emit("test", dataset="chords")
+
+        first, second = [json.loads(line) for line in log_path.read_text().splitlines()]
+        assert first["dataset"] == "notes"
+        assert first["spans"]["a"]["count"] == 2
+        assert first["spans"]["b"]["count"] == 1
+        assert first["counters"] == {"samples": 4}
+        assert first["peak_rss_bytes"] > 0
+        # emitting starts a new recording
+        assert second["spans"] == {}
+
+
+def test_disabled_recorder() -> None:
+    recorder = Recorder(enabled=False)
+    with recorder.span("a"):
+        pass
+    recorder.count("samples")
+    assert recorder.histograms == {}
+    assert recorder.drain() is None
+    assert recorder.emit("test") is None
@@ -0,0 +1,208 @@
+import tempfile
+
+import numpy as np
+import pytest
+import torch
+
+from probe.probes import (
+    BatchedMLP,
+    BatchedProbeExperiment,
+    LayerwiseProbeExperiment,
+    ProbeExperiment,
+    get_early_stopping_schedule,
+    group_probe_configs,
+    train_probes_batched,
+)
+from tests.probe.util import ListSink, make_experiment_with_splits, make_probe_config
+
+
+def test_batched_mlp_matches_simple_mlp() -> None:
+    torch.manual_seed(0)
+    batched = BatchedMLP(4, 8, [5], 3, dropout_ps=[0.0, 0.25, 0.5, 0.75])
+    batched.eval()
+    x = torch.randn(10, 8)
+    batched_out = batched(x)
+    assert batched_out.shape == (4, 10, 3)
+
+    for k in range(4):
+        probe = batched.to_simple_mlp(k)
+        probe.eval()
+        assert probe.dropout.p == batched.dropout_p[k].item()
+        assert torch.allclose(probe(x), batched_out[k], atol=1e-6)
+
+    # inputs can also be given per probe
+    x = torch.randn(4, 10, 8)
+    batched_out = batched(x)
+    for k in range(4):
+        assert torch.allclose(batched.to_simple_mlp(k).eval()(x[k]), batched_out[k], atol=1e-6)
+
+
+def test_batched_adam_step_matches_torch_adam() -> None:
+    torch.manual_seed(0)
+    lrs = [1e-3, 1e-2]
+    weight_decays = [0.0, 1e-2]
+    params = torch.randn(2, 4, 3, requires_grad=True)
+    exp_avgs = [torch.zeros_like(params)]
+    exp_avg_sqs = [torch.zeros_like(params)]
+
+    reference = [params[k].detach().clone().requires_grad_(True) for k in range(2)]
+    optimizers = [
+        torch.optim.Adam([p], lr=lr, weight_decay=wd)
+        for p, lr, wd in zip(reference, lrs, weight_decays)
+    ]
+
+    for step in range(1, 4):
+        grad = torch.randn(2, 4, 3)
+        params.grad = grad.clone()
+        BatchedProbeExperiment.adam_step(
+            [params],
+            exp_avgs,
+            exp_avg_sqs,
+            step,
+            torch.tensor(lrs).view(-1, 1, 1),
+            torch.tensor(weight_decays).view(-1, 1, 1),
+        )
+        for k in range(2):
+            reference[k].grad = grad[k].clone()
+            optimizers[k].step()
+
+    for k in range(2):
+        assert torch.allclose(params[k], reference[k], atol=1e-6)
+
+
+def test_group_probe_configs() -> None:
+    cfgs = [
+        make_probe_config(learning_rate=1e-3),
+        make_probe_config(learning_rate=1e-4, dropout_p=0.25),
+        make_probe_config(hidden_layer_sizes=[512]),
+        make_probe_config(batch_size=256),
+        make_probe_config(l2_weight_decay=1e-4),
+    ]
+    groups = group_probe_configs(cfgs)
+    assert groups == [[cfgs[0], cfgs[1], cfgs[4]], [cfgs[2]], [cfgs[3]]]
+
+
+def test_layerwise_probes() -> None:
+    num_layers = 3
+    cfgs = [
+        make_probe_config(model_hash=f"MODEL-L-{layer}", learning_rate=1e-2)
+        for layer in range(num_layers)
+    ]
+    rng = np.random.default_rng(0)
+    # all layers concatenated, only the last layer is informative of the labels
+    X = rng.normal(size=(200, num_layers, 4)).astype(np.float32)
+    y = X[:, -1, :3].argmax(axis=1)
+    X = X.reshape(200, -1)
+    data = make_experiment_with_splits(
+        cfgs[0], X, y, "multiclass", split_names=("train", "valid")
+    )
+
+    exp = LayerwiseProbeExperiment(cfgs, data)
+    assert exp.get_probe_input_dimension() == 4
+    probe_inputs = exp.to_probe_inputs(torch.tensor(X))
+    for layer in range(num_layers):
+        assert torch.equal(probe_inputs[layer], torch.tensor(X[:, layer * 4 : (layer + 1) * 4]))
+
+    exp.train()
+    accuracies = [metrics["accuracy"] for metrics in exp.eval("valid")]
+    assert accuracies[-1] > 0.8
+    assert accuracies[-1] > max(accuracies[:-1])
+
+    # each layer is exported as a probe of that layer alone
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for layer, layer_exp in enumerate(exp.to_experiments()):
+            assert layer_exp.cfg is cfgs[layer]
+            assert layer_exp.get_embedding_dimension() == 4
+            metrics = layer_exp.eval("valid")
+            assert metrics["accuracy"] == pytest.approx(accuracies[layer], abs=1e-6)
+
+            uid, _ = layer_exp.save(tmp_dir, metrics)
+            loaded = ProbeExperiment.load(uid, tmp_dir, use_wandb=False)
+            loaded.share_data_from(layer_exp)
+            assert loaded.eval("valid")["accuracy"] == metrics["accuracy"]
+
+
+def test_batched_early_stopping_matches_probe_experiment() -> None:
+    # the probes run out of patience at different times, long before the last epoch. The
+    # scaler is frozen, so the restored weights score exactly as they did when evaluated.
+    cfgs = [
+        make_probe_config(
+            precompute_standardization=True,
+            learning_rate=learning_rate,
+            max_num_epochs=1000,
+            early_stopping_eval_frequency=1,
+            early_stopping_boredom=boredom,
+            seed=0,
+        )
+        for learning_rate, boredom in ((1e-2, 3), (1e-3, 10))
+    ]
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(200, 5)).astype(np.float32)
+    y = (X[:, :3] + rng.normal(scale=0.2, size=(200, 3))).argmax(axis=1)
+    data = make_experiment_with_splits(
+        cfgs[0], X, y, "multiclass", split_names=("train", "valid")
+    )
+
+    batched_sinks = [ListSink() for _ in cfgs]
+    batched = train_probes_batched(
+        cfgs, data, summarize_frequency=1, metrics_sinks=batched_sinks
+    )
+
+    num_evals = []
+    for cfg, exp, batched_sink in zip(cfgs, batched, batched_sinks):
+        reference_sink = ListSink()
+        reference = ProbeExperiment(cfg, use_wandb=False, metrics_sink=reference_sink)
+        reference.share_data_from(data)
+        reference.train()
+
+        _, max_boredom = get_early_stopping_schedule(cfg, len(y))
+        for trained, sink in ((reference, reference_sink), (exp, batched_sink)):
+            evals = [m for _, m in sink.records if "early_stopping_score" in m]
+            # stopped once it ran out of patience, not at the last epoch
+            assert evals[-1]["early_stopping_boredom"] == max_boredom - 1
+            assert evals[-1]["epoch"] < cfg["max_num_epochs"]
+            # and went back to the weights of its best evaluation
+            best_score = max(r["early_stopping_score"] for r in evals)
+            assert trained.eval("valid")["primary"] == pytest.approx(best_score, abs=1e-6)
+        num_evals.append(len(evals))
+
+        # the train loss is reported while the probe trains, as in a single run
+        train_steps = [step for step, m in batched_sink.records if "train_loss" in m]
+        assert train_steps
+        assert train_steps[-1] <= batched_sink.records[-1][0]
+
+    # each probe stopped on its own
+    assert num_evals[0] != num_evals[1]
+
+
+def test_batched_probe_with_nan_score_is_reported_as_failed(monkeypatch) -> None:
+    cfgs = [
+        make_probe_config(learning_rate=learning_rate, max_num_epochs=20)
+        for learning_rate in (1e-3, 1e-2)
+    ]
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(100, 5)).astype(np.float32)
+    y = X[:, :3].argmax(axis=1)
+    data = make_experiment_with_splits(
+        cfgs[0], X, y, "multiclass", split_names=("train", "valid")
+    )
+
+    evaluate = BatchedProbeExperiment.eval
+
+    def diverging_eval(self, split_name):
+        all_metrics = evaluate(self, split_name)
+        all_metrics[1]["primary"] = float("nan")
+        return all_metrics
+
+    monkeypatch.setattr(BatchedProbeExperiment, "eval", diverging_eval)
+    sinks = [ListSink() for _ in cfgs]
+    train_probes_batched(cfgs, data, metrics_sinks=sinks)
+
+    # the other probe keeps training
+    assert not any("error" in m for _, m in sinks[0].records)
+    assert len([m for _, m in sinks[0].records if "early_stopping_score" in m]) > 1
+    # the diverged probe reports its last evaluation and an error, as a single run would
+    step, last = sinks[1].records[-1]
+    assert last == {"error": "NaN score"}
+    assert sinks[1].records[-2][0] == step
+    assert np.isnan(sinks[1].records[-2][1]["early_stopping_score"])
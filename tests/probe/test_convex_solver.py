@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import torch
+
+from probe.probes import ProbeExperiment
+from tests.probe.util import (
+    DEFAULT_CONFIG_UID,
+    make_experiment_with_splits,
+    make_probe_config,
+)
+
+
+def _experiment_with_data(
+    output_type: str, num_outputs: int, y_train, **kwargs
+) -> ProbeExperiment:
+    cfg = make_probe_config(num_outputs=num_outputs, solver="convex", **kwargs)
+    X_train = np.random.default_rng(0).normal(size=(len(y_train), 6)).astype(np.float32)
+    return make_experiment_with_splits(cfg, X_train, y_train, output_type)
+
+
+def _objective_gradient(exp: ProbeExperiment, weight_decay: float) -> float:
+    X = torch.tensor(exp.scaler.transform(exp.split_to_X["train"]), dtype=torch.float32)
+    y = torch.tensor(np.array(exp.split_to_y["train"]))
+    exp.probe.zero_grad()
+    loss = exp.compute_loss(exp.probe(X), y) + (weight_decay / 2) * sum(
+        p.pow(2).sum() for p in exp.probe.parameters()
+    )
+    loss.backward()
+    return max(p.grad.abs().max().item() for p in exp.probe.parameters())
+
+
+@pytest.mark.parametrize("weight_decay", [None, 1e-2])
+def test_convex_solver_regression(weight_decay) -> None:
+    y_train = list(np.random.default_rng(1).uniform(size=50).astype(np.float32))
+    exp = _experiment_with_data(
+        "regression", 1, y_train, l2_weight_decay=weight_decay
+    )
+    exp.train()
+
+    # the ridge solution is the minimizer of the regularized objective
+    assert _objective_gradient(exp, weight_decay or 0) < 1e-4
+    assert "r2" in exp.eval("valid")
+
+
+def test_convex_solver_multiclass() -> None:
+    exp = _experiment_with_data("multiclass", 3, np.zeros(60), l2_weight_decay=1e-2)
+    # linearly separable labels
+    classes = exp.split_to_X["train"][:, :3].argmax(axis=1)
+    exp.split_to_y = {"train": classes, "valid": classes, "test": classes}
+    exp.train()
+
+    assert _objective_gradient(exp, 1e-2) < 1e-3
+    assert exp.eval("valid")["accuracy"] > 0.5
+
+
+def test_convex_solver_config() -> None:
+    kwargs = dict(num_outputs=10, seed=42)
+    # the default solver does not change the uid of existing configs
+    assert make_probe_config(**kwargs).uid() == DEFAULT_CONFIG_UID
+    assert make_probe_config(**kwargs, solver="convex").uid() != DEFAULT_CONFIG_UID
+
+    with pytest.raises(ValueError):
+        make_probe_config(**kwargs, solver="sgd")
+
+    with pytest.raises(ValueError):
+        make_probe_config(**kwargs, solver="convex", hidden_layer_sizes=[512])
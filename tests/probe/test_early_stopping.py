@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from probe.probes import get_early_stopping_schedule
+from tests.probe.util import make_experiment_with_splits, make_probe_config
+
+
+def test_early_stopping_schedule() -> None:
+    # fixed values do not depend on the dataset size
+    assert get_early_stopping_schedule(make_probe_config(), 100) == (8, 256)
+    assert get_early_stopping_schedule(make_probe_config(), 100000) == (8, 256)
+
+    auto = make_probe_config(
+        batch_size=64,
+        early_stopping_eval_frequency="auto",
+        early_stopping_boredom="auto",
+    )
+    # 2 steps per epoch, so every step, and 10 epochs of patience
+    assert get_early_stopping_schedule(auto, 100) == (1, 20)
+    # 1563 steps per epoch, 4 evals per epoch
+    assert get_early_stopping_schedule(auto, 100000) == (391, 40)
+
+    # boredom may be auto with a fixed eval frequency
+    auto_boredom = make_probe_config(early_stopping_boredom="auto")
+    assert get_early_stopping_schedule(auto_boredom, 6400) == (8, 125)
+
+    with pytest.raises(ValueError):
+        make_probe_config(early_stopping_boredom="never")
+
+
+def test_early_stopping_restores_best_weights() -> None:
+    cfg = make_probe_config(
+        learning_rate=1e-2,
+        early_stopping_eval_frequency="auto",
+        early_stopping_boredom="auto",
+    )
+    X = np.random.default_rng(0).normal(size=(200, 5)).astype(np.float32)
+    y = X[:, :3].argmax(axis=1)
+    exp = make_experiment_with_splits(
+        cfg, X, y, "multiclass", split_names=("train", "valid")
+    )
+
+    exp.train()
+
+    # training stops once the valid accuracy no longer improves, at its best weights
+    assert exp.eval("valid")["accuracy"] > 0.8
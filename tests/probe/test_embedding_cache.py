@@ -0,0 +1,109 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import zarr
+
+from embeddings.export_embeddings import export_zarr_to_npy
+from probe.embedding_cache import EmbeddingCache
+from probe.probes import ProbeExperiment
+from tests.probe.util import make_probe_config
+
+
+def test_embedding_cache() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        zarr_path = tmp_path / "notes_CHROMA_abc.zarr"
+        zarr.save(str(zarr_path), np.zeros((4, 2)))
+
+        cache = EmbeddingCache(tmp_path / "cache")
+        key = cache.get_key(zarr_path, 0, 42, dataset="notes")
+
+        # the key depends on the layer, seed, and split settings
+        assert key == cache.get_key(zarr_path, 0, 42, dataset="notes")
+        assert key != cache.get_key(zarr_path, 1, 42, dataset="notes")
+        assert key != cache.get_key(zarr_path, 0, 43, dataset="notes")
+        assert key != cache.get_key(zarr_path, 0, 42, dataset="tempos")
+
+        # nothing cached yet
+        assert cache.load(key) is None
+
+        split_to_X = {
+            "train": np.random.rand(3, 2),
+            "valid": np.random.rand(1, 2),
+            "test": np.random.rand(1, 2),
+        }
+        cache.save(key, split_to_X)
+
+        cached = cache.load(key)
+        assert set(cached.keys()) == {"train", "valid", "test"}
+        for split_name, X in split_to_X.items():
+            assert isinstance(cached[split_name], np.memmap)
+            assert cached[split_name].dtype == np.float32
+            assert np.allclose(cached[split_name], X)
+
+
+def test_embedding_cache_evicts_least_recently_used() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        split_to_X = {
+            "train": np.zeros((10, 2)),
+            "valid": np.zeros((2, 2)),
+            "test": np.zeros((2, 2)),
+        }
+        cache = EmbeddingCache(Path(tmp_dir))
+        cache.save("a", split_to_X)
+        # room for two entries
+        entry_bytes = sum(p.stat().st_size for p in Path(tmp_dir).glob("*.npy"))
+        cache.max_bytes = 2 * entry_bytes
+
+        cache.save("b", split_to_X)
+        os.utime(Path(tmp_dir, "a_train.npy"), ns=(0, 0))
+        os.utime(Path(tmp_dir, "b_train.npy"), ns=(1, 1))
+        # a was used last
+        assert cache.load("a") is not None
+
+        cache.save("c", split_to_X)
+        assert cache.load("b") is None
+        assert cache.load("a") is not None
+        assert cache.load("c") is not None
+
+        # larger than the whole cache, not cached
+        cache.save("d", {"train": np.zeros((1000, 100))})
+        assert cache.load("d", split_names=["train"]) is None
+
+
+def test_load_data_uses_embedding_cache() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        labels_path = tmp_path / "info.csv"
+        pd.DataFrame({"something": np.arange(30) % 3}).to_csv(labels_path, index=False)
+        zarr_path = tmp_path / "notes_JUKEBOX_abc.zarr"
+        embeddings = np.random.rand(30, 2, 4)
+        zarr.save(str(zarr_path), embeddings)
+
+        def load_data(cache_dir: Path) -> ProbeExperiment:
+            exp = ProbeExperiment(
+                make_probe_config(),
+                use_wandb=False,
+                embedding_cache=EmbeddingCache(cache_dir),
+            )
+            exp.load_data(labels_path, "something", str(zarr_path), "multiclass", 1)
+            return exp
+
+        first = load_data(tmp_path / "cache")
+        assert len(list((tmp_path / "cache").glob("*.npy"))) == 3
+
+        # the second run memory maps the splits of the first one
+        second = load_data(tmp_path / "cache")
+        for split_name, X in first.split_to_X.items():
+            assert isinstance(second.split_to_X[split_name], np.memmap)
+            assert np.allclose(second.split_to_X[split_name], X)
+
+        # the export is shared through the page cache already, it is not copied to the cache
+        export_zarr_to_npy(zarr_path)
+        exported = load_data(tmp_path / "cache_with_export")
+        assert not (tmp_path / "cache_with_export").exists()
+        for split_name, X in first.split_to_X.items():
+            assert np.allclose(exported.split_to_X[split_name], X)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from probe.probes import SimpleMLP
+from tests.probe.util import make_experiment_with_splits, make_probe_config
+
+
+@pytest.mark.parametrize("output_type", ["multiclass", "regression"])
+@pytest.mark.parametrize("precompute_standardization", [False, True])
+def test_eval_on_device_matches_eval(output_type, precompute_standardization) -> None:
+    num_outputs = 4 if output_type == "multiclass" else 1
+    cfg = make_probe_config(
+        num_outputs=num_outputs, precompute_standardization=precompute_standardization
+    )
+    rng = np.random.default_rng(0)
+    X = rng.normal(loc=1, size=(90, 6)).astype(np.float32)
+    if output_type == "multiclass":
+        y = rng.integers(num_outputs, size=90)
+    else:
+        y = list(rng.normal(size=90).astype(np.float32))
+
+    exp = make_experiment_with_splits(
+        cfg,
+        X,
+        y,
+        output_type,
+        split_names=("train", "valid"),
+        pretrained_probe=SimpleMLP(6, [8], num_outputs),
+    )
+    exp.scaler = exp.fit_scaler(True)
+
+    expected = exp.eval("valid")
+    metrics = exp.eval_on_device("valid")
+
+    assert set(metrics) == set(expected)
+    for name, value in expected.items():
+        assert metrics[name] == pytest.approx(value, abs=1e-5)
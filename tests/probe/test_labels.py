@@ -0,0 +1,47 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from probe.probes import ProbeExperiment
+from tests.probe.util import make_probe_config
+
+
+def _experiment(seed: int = 0) -> ProbeExperiment:
+    cfg = make_probe_config(
+        dataset_embeddings_label_column_name="root_note_name", dataset="notes", seed=seed
+    )
+    return ProbeExperiment(cfg, use_wandb=False)
+
+
+def test_labels_are_integer_classes() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        labels_path = Path(tmp_dir, "prompts.csv")
+        notes = ["E", "C", "D"] * 20
+        pd.DataFrame({"root_note_name": notes}).to_csv(labels_path, index=False)
+
+        exp = _experiment()
+        dataset_labels, train_df, test_df, valid_df = exp.load_labels_and_splits(
+            labels_path, "root_note_name", "multiclass"
+        )
+
+        # classes are numbered in sorted order
+        encoded = dataset_labels["root_note_name_encoded"]
+        assert encoded.dtype == np.int64
+        assert list(encoded[:3]) == [2, 0, 1]
+        assert len(train_df) + len(test_df) + len(valid_df) == len(notes)
+        assert set(train_df["zarr_idx"]).isdisjoint(valid_df["zarr_idx"])
+
+        # prepared once per process for the same labels and seed
+        assert (
+            _experiment().load_labels_and_splits(
+                labels_path, "root_note_name", "multiclass"
+            )[1]
+            is train_df
+        )
+        other_seed = _experiment(seed=1).load_labels_and_splits(
+            labels_path, "root_note_name", "multiclass"
+        )[1]
+        assert other_seed is not train_df
+        assert sorted(other_seed["zarr_idx"]) != sorted(train_df["zarr_idx"])
@@ -0,0 +1,129 @@
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import probe.local_sweep
+import probe.main
+from probe.local_sweep import group_sweep_configs, is_done, run_sweep_configs
+from probe.main import get_probe_config
+from probe.metrics_sink import read_jsonl_metrics
+from probe.probes import BatchedProbeExperiment
+from probe.result_store import ProbeResultStore
+from tests.probe.util import write_notes_embeddings
+
+
+def _sweep_config(concept="notes", model_layer=0, learning_rate=1e-3):
+    return {
+        "model_type": "JUKEBOX",
+        "model_size": "L",
+        "model_layer": model_layer,
+        "concept": concept,
+        "learning_rate": learning_rate,
+    }
+
+
+def test_group_sweep_configs() -> None:
+    sweep_configs = [
+        _sweep_config(concept, model_layer, learning_rate)
+        for concept in ("notes", "chords")
+        for learning_rate in (1e-4, 1e-3, 1e-2)
+        for model_layer in (0, 1)
+    ]
+    groups = group_sweep_configs(sweep_configs)
+    assert len(groups) == 4
+    for group in groups:
+        assert len(group) == 3
+        assert len({(c["concept"], c["model_layer"]) for c in group}) == 1
+
+    # large groups are split so they can be spread over workers
+    groups = group_sweep_configs(sweep_configs, max_group_size=2)
+    assert sorted(len(g) for g in groups) == [1, 1, 1, 1, 2, 2, 2, 2]
+    assert sum(len(g) for g in groups) == len(sweep_configs)
+
+
+def test_is_done() -> None:
+    sweep_config = _sweep_config()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ProbeResultStore(tmp_dir)
+        assert not is_done(sweep_config, store.uids())
+
+        cfg = get_probe_config(SimpleNamespace(**sweep_config), random_seed=0)
+        store.put(cfg.uid(), cfg, {"primary": 0.5})
+        assert is_done(sweep_config, store.uids())
+        # the seed is part of the config
+        assert not is_done(sweep_config, store.uids(), random_seed=1)
+        assert not is_done(_sweep_config(learning_rate=1e-2), store.uids())
+        # all layer configs are checked once their embeddings are found
+        assert not is_done(_sweep_config(model_layer="all"), store.uids())
+
+
+def test_run_sweep_configs_trains_compatible_configs_together(monkeypatch) -> None:
+    batched_groups = []
+    train = BatchedProbeExperiment.train
+
+    def recording_train(self):
+        batched_groups.append(len(self.cfgs))
+        return train(self)
+
+    monkeypatch.setattr(BatchedProbeExperiment, "train", recording_train)
+    monkeypatch.setattr(probe.main, "_LOADED_DATA", {})
+
+    sweep_configs = [
+        {
+            **_sweep_config(model_layer=1, learning_rate=learning_rate),
+            "hidden_layer_sizes": [],
+        }
+        for learning_rate in (1e-4, 1e-3, 1e-2)
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        write_notes_embeddings(tmp_path / "data")
+        results = run_sweep_configs(
+            sweep_configs,
+            metrics_dir=tmp_path / "metrics",
+            result_store_dir=tmp_path / "probes",
+            base_path_parent=tmp_path / "data",
+        )
+        assert [error for _, error in results] == [None, None, None]
+        # one probe per config, trained side by side
+        assert batched_groups == [3]
+        finished_uids = ProbeResultStore(tmp_path / "probes").uids()
+        assert all(is_done(c, finished_uids) for c in sweep_configs)
+
+        # each config reports its own early stopping evaluations
+        for metrics_path in (tmp_path / "metrics").glob("*.jsonl"):
+            records = read_jsonl_metrics(metrics_path)
+            assert len({r["learning_rate"] for r in records}) == 1
+            assert "early_stopping_score" in records[0]
+        assert len(list((tmp_path / "metrics").glob("*.jsonl"))) == 3
+
+
+def test_run_sweep_configs_retries_configs_one_at_a_time(monkeypatch) -> None:
+    def failing_start_many(sweep_configs, metrics_sinks, **kwargs):
+        for sink in metrics_sinks:
+            sink.log({"early_stopping_score": 0.0}, step=0)
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(probe.local_sweep, "start_many", failing_start_many)
+    monkeypatch.setattr(probe.main, "_LOADED_DATA", {})
+
+    sweep_configs = [
+        {**_sweep_config(model_layer=1, learning_rate=learning_rate), "hidden_layer_sizes": []}
+        for learning_rate in (1e-3, 1e-2)
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        write_notes_embeddings(tmp_path / "data")
+        results = run_sweep_configs(
+            sweep_configs,
+            metrics_dir=tmp_path / "metrics",
+            result_store_dir=tmp_path / "probes",
+            base_path_parent=tmp_path / "data",
+        )
+        assert [error for _, error in results] == [None, None]
+
+        # only the curve of the retry is kept
+        for metrics_path in (tmp_path / "metrics").glob("*.jsonl"):
+            steps = [r["step"] for r in read_jsonl_metrics(metrics_path) if "early_stopping_score" in r]
+            assert len(steps) == len(set(steps))
+            assert steps[1] > 0
@@ -0,0 +1,116 @@
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import probe.main
+import probe.probes
+from probe.main import get_probe_config
+from probe.probes import ProbeExperiment
+from probe.result_store import ProbeResultStore
+from tests.probe.util import write_notes_embeddings
+
+
+def test_start_reuses_loaded_data(monkeypatch) -> None:
+    load_data_calls = []
+    load_data = ProbeExperiment.load_data
+
+    def counting_load_data(self, *args, **kwargs):
+        load_data_calls.append(args)
+        return load_data(self, *args, **kwargs)
+
+    monkeypatch.setattr(ProbeExperiment, "load_data", counting_load_data)
+    monkeypatch.setattr(probe.main, "_LOADED_DATA", {})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_notes_embeddings(Path(tmp_dir))
+        experiments = [
+            probe.main.start(
+                use_wandb=False,
+                base_path_parent=Path(tmp_dir),
+                sweep_config={
+                    "model_type": "JUKEBOX",
+                    "model_size": "L",
+                    "model_layer": 1,
+                    "concept": "notes",
+                    "hidden_layer_sizes": [],
+                    "learning_rate": learning_rate,
+                },
+            )
+            for learning_rate in (1e-3, 1e-2)
+        ]
+
+    # the second config probes the same embeddings, it uses the data of the first
+    assert len(load_data_calls) == 1
+    assert experiments[1].split_to_X is experiments[0].split_to_X
+    assert experiments[1].probe is not experiments[0].probe
+    # only the data is kept in memory, not the first experiment
+    (data,) = probe.main._LOADED_DATA.values()
+    assert set(data) == set(ProbeExperiment.DATA_ATTRIBUTES)
+
+
+def test_start_all_layers_saves_a_probe_per_layer() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        write_notes_embeddings(tmp_path / "data", num_layers=3)
+        result_store = ProbeResultStore(tmp_path / "probes")
+        sweep_config = {
+            "model_type": "JUKEBOX",
+            "model_size": "L",
+            "model_layer": "all",
+            "concept": "notes",
+            "hidden_layer_sizes": [],
+        }
+        probe.main.start(
+            use_wandb=False,
+            base_path_parent=tmp_path / "data",
+            result_store=result_store,
+            sweep_config=sweep_config,
+        )
+
+        for layer in range(3):
+            cfg = get_probe_config(
+                SimpleNamespace(**sweep_config), model_layer=layer
+            )
+            assert result_store.get(cfg.uid())["model_dir"] is not None
+            loaded = ProbeExperiment.load(
+                cfg.uid(), result_store.root_dir, use_wandb=False
+            )
+            assert loaded.cfg == cfg
+            assert loaded.probe.output.weight.shape == (12, 6)
+
+
+def test_start_all_layers_reads_a_batch_at_a_time(monkeypatch) -> None:
+    read_shapes = []
+    get_split_X = ProbeExperiment.get_split_X
+
+    def recording_get_split_X(self, *args, **kwargs):
+        X = get_split_X(self, *args, **kwargs)
+        read_shapes.append(X.shape)
+        return X
+
+    monkeypatch.setattr(ProbeExperiment, "get_split_X", recording_get_split_X)
+    monkeypatch.setattr(probe.probes, "STANDARDIZATION_CHUNK_SIZE", 16)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_notes_embeddings(Path(tmp_dir), num_layers=3)
+        exp = probe.main.start(
+            use_wandb=False,
+            base_path_parent=Path(tmp_dir),
+            sweep_config={
+                "model_type": "JUKEBOX",
+                "model_size": "L",
+                "model_layer": "all",
+                "concept": "notes",
+                "hidden_layer_sizes": [],
+                "batch_size": 8,
+                # neither keeps the embeddings of all layers in memory or on the device
+                "precompute_standardization": True,
+            },
+        )
+
+    assert exp.cfg["load_embeddings_in_memory"]
+    assert all(isinstance(X, tuple) for X in exp.data.split_to_X.values())
+    assert not exp.uses_device_splits()
+    # the standardization chunks hold as many values as 16 samples of one layer
+    assert max(shape[0] for shape in read_shapes) == 8
+    assert all(shape[1] == 3 * 6 for shape in read_shapes)
@@ -0,0 +1,91 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from probe.metrics_sink import JsonlSink, read_jsonl_metrics
+from probe.probe_config import CONCEPT_LABELS, expand_sweep_config
+from tests.probe.util import ListSink, make_experiment_with_splits, make_probe_config
+
+
+def test_jsonl_sink() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir, "runs", "run.jsonl")
+        with JsonlSink(path, tags={"concept": "notes"}, batch_size=3) as sink:
+            for step in range(10):
+                metrics = {"train_loss": np.float32(step / 2), "lr": torch.tensor(0.5)}
+                sink.log(metrics, step=step)
+                # records are serialized when they are logged
+                metrics["train_loss"] = -1
+
+        records = read_jsonl_metrics(path)
+        assert [r["step"] for r in records] == list(range(10))
+        assert records[3] == {"concept": "notes", "train_loss": 1.5, "lr": 0.5, "step": 3}
+
+        # later runs append to the same file
+        with JsonlSink(path) as sink:
+            sink.log({"primary": 1})
+        assert read_jsonl_metrics(path)[-1] == {"primary": 1, "step": None}
+
+
+def test_jsonl_sink_discard() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir, "run.jsonl")
+        with JsonlSink(path) as sink:
+            sink.log({"primary": 1}, step=0)
+
+        # the records of an attempt are dropped, those of the earlier run are kept
+        with JsonlSink(path, batch_size=1) as sink:
+            sink.log({"primary": 2}, step=0)
+            sink.log({"primary": 3}, step=1)
+            sink.discard()
+            sink.log({"primary": 4}, step=0)
+        assert [r["primary"] for r in read_jsonl_metrics(path)] == [1, 4]
+
+
+def test_jsonl_sink_errors() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the path is a directory, it fails when the sink is created
+        with pytest.raises(IsADirectoryError):
+            JsonlSink(tmp_dir)
+
+    if not Path("/dev/full").exists():
+        return
+    # writes fail, as on a full disk. The error of the writer thread is raised by close
+    sink = JsonlSink("/dev/full")
+    sink.log({"primary": 1})
+    with pytest.raises(OSError):
+        sink.close()
+
+
+def test_expand_sweep_config() -> None:
+    configs = expand_sweep_config("musicgen")
+    assert len(configs) == 3 * 49 * len(CONCEPT_LABELS)
+    assert configs[0] == {
+        "model_type": "MUSICGEN_DECODER",
+        "model_size": "L",
+        "model_layer": 0,
+        "concept": "chord_progressions",
+    }
+    assert len({tuple(c.values()) for c in configs}) == len(configs)
+
+
+def test_experiment_logs_to_sink() -> None:
+    sink = ListSink()
+    X = np.random.default_rng(0).normal(size=(60, 5)).astype(np.float32)
+    y = X[:, :3].argmax(axis=1)
+    exp = make_experiment_with_splits(
+        make_probe_config(max_num_epochs=10),
+        X,
+        y,
+        "multiclass",
+        split_names=("train", "valid"),
+        summarize_frequency=5,
+        metrics_sink=sink,
+    )
+    exp.train()
+
+    assert any("train_loss" in metrics for _, metrics in sink.records)
+    assert any("early_stopping_score" in metrics for _, metrics in sink.records)
@@ -0,0 +1,57 @@
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from probe.probes import ProbeExperiment
+from probe.result_store import ProbeResultStore
+from tests.probe.util import make_experiment_with_splits, make_probe_config
+
+
+def test_result_store() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ProbeResultStore(tmp_dir)
+        cfg = make_probe_config(solver="convex")
+        assert store.get(cfg.uid()) is None
+        assert cfg.uid() not in store
+
+        store.put(cfg.uid(), cfg, {"primary": 0.5})
+        record = store.get(cfg.uid())
+        assert record["cfg"] == cfg
+        assert record["metrics"] == {"primary": 0.5}
+        assert record["model_dir"] is None
+
+        # a later run of the same config replaces the record
+        store.put(cfg.uid(), cfg, {"primary": 0.75}, model_dir=Path(tmp_dir, "test"))
+        assert ProbeResultStore(tmp_dir).get(cfg.uid())["metrics"] == {"primary": 0.75}
+        assert store.uids() == {cfg.uid()}
+
+        store.delete(cfg.uid())
+        assert cfg.uid() not in store
+
+
+def test_save_and_load_through_result_store() -> None:
+    X = np.random.default_rng(0).normal(size=(60, 5)).astype(np.float32)
+    y = X[:, :3].argmax(axis=1)
+    exp = make_experiment_with_splits(
+        make_probe_config(solver="convex"), X, y, "multiclass", split_names=("train", "valid")
+    )
+    exp.train()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        uid, _ = exp.save(tmp_dir)
+
+        record = ProbeResultStore(tmp_dir).get(uid)
+        assert record["model_dir"] == Path(tmp_dir, "test", uid)
+        assert record["metrics"] == exp.eval("valid")
+        # metrics are saved next to the probe, and at the root as the latest run
+        assert Path(tmp_dir, "test", uid, "metrics.json").is_file()
+        with open(Path(tmp_dir, "metrics.json")) as f:
+            assert json.load(f) == record["metrics"]
+
+        loaded = ProbeExperiment.load(uid, root_dir=tmp_dir, use_wandb=False)
+        assert loaded.cfg == exp.cfg
+        for p, loaded_p in zip(exp.probe.parameters(), loaded.probe.parameters()):
+            assert torch.equal(p.cpu(), loaded_p.cpu())
@@ -0,0 +1,77 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.model_selection import train_test_split
+
+from probe.splits import (
+    RANDOM_SPLIT,
+    TEMPO_EXTRAPOLATION_SPLIT,
+    compute_split_positions,
+    get_split_filepath,
+    load_split_positions,
+)
+
+
+def _labels(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(n)
+    return pd.DataFrame({"bpm": rng.integers(50, 210, size=n), "zarr_idx": np.arange(n)})
+
+
+@pytest.mark.parametrize("n", [17, 600])
+@pytest.mark.parametrize("seed", [0, 100])
+def test_random_split_positions(n, seed) -> None:
+    df = _labels(n)
+    positions = compute_split_positions(df, seed, RANDOM_SPLIT)
+
+    # same splits as shuffling and splitting the DataFrame itself
+    train_df, non_train_df = train_test_split(
+        df.sample(frac=1, random_state=seed), train_size=0.7, random_state=seed
+    )
+    valid_df, test_df = train_test_split(non_train_df, test_size=0.5, random_state=seed)
+    for split_name, split_df in (("train", train_df), ("test", test_df), ("valid", valid_df)):
+        assert positions[split_name].dtype == np.int32
+        assert np.array_equal(
+            df.iloc[positions[split_name]]["zarr_idx"].to_numpy(),
+            split_df["zarr_idx"].to_numpy(),
+        )
+
+
+def test_tempo_extrapolation_split_positions() -> None:
+    df = _labels(200)
+    positions = compute_split_positions(df, 0, TEMPO_EXTRAPOLATION_SPLIT)
+
+    train_bpm = df["bpm"].to_numpy()[positions["train"]]
+    held_out_bpm = df["bpm"].to_numpy()[np.concatenate([positions["test"], positions["valid"]])]
+    assert len(positions["train"]) == 140
+    # held out tempos are outside of the range of the training tempos
+    assert np.all(
+        (held_out_bpm <= train_bpm.min()) | (held_out_bpm >= train_bpm.max())
+    )
+
+
+def test_load_split_positions() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        labels_path = Path(tmp_dir, "prompts.csv")
+        df = _labels(100)
+        df.to_csv(labels_path, index=False)
+
+        positions = load_split_positions(labels_path, df, 3)
+        train_path = get_split_filepath(labels_path, 3, RANDOM_SPLIT, "train")
+        assert train_path.is_file()
+
+        # later runs memory map the stored splits
+        loaded = load_split_positions(labels_path, df, 3)
+        assert isinstance(loaded["train"], np.memmap)
+        for split_name in positions:
+            assert np.array_equal(loaded[split_name], positions[split_name])
+
+        # rewritten labels invalidate the stored splits
+        df = _labels(50)
+        df.to_csv(labels_path, index=False)
+        later = train_path.stat().st_mtime_ns + 1_000_000_000
+        os.utime(labels_path, ns=(later, later))
+        assert len(load_split_positions(labels_path, df, 3)["train"]) == 35
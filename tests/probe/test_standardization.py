@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.preprocessing import StandardScaler
+
+import probe.probes
+from probe.probes import ProbeExperiment, get_standardization_tensors, standardize
+from tests.probe.util import DEFAULT_CONFIG_UID, make_probe_config
+
+
+def _experiment_with_data(load_embeddings_in_memory: bool, **kwargs) -> ProbeExperiment:
+    cfg = make_probe_config(
+        load_embeddings_in_memory=load_embeddings_in_memory,
+        precompute_standardization=True,
+        **kwargs,
+    )
+    exp = ProbeExperiment(cfg, use_wandb=False)
+    rng = np.random.default_rng(0)
+    # (n, layer_num, k) embeddings, the train split is a shuffled subset of them
+    exp.embeddings = rng.normal(loc=3, scale=2, size=(100, 2, 5)).astype(np.float32)
+    selector = rng.permutation(100)[:70]
+    if load_embeddings_in_memory:
+        exp.split_to_X = {"train": exp.embeddings[selector][:, 1, :]}
+    else:
+        exp.split_to_X = {"train": (selector, 1)}
+    return exp
+
+
+@pytest.mark.parametrize("load_embeddings_in_memory", [True, False])
+def test_fit_scaler_is_exact(monkeypatch, load_embeddings_in_memory) -> None:
+    # several chunks, the last one partial
+    monkeypatch.setattr(probe.probes, "STANDARDIZATION_CHUNK_SIZE", 16)
+    exp = _experiment_with_data(load_embeddings_in_memory)
+    X_train = exp.get_split_X("train")
+
+    scaler = exp.fit_scaler(True)
+    expected = StandardScaler().fit(X_train)
+    assert np.allclose(scaler.mean_, expected.mean_, atol=1e-5)
+    assert np.allclose(scaler.var_, expected.var_, atol=1e-4)
+    assert scaler.n_samples_seen_ == X_train.shape[0]
+
+
+@pytest.mark.parametrize("data_standardization", [True, False])
+def test_standardize_matches_scaler(data_standardization) -> None:
+    exp = _experiment_with_data(True)
+    scaler = exp.fit_scaler(data_standardization)
+    X = exp.get_split_X("train")
+
+    standardization = get_standardization_tensors(scaler, torch.device("cpu"))
+    X_standardized = standardize(torch.tensor(X), standardization).numpy()
+    assert np.allclose(X_standardized, scaler.transform(X), atol=1e-5)
+
+
+def test_precompute_standardization_config() -> None:
+    kwargs = dict(num_outputs=10, seed=42)
+    # the default does not change the uid of existing configs
+    assert (
+        make_probe_config(**kwargs, precompute_standardization=False).uid()
+        == DEFAULT_CONFIG_UID
+    )
+    assert (
+        make_probe_config(**kwargs, precompute_standardization=True).uid()
+        != DEFAULT_CONFIG_UID
+    )
+
+
+def test_device_splits() -> None:
+    exp = _experiment_with_data(True, learning_rate=1e-2)
+    X_train = exp.split_to_X["train"]
+    y_train = X_train[:, :3].argmax(axis=1)
+    exp.split_to_uids = {"train": [], "valid": []}
+    exp.split_to_X["valid"] = X_train
+    exp.split_to_y = {"train": y_train, "valid": y_train}
+    exp.output_type = "multiclass"
+    assert exp.uses_device_splits()
+
+    exp.train()
+
+    # standardized once by the frozen scaler
+    X, y = exp.get_device_split("valid")
+    assert np.allclose(X.cpu().numpy(), exp.scaler.transform(X_train), atol=1e-5)
+    assert np.array_equal(y.cpu().numpy(), y_train)
+    assert exp.eval("valid")["accuracy"] > 0.5
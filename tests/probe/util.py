@@ -6,21 +6,73 @@ from unittest.mock import patch, Mock, MagicMock
 import math
 
 import numpy as np
+import pandas as pd
+import zarr
 
 from dataset.synthetic.dataset_writer import DatasetWriter
+from embeddings.catalog import register_embeddings
 from embeddings.config_checksum import compute_checksum
-from embeddings.extract_embeddings import (
-    get_scripts_to_extract_embeddings_for_dataset_with_model,
-)
-from embeddings.embeddings_cli import extract_shard
 from probe.main import start
+from probe.metrics_sink import MetricsSink
+from probe.probe_config import ProbeExperimentConfig
 from probe.probes import ProbeExperiment
 from util import no_output
 
+# the uid of make_probe_config(num_outputs=10, seed=42). New config fields must not change
+# it, so that probes that were already saved keep their uid.
+DEFAULT_CONFIG_UID = "23f4db03a995b56bc70d62dd5453670c68ea8654"
+
+
 class ModelConfigurationDoesNotExist(Exception):
     pass
 
 
+class ListSink(MetricsSink):
+    """Keeps the records logged to it in memory, as (step, metrics)."""
+
+    def __init__(self) -> None:
+        self.records = []
+
+    def log(self, metrics, step=None) -> None:
+        self.records.append((step, dict(metrics)))
+
+
+def make_probe_config(**kwargs) -> ProbeExperimentConfig:
+    """The config of a small probe on the "test" dataset, with the given settings."""
+    return ProbeExperimentConfig(
+        **{
+            "dataset_embeddings_label_column_name": "something",
+            "dataset": "test",
+            "num_outputs": 3,
+            "model_hash": "xyz",
+            "max_num_epochs": 100,
+            "load_embeddings_in_memory": True,
+            **kwargs,
+        }
+    )
+
+
+def make_experiment_with_splits(
+    cfg: ProbeExperimentConfig,
+    X: np.ndarray,
+    y: Any,
+    output_type: str,
+    split_names: Tuple[str, ...] = ("train", "valid", "test"),
+    **experiment_kwargs: Any,
+) -> ProbeExperiment:
+    """An experiment whose splits are set in memory instead of loaded, each to X and y."""
+    exp = ProbeExperiment(cfg, use_wandb=False, **experiment_kwargs)
+    exp.dataset_labels_filepath = None
+    exp.dataset_labels = None
+    exp.is_foundation_model_layers = False
+    exp.embeddings = None
+    exp.split_to_uids = {split_name: [] for split_name in split_names}
+    exp.split_to_X = {split_name: X for split_name in split_names}
+    exp.split_to_y = {split_name: y for split_name in split_names}
+    exp.output_type = output_type
+    return exp
+
+
 class MockWandbConfig:
     def __init__(self, sweep_attrs: Dict[str, Any]) -> None:
         for k, v in sweep_attrs.items():
@@ -45,9 +97,45 @@ class MockWandbConfig:
         self.__dict__[key] = value
 
 
+def write_notes_embeddings(
+    base_path_parent: Path, num_samples: int = 120, num_layers: int = 2, dim: int = 6
+) -> Path:
+    """A notes dataset of random JUKEBOX embeddings whose first dimensions encode the label.
+
+    Returns: The zarr array of the embeddings, listed in the catalog of the dataset.
+    """
+    dataset_folder = base_path_parent / "notes"
+    dataset_folder.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    labels = np.arange(num_samples) % 12
+    pd.DataFrame({"root_note_pitch_class": labels}).to_csv(
+        dataset_folder / "prompts.csv", index=False
+    )
+
+    embeddings = rng.normal(size=(num_samples, num_layers, dim)).astype(np.float32)
+    embeddings[np.arange(num_samples), :, labels % dim] += 3
+    zarr_filepath = dataset_folder / "notes_JUKEBOX_abc.zarr"
+    zarr.save(str(zarr_filepath), embeddings)
+    register_embeddings(
+        dataset_folder,
+        zarr_filepath,
+        "abc",
+        {"model_name": "JUKEBOX"},
+        embeddings.shape,
+        embeddings.dtype,
+    )
+    return zarr_filepath
+
+
 def extract_embeddings_for_model_config_mock_subprocess(
     model_config, dataset_writer: DatasetWriter, max_samples_per_shard: int = 32
 ) -> List[Path]:
+    # extraction needs the foundation model libraries, the other helpers do not
+    from embeddings.extract_embeddings import (
+        get_scripts_to_extract_embeddings_for_dataset_with_model,
+    )
+    from embeddings.embeddings_cli import extract_shard
+
     model_config_checksum = compute_checksum(model_config)
     with patch("subprocess.run") as mock_run:
         mock_result = Mock()